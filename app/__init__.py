@@ -1,9 +1,11 @@
-from flask import Flask
+from flask import Flask, g, request
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager
 from config import Config
+from services import logs, metrics
 import os
+import time
 
 db = SQLAlchemy()
 migrate = Migrate()
@@ -12,6 +14,8 @@ login.login_view = 'auth.login' # Assuming auth blueprint for login routes
 login.login_message = 'الرجاء تسجيل الدخول للوصول إلى هذه الصفحة.'
 
 def create_app(config_class=Config):
+    # Queue-based JSON logging, set up before Flask adds its own handler
+    logs.setup_logging("web")
     app = Flask(__name__)
     app.config.from_object(config_class)
 
@@ -29,6 +33,34 @@ def create_app(config_class=Config):
     from app.routes.admin import bp as admin_bp
     app.register_blueprint(admin_bp, url_prefix='/admin')
 
+    # Request timing for the /metrics endpoint
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_request_time(response):
+        started = g.pop('request_started', None)
+        if started is not None:
+            metrics.HTTP_REQUEST_SECONDS.observe(
+                time.perf_counter() - started,
+                endpoint=request.endpoint or 'unknown',
+                status=response.status_code,
+            )
+        return response
+
+    # Statement count / SQL time budget per request, N+1 warnings
+    from app.utils import query_budget
+    query_budget.init_app(app)
+
+    # Fingerprinted, precompressed static files (before view_cache: page ETags cover asset URLs)
+    from app.utils import assets
+    assets.init_app(app)
+
+    # Rendered page/fragment cache and conditional GET
+    from app.utils import view_cache
+    view_cache.init_app(app)
+
     # Create database tables if they don't exist (useful for SQLite)
     # For PostgreSQL with migrations, this isn't strictly necessary after initial migration
     # with app.app_context():
@@ -1,7 +1,9 @@
 from datetime import datetime, timezone
 from werkzeug.security import generate_password_hash, check_password_hash
+from flask import current_app
 from flask_login import UserMixin
 from app import db, login
+from app.utils.identity import AdminIdentity, IdentityCache, parse_session_id
 
 class User(UserMixin, db.Model):
     __tablename__ = 'users' # Explicit table name
@@ -10,12 +12,21 @@ class User(UserMixin, db.Model):
     first_name = db.Column(db.String(64), nullable=True)
     last_name = db.Column(db.String(64), nullable=True)
     username = db.Column(db.String(64), nullable=True, index=True)
-    joined_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    joined_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), index=True) # Admin users list order
     last_active_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    updated_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc), index=True) # Polled by the bot's ban list
     is_subscribed = db.Column(db.Boolean, default=False, nullable=False) # <<< أضف هذا السطر
     is_banned = db.Column(db.Boolean, default=False, nullable=False)     # <<< أضف هذا السطر (لمنع من ألغوا الاشتراك)
     downloads = db.relationship('Download', backref='user', lazy='dynamic')
 
+    __table_args__ = (
+        # Banned users are a small minority, so a partial index keeps the ban
+        # list load cheap. The opposite partial (is_banned = false) would cover
+        # nearly every row and buy nothing over a full scan for broadcasts.
+        db.Index('ix_users_banned', 'telegram_user_id',
+                 postgresql_where=db.text('is_banned = true'), sqlite_where=db.text('is_banned = 1')),
+    )
+
     def __repr__(self):
         return f'<User {self.username or self.telegram_user_id}>'
 
@@ -33,16 +44,33 @@ class Admin(UserMixin, db.Model):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+    def get_id(self):
+        # Prefixed so load_user never confuses an admin with a bot user of the same id
+        return f"admin:{self.id}"
+
     def __repr__(self):
         return f'<Admin {self.username}>'
 
+admin_identities = IdentityCache()
+
+def cache_admin_identity(admin):
+    identity = AdminIdentity.from_admin(admin)
+    admin_identities.ttl = current_app.config.get("ADMIN_IDENTITY_TTL", 60)
+    admin_identities.set(admin.id, identity)
+    return identity
+
 @login.user_loader
 def load_user(id):
-    # Check both User and Admin tables
-    user = User.query.get(int(id))
-    if user:
-        return user
-    return Admin.query.get(int(id))
+    kind, principal_id = parse_session_id(id)
+    if kind != "admin":
+        return None # Bot users never log in to the web panel
+    identity = admin_identities.get(principal_id)
+    if identity is None:
+        admin = db.session.get(Admin, principal_id)
+        if admin is None:
+            return None
+        identity = cache_admin_identity(admin)
+    return identity
 
 # --- Models for Bot Functionality ---
 
@@ -55,6 +83,11 @@ class Download(db.Model):
     status = db.Column(db.String(64), default='success') # e.g., success, failed, pending
     error_message = db.Column(db.Text, nullable=True)
 
+    __table_args__ = (
+        # A user's history, newest first; also serves plain user_id lookups
+        db.Index('ix_downloads_user_id_download_time', 'user_id', 'download_time'),
+    )
+
     def __repr__(self):
         return f'<Download {self.id} by User {self.user_id}>'
 
@@ -1,8 +1,11 @@
 # Placeholder for admin dashboard routes
-from flask import Blueprint, render_template, redirect, url_for, flash, request, current_app
+from flask import Blueprint, Response, jsonify, make_response, render_template, redirect, url_for, flash, request, current_app, abort, stream_with_context
 from flask_login import login_required
 from app import db # Remove Message from this import
-from app.models import User, Setting # Add Setting import
+from app.models import User, Download, Setting # Add Setting import
+from app.utils import view_cache
+from app.utils.export import encode_rows
+from services import activity, segments, tracing
 from datetime import datetime, timezone # Import datetime
 import telegram
 import threading
@@ -13,6 +16,7 @@ bp = Blueprint("admin", __name__)
 
 @bp.route("/dashboard")
 @login_required # Protect this route
+@view_cache.cached_page(view_cache.static_version, public=False)
 def dashboard():
     # This will render the admin dashboard template
     return render_template("admin/dashboard.html")
@@ -22,8 +26,23 @@ def dashboard():
 def users_list():
     page = request.args.get("page", 1, type=int)
     per_page = current_app.config.get("ADMIN_USERS_PER_PAGE", 15) # Configurable items per page
-    users = db.session.query(User).order_by(User.joined_at.desc()).paginate(page=page, per_page=per_page, error_out=False)
-    return render_template("admin/users.html", users=users)
+    version, total = view_cache.users_version()
+    etag = view_cache.etag_for("admin.users_list", page, per_page, version.tag)
+    response = view_cache.not_modified(etag, version.last_modified)
+    if response is not None:
+        return response
+
+    def render_table():
+        # The version query already counted the users
+        users = db.session.query(User).order_by(User.joined_at.desc()).paginate(page=page, per_page=per_page, error_out=False, count=False)
+        users.total = total
+        # Download counts for the whole page in one query (was one COUNT per row)
+        summaries = activity.get_summaries(db.session, [user.telegram_user_id for user in users.items])
+        return render_template("admin/_users_table.html", users=users, summaries=summaries)
+
+    users_table = view_cache.fragment("users_table", version, page, per_page, render=render_table)
+    response = make_response(render_template("admin/users.html", users_table=users_table))
+    return view_cache.set_validators(response, etag, version.last_modified)
 
 @bp.route("/users/<int:user_id>/ban", methods=["GET"]) # Use GET for simplicity, POST is better practice
 @login_required
@@ -70,10 +89,12 @@ def settings():
                 "warning_message_text",
                 "warning_message_color"
             ]
+            # Load every setting being updated in one query instead of one per key
+            existing = {setting.key: setting for setting in db.session.query(Setting).filter(Setting.key.in_(settings_to_update))}
             for key in settings_to_update:
                 value = request.form.get(key)
                 if value is not None:
-                    setting = db.session.query(Setting).filter_by(key=key).first() # Use filter_by for non-primary key
+                    setting = existing.get(key)
                     if setting:
                         setting.value = value
                         setting.last_updated = datetime.now(timezone.utc)
@@ -106,10 +127,10 @@ def settings():
             "warning_message_color"
         ]
         settings_data = {}
+        stored = dict(db.session.query(Setting.key, Setting.value).filter(Setting.key.in_(settings_keys)))
         for key in settings_keys:
-            setting = db.session.query(Setting).filter_by(key=key).first()
-            if setting:
-                settings_data[key] = setting.value
+            if key in stored:
+                settings_data[key] = stored[key]
             else:
                 # Provide default values if setting not found in DB
                 if key == "warning_message_text":
@@ -124,15 +145,136 @@ def settings():
 
     return render_template("admin/settings.html", settings=settings_data)
 
+@bp.route("/traces")
+@login_required
+def slow_requests():
+    # Slowest recently traced bot requests, broken down by pipeline stage
+    traces = tracing.read_slowest(current_app.config["TRACE_FILE"], limit=50)
+    return render_template("admin/traces.html", traces=traces)
+
+# --- Exports ---
+# Columns an admin may export per table, and the column the date range filters on
+EXPORTS = {
+    "users": {
+        "columns": {
+            "id": User.id,
+            "telegram_user_id": User.telegram_user_id,
+            "username": User.username,
+            "first_name": User.first_name,
+            "last_name": User.last_name,
+            "joined_at": User.joined_at,
+            "last_active_at": User.last_active_at,
+            "is_subscribed": User.is_subscribed,
+            "is_banned": User.is_banned,
+        },
+        "date_column": User.joined_at,
+        "order_by": User.id,
+    },
+    "downloads": {
+        "columns": {
+            "id": Download.id,
+            "user_id": Download.user_id,
+            "telegram_user_id": User.telegram_user_id,
+            "url": Download.url,
+            "download_time": Download.download_time,
+            "status": Download.status,
+            "error_message": Download.error_message,
+        },
+        "date_column": Download.download_time,
+        "order_by": Download.id,
+    },
+}
+EXPORT_BATCH_SIZE = 1000 # Rows fetched per round trip from the server-side cursor
+
+def _parse_date_arg(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        abort(400, f"Invalid {name} date: {value}")
+
+@bp.route("/export/<table>")
+@login_required
+def export(table):
+    # Streams a whole table without loading it: /admin/export/downloads?format=jsonl&gzip=1&since=2024-01-01
+    spec = EXPORTS.get(table)
+    if spec is None:
+        abort(404)
+    fmt = request.args.get("format", "csv")
+    if fmt not in ("csv", "jsonl"):
+        abort(400, "format must be csv or jsonl")
+    names = [name for name in request.args.get("columns", "").split(",") if name] or list(spec["columns"])
+    unknown = [name for name in names if name not in spec["columns"]]
+    if unknown:
+        abort(400, f"Unknown columns: {', '.join(unknown)}")
+    compress = request.args.get("gzip") in ("1", "true", "yes")
+    since = _parse_date_arg("since")
+    until = _parse_date_arg("until")
+
+    query = db.select(*[spec["columns"][name].label(name) for name in names])
+    if table == "downloads" and "telegram_user_id" in names:
+        query = query.select_from(Download).join(User, Download.user_id == User.id)
+    if since:
+        query = query.where(spec["date_column"] >= since)
+    if until:
+        query = query.where(spec["date_column"] < until)
+    # yield_per streams through a server-side cursor where the driver has one (psycopg2)
+    query = query.order_by(spec["order_by"]).execution_options(yield_per=EXPORT_BATCH_SIZE)
+
+    def generate():
+        result = db.session.execute(query)
+        try:
+            yield from encode_rows(names, (tuple(row) for row in result), fmt, compress)
+        finally:
+            result.close()
+
+    filename = f"{table}-{datetime.now(timezone.utc):%Y%m%d-%H%M%S}.{fmt}"
+    mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    if compress:
+        filename += ".gz"
+        mimetype = "application/gzip"
+    response = Response(stream_with_context(generate()), mimetype=mimetype)
+    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    response.headers["X-Accel-Buffering"] = "no" # Don't let nginx buffer the whole file
+    return response
+
 # Function to send message in a background thread
 def send_telegram_message_async(bot_token, chat_id, text):
     try:
         bot = telegram.Bot(token=bot_token)
         # Corrected the parse_mode argument below
         bot.send_message(chat_id=chat_id, text=text, parse_mode='Markdown') # <<< تم تصحيح هذا السطر
-        current_app.logger.info(f"Message sent to {chat_id}")
+        current_app.logger.info("Message sent to %s", chat_id)
     except Exception as e:
-        current_app.logger.error(f"Failed to send message to {chat_id}: {e}")
+        current_app.logger.error("Failed to send message to %s: %s", chat_id, e)
+
+def audience_choices():
+    """(target_group, label) pairs for the broadcast form, see services/segments.py."""
+    choices = [("all", "جميع المستخدمين")]
+    choices += [(f"active_{days}d", f"النشطون خلال آخر {days} يوماً") for days in segments.ACTIVE_WINDOWS]
+    choices += [
+        ("subscribed", "المشتركون في القناة"),
+        ("heavy", f"كثيرو التحميل ({segments.HEAVY_DOWNLOADER_MIN} تحميل أو أكثر)"),
+        (segments.JOINED_AFTER, "المنضمون بعد تاريخ"),
+    ]
+    return choices
+
+def parse_joined_after(value):
+    try:
+        return datetime.strptime(value or "", "%Y-%m-%d")
+    except ValueError:
+        return None
+
+@bp.route("/broadcast/audience")
+@login_required
+def broadcast_audience():
+    # Size of the "joined after" audience for the date picked in the form
+    since = parse_joined_after(request.args.get("joined_after"))
+    if since is None:
+        abort(400)
+    return jsonify(size=segments.count_joined_after(db.session, since))
 
 @bp.route("/broadcast", methods=["GET", "POST"])
 @login_required
@@ -150,11 +292,27 @@ def broadcast():
             flash("لم يتم تكوين توكن بوت التليجرام في الإعدادات.", "danger")
             return redirect(url_for("admin.broadcast"))
 
+        if target_group not in dict(audience_choices()):
+            flash("الفئة المستهدفة غير صالحة.", "warning")
+            return redirect(url_for("admin.broadcast"))
+
+        since = None
+        if target_group == segments.JOINED_AFTER:
+            since = parse_joined_after(request.form.get("joined_after"))
+            if since is None:
+                flash("يرجى اختيار تاريخ انضمام صحيح.", "warning")
+                return redirect(url_for("admin.broadcast"))
+
         try:
-            users_to_message = []
-            if target_group == "all":
-                users_to_message = db.session.query(User).filter_by(is_banned=False).all()
-            # Add other target groups logic here later
+            if target_group != segments.JOINED_AFTER and target_group not in segments.get_sizes(db.session):
+                # Not computed yet (the bot's refresh job has not run)
+                segments.refresh(db.engine, [target_group])
+            # Precomputed member ids, read in primary-key pages
+            users_to_message = [
+                telegram_user_id
+                for batch in segments.iter_members(db.session, target_group, since)
+                for telegram_user_id in batch
+            ]
 
             if not users_to_message:
                 flash("لم يتم العثور على مستخدمين لإرسال الرسالة إليهم.", "warning")
@@ -171,9 +329,9 @@ def broadcast():
             sent_count = 0
             failed_count = 0
             threads = []
-            for user in users_to_message:
+            for telegram_user_id in users_to_message:
                 # Create and start a new thread for each message
-                thread = threading.Thread(target=send_telegram_message_async, args=(bot_token, user.telegram_user_id, message_text))
+                thread = threading.Thread(target=send_telegram_message_async, args=(bot_token, telegram_user_id, message_text))
                 threads.append(thread)
                 thread.start()
                 sent_count += 1 # Assuming thread starts successfully, actual success is logged inside thread
@@ -191,6 +349,7 @@ def broadcast():
         return redirect(url_for("admin.broadcast"))
 
     # For GET request
-    return render_template("admin/broadcast.html")
+    return render_template("admin/broadcast.html", choices=audience_choices(), sizes=segments.get_sizes(db.session),
+                           joined_after=segments.JOINED_AFTER)
 
 # ... (rest of the code)
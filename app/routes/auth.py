@@ -2,7 +2,7 @@
 from flask import Blueprint, render_template, redirect, url_for, flash, request
 from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.security import check_password_hash
-from app.models import Admin
+from app.models import Admin, admin_identities, cache_admin_identity
 from app import db
 
 bp = Blueprint("auth", __name__)
@@ -19,6 +19,7 @@ def login():
 
         if admin and admin.check_password(password):
             login_user(admin) # Log in the admin user
+            cache_admin_identity(admin) # So the next page view needs no lookup
             flash("تم تسجيل الدخول بنجاح!", "success")
             next_page = request.args.get("next")
             return redirect(next_page or url_for("admin.dashboard"))
@@ -32,6 +33,7 @@ def login():
 @bp.route("/logout")
 @login_required
 def logout():
+    admin_identities.invalidate(current_user.id)
     logout_user()
     flash("تم تسجيل الخروج بنجاح.", "info")
     return redirect(url_for("main.index"))
@@ -1,7 +1,9 @@
 # Placeholder for main routes
-from flask import Blueprint, render_template, jsonify, current_app
+from flask import Blueprint, Response, render_template, jsonify, current_app
 from app import db
 from app.models import User, Download, Setting
+from app.utils import view_cache
+from services import metrics
 import datetime
 import time
 
@@ -12,6 +14,7 @@ bp = Blueprint("main", __name__)
 app_start_time = time.time()
 
 # Function to get stats from database
+@metrics.DB_QUERY_SECONDS.time(helper="get_stats_from_db")
 def get_stats_from_db():
     stats = {
         "visitors": 0,  # Visitor count needs a better mechanism (e.g., Redis, dedicated table, or analytics service)
@@ -49,7 +52,7 @@ def get_stats_from_db():
         db.session.commit()
     except Exception as e:
         db.session.rollback() # Rollback in case of error
-        current_app.logger.error(f"Error getting stats from DB: {e}")
+        current_app.logger.error("Error getting stats from DB: %s", e)
         # Return defaults or indicate error
         stats["visitors"] = "N/A"
         stats["bot_users"] = "N/A"
@@ -63,18 +66,21 @@ def get_warning_message_from_db():
         "color": "red"
     }
     try:
-        # CORRECTED: Use filter_by for non-primary key lookup
-        warning_text_setting = db.session.query(Setting).filter_by(key="warning_message_text").first()
-        warning_color_setting = db.session.query(Setting).filter_by(key="warning_message_color").first()
+        # Both keys in one query
+        rows = db.session.query(Setting.key, Setting.value).filter(
+            Setting.key.in_(["warning_message_text", "warning_message_color"])
+        ).all()
+        values = dict(rows)
 
-        text = warning_text_setting.value if warning_text_setting else default_warning["text"]
-        color = warning_color_setting.value if warning_color_setting else default_warning["color"]
+        text = values.get("warning_message_text", default_warning["text"])
+        color = values.get("warning_message_color", default_warning["color"])
         return {"text": text, "color": color}
     except Exception as e:
-        current_app.logger.error(f"Error getting warning message from DB: {e}")
+        current_app.logger.error("Error getting warning message from DB: %s", e)
         return default_warning
 
 @bp.route("/")
+@view_cache.cached_page(view_cache.settings_version)
 def index():
     # Render the main frontend page
     return render_template("index.html")
@@ -95,3 +101,8 @@ def api_stats():
         "server_start_timestamp": start_timestamp
     })
 
+
+@bp.route("/metrics")
+def metrics_endpoint():
+    # Prometheus scrape target (counters are per worker process)
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
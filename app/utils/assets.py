@@ -0,0 +1,206 @@
+# Fingerprinted, precompressed static assets
+#
+# build() copies every file under app/static into app/static/dist with a
+# content hash in its name (css/style.css -> css/style.3f2a9c0d1e.css) and
+# writes gzip and, when the Brotli package is installed, brotli variants of
+# text assets next to them. A manifest.json maps the source paths to the
+# fingerprinted ones.
+#
+# init_app() runs the build at startup when the manifest is missing or older
+# than a source file (ASSETS_BUILD_ON_STARTUP). It then makes
+# url_for('static', filename='css/style.css') return the fingerprinted URL,
+# so templates need no changes. Fingerprinted files are served with
+# far-future immutable cache headers, and the brotli or gzip variant goes to
+# clients that accept it. A changed file gets a new name, so browsers never
+# need to revalidate; repeat page loads make no asset requests.
+#
+#   flask --app run assets build    # as a deploy step instead of at startup
+#
+# Config:
+#   ASSETS_FINGERPRINT       default True; False serves app/static as before
+#   ASSETS_BUILD_ON_STARTUP  default True
+import fcntl
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+import tempfile
+
+import click
+from flask import current_app, request, send_from_directory
+from flask.cli import AppGroup
+
+try:
+    import brotli
+except ImportError: # Optional: gzip variants only
+    brotli = None
+
+DIST = "dist"
+MANIFEST = "manifest.json"
+COMPRESSIBLE = {".css", ".js", ".svg", ".json", ".txt", ".map", ".html", ".xml"}
+MIN_COMPRESS_BYTES = 256 # Smaller files are not worth a variant
+IMMUTABLE = "public, max-age=31536000, immutable"
+ENCODINGS = (("br", ".br"), ("gzip", ".gz")) # Preferred first
+CSS_URL_RE = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+
+_manifest = {}
+
+
+def _sources(static_folder):
+    for root, dirs, files in os.walk(static_folder):
+        if root == static_folder:
+            # Build output, old builds and builds in progress
+            dirs[:] = [name for name in dirs if name != DIST and not name.startswith((".", DIST + "."))]
+        for name in files:
+            if name.startswith("."):
+                continue
+            path = os.path.join(root, name)
+            yield os.path.relpath(path, static_folder).replace(os.sep, "/"), path
+
+
+def _fingerprinted(name, content):
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{hashlib.sha256(content).hexdigest()[:10]}{ext}"
+
+
+def _rewrite_css(name, content, manifest):
+    """Points relative url() references in a stylesheet at fingerprinted files."""
+    base = os.path.dirname(name)
+
+    def replace(match):
+        quote, target = match.groups()
+        if re.match(r"^(?:[a-z]+:|/|#)", target):
+            return match.group(0) # Absolute, data: or fragment
+        path, sep, suffix = target.partition("?") if "?" in target else target.partition("#")
+        resolved = os.path.normpath(os.path.join(base, path)).replace(os.sep, "/")
+        if resolved not in manifest:
+            return match.group(0)
+        new = os.path.relpath(manifest[resolved], base or ".").replace(os.sep, "/")
+        return f"url({quote}{new}{sep}{suffix}{quote})"
+
+    return CSS_URL_RE.sub(replace, content.decode("utf-8")).encode("utf-8")
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+
+
+def build(static_folder):
+    """Builds static/dist and its manifest. Returns the manifest."""
+    dist = os.path.join(static_folder, DIST)
+    tmp = tempfile.mkdtemp(dir=static_folder, prefix=".dist-")
+    try:
+        manifest = {}
+        # Stylesheets last, so the files they reference already have their names
+        sources = sorted(_sources(static_folder), key=lambda item: (item[0].endswith(".css"), item[0]))
+        for name, path in sources:
+            with open(path, "rb") as f:
+                content = f.read()
+            if name.endswith(".css"):
+                content = _rewrite_css(name, content, manifest)
+            target = _fingerprinted(name, content)
+            manifest[name] = target
+            out = os.path.join(tmp, target)
+            _write(out, content)
+            if os.path.splitext(name)[1] in COMPRESSIBLE and len(content) >= MIN_COMPRESS_BYTES:
+                _write(out + ".gz", gzip.compress(content, compresslevel=9, mtime=0))
+                if brotli is not None:
+                    _write(out + ".br", brotli.compress(content, quality=11))
+        _write(os.path.join(tmp, MANIFEST), json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8"))
+        # Swap the whole directory so a running worker never sees half a build
+        old = dist + ".old"
+        shutil.rmtree(old, ignore_errors=True)
+        if os.path.exists(dist):
+            os.replace(dist, old)
+        os.replace(tmp, dist)
+        shutil.rmtree(old, ignore_errors=True)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return manifest
+
+
+def _stale(static_folder):
+    manifest_path = os.path.join(static_folder, DIST, MANIFEST)
+    if not os.path.exists(manifest_path):
+        return True
+    built = os.path.getmtime(manifest_path)
+    return any(os.path.getmtime(path) > built for _, path in _sources(static_folder))
+
+
+def load_manifest(static_folder):
+    try:
+        with open(os.path.join(static_folder, DIST, MANIFEST), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def manifest_hash():
+    """Changes whenever an asset does (for page ETags)."""
+    return hashlib.sha1(json.dumps(_manifest, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+
+
+def _static_url(endpoint, values):
+    if endpoint == "static":
+        fingerprinted = _manifest.get(values.get("filename"))
+        if fingerprinted:
+            values["filename"] = f"{DIST}/{fingerprinted}"
+
+
+def _serve_static(filename):
+    """The static view: fingerprinted files get their precompressed variant
+    and immutable caching, anything else is served as Flask would."""
+    static_folder = current_app.static_folder
+    if not filename.startswith(DIST + "/"):
+        return current_app.send_static_file(filename)
+    path, encoding = filename, None
+    for name, suffix in ENCODINGS:
+        if request.accept_encodings[name] and os.path.isfile(os.path.join(static_folder, filename + suffix)):
+            path, encoding = filename + suffix, name
+            break
+    # The type of the original file, not application/gzip
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    response = send_from_directory(static_folder, path, mimetype=mimetype)
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    response.headers["Cache-Control"] = IMMUTABLE
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+assets_cli = AppGroup("assets", help="Static asset pipeline.")
+
+
+@assets_cli.command("build")
+def build_command():
+    """Fingerprint and precompress app/static into app/static/dist."""
+    manifest = build(current_app.static_folder)
+    click.echo(f"Built {len(manifest)} assets{'' if brotli else ' (gzip only, Brotli is not installed)'}.")
+
+
+def init_app(app):
+    global _manifest
+    app.config.setdefault("ASSETS_FINGERPRINT", True)
+    app.config.setdefault("ASSETS_BUILD_ON_STARTUP", True)
+    app.cli.add_command(assets_cli)
+    if not app.config["ASSETS_FINGERPRINT"]:
+        return
+    if app.config["ASSETS_BUILD_ON_STARTUP"]:
+        try:
+            # Web workers start together; one builds, the others wait for it
+            with open(os.path.join(app.static_folder, ".assets.lock"), "w") as lock:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+                if _stale(app.static_folder):
+                    build(app.static_folder)
+        except OSError as e:
+            app.logger.error("Could not build static assets, serving them unversioned: %s", e)
+    _manifest = load_manifest(app.static_folder)
+    if _manifest:
+        app.url_defaults(_static_url)
+        app.view_functions["static"] = _serve_static
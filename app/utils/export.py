@@ -0,0 +1,55 @@
+# Streaming CSV / JSON-lines encoders for the admin exports
+import csv
+import io
+import json
+import zlib
+
+CHUNK_SIZE = 64 * 1024 # Bytes of encoded rows per yielded chunk
+
+
+def _csv_lines(columns, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _jsonl_lines(columns, rows):
+    parts = []
+    size = 0
+    for row in rows:
+        line = json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=str) + "\n"
+        parts.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE:
+            yield "".join(parts)
+            parts = []
+            size = 0
+    yield "".join(parts)
+
+
+def _gzip(chunks):
+    # wbits=31 writes a gzip header and trailer instead of raw zlib
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def encode_rows(columns, rows, fmt="csv", compress=False):
+    """Encodes an iterable of row tuples as chunks of CSV or JSON-lines bytes.
+
+    Only one chunk is held in memory at a time, so feeding it a streamed
+    query result keeps memory flat however many rows there are.
+    """
+    lines = _csv_lines(columns, rows) if fmt == "csv" else _jsonl_lines(columns, rows)
+    chunks = (text.encode("utf-8") for text in lines if text)
+    return _gzip(chunks) if compress else chunks
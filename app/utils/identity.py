@@ -0,0 +1,75 @@
+# Login identities for Flask-Login
+#
+# Session ids carry the principal type ("admin:<id>") so load_user knows which
+# table to read, and loaded admins are cached in-process for a short TTL so an
+# authenticated page view normally costs no query at all. The cache holds
+# plain AdminIdentity snapshots, not ORM objects, so entries can be shared
+# across requests and threads without being tied to a DB session.
+import threading
+import time
+
+from flask_login import UserMixin
+
+ADMIN_PREFIX = "admin:"
+
+
+class AdminIdentity(UserMixin):
+    """What ``current_user`` is for a logged-in admin."""
+
+    def __init__(self, id, username, role):
+        self.id = id
+        self.username = username
+        self.role = role
+
+    @classmethod
+    def from_admin(cls, admin):
+        return cls(admin.id, admin.username, admin.role)
+
+    def get_id(self):
+        return f"{ADMIN_PREFIX}{self.id}"
+
+    def __repr__(self):
+        return f'<AdminIdentity {self.username}>'
+
+
+class IdentityCache:
+    def __init__(self, ttl=60, max_entries=1024, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            identity, expires_at = entry
+            if expires_at < self.clock():
+                del self._entries[key]
+                return None
+            return identity
+
+    def set(self, key, identity):
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                # Few admins ever log in; dropping everything is simpler than LRU
+                self._entries.clear()
+            self._entries[key] = (identity, self.clock() + self.ttl)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+def parse_session_id(session_id):
+    """Returns (principal type, numeric id) or (None, None) if malformed.
+
+    Bare numeric ids come from sessions created before the prefix existed;
+    only admins can log in, so they are read as admin ids.
+    """
+    kind, _, raw_id = session_id.rpartition(":")
+    if not raw_id.isdigit():
+        return None, None
+    return (kind or "admin"), int(raw_id)
@@ -0,0 +1,153 @@
+# Per-request SQL statement budget and N+1 detector
+#
+# Every statement executed while a Flask request is active is counted and
+# timed through SQLAlchemy engine events. When a request goes over its budget
+# (statement count, SQL time, or the same statement repeated too often, the
+# usual sign of an N+1 loop) it is logged, or raised as QueryBudgetExceeded
+# when SQL_BUDGET_MODE is "raise" (for tests and CI).
+#
+# Config:
+#   SQL_QUERY_BUDGET      max statements per request (default 20)
+#   SQL_TIME_BUDGET_MS    max SQL time per request (default 500)
+#   SQL_REPEAT_THRESHOLD  same statement this many times = N+1 (default 5)
+#   SQL_BUDGET_MODE       "warn" (default), "raise" or "off"
+#
+# In debug mode responses also get X-SQL-Queries / X-SQL-Time-ms headers and
+# /debug/queries returns the per-endpoint totals.
+import functools
+import threading
+import time
+from collections import Counter
+
+from flask import current_app, g, has_request_context, jsonify, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class _RequestStats:
+    __slots__ = ("count", "seconds", "statements", "started")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = Counter()
+        self.started = []
+
+
+class EndpointTotals:
+    """Running per-endpoint totals, shown by /debug/queries."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = {}
+
+    def add(self, endpoint, stats):
+        with self.lock:
+            entry = self.totals.setdefault(endpoint, {"requests": 0, "statements": 0, "sql_ms": 0.0, "max_statements": 0})
+            entry["requests"] += 1
+            entry["statements"] += stats.count
+            entry["sql_ms"] += stats.seconds * 1000
+            entry["max_statements"] = max(entry["max_statements"], stats.count)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                endpoint: {
+                    "requests": entry["requests"],
+                    "statements_per_request": round(entry["statements"] / entry["requests"], 2),
+                    "max_statements": entry["max_statements"],
+                    "sql_ms_per_request": round(entry["sql_ms"] / entry["requests"], 3),
+                }
+                for endpoint, entry in sorted(self.totals.items())
+            }
+
+
+def query_budget(statements=None, time_ms=None):
+    """Overrides the app-wide budget for one view: @query_budget(statements=5)."""
+    def decorator(view):
+        view._query_budget = (statements, time_ms)
+
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            g.query_budget = view._query_budget
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        stats = g.get("sql_stats")
+        if stats is not None:
+            stats.started.append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        stats = g.get("sql_stats")
+        if stats is not None and stats.started:
+            stats.seconds += time.perf_counter() - stats.started.pop()
+            stats.count += 1
+            stats.statements[statement] += 1
+
+
+def _check(stats, endpoint, config):
+    statements, time_ms = g.get("query_budget") or (None, None)
+    statements = statements if statements is not None else config.get("SQL_QUERY_BUDGET", 20)
+    time_ms = time_ms if time_ms is not None else config.get("SQL_TIME_BUDGET_MS", 500)
+    repeat_threshold = config.get("SQL_REPEAT_THRESHOLD", 5)
+
+    problems = []
+    if stats.count > statements:
+        problems.append(f"{stats.count} SQL statements (budget {statements})")
+    if stats.seconds * 1000 > time_ms:
+        problems.append(f"{stats.seconds * 1000:.1f}ms of SQL (budget {time_ms}ms)")
+    for statement, times in stats.statements.most_common(3):
+        if times < repeat_threshold:
+            break
+        problems.append(f"possible N+1: ran {times}x: {' '.join(statement.split())[:200]}")
+    return problems
+
+
+def init_app(app):
+    mode = app.config.get("SQL_BUDGET_MODE", "warn")
+    if mode == "off":
+        return
+    totals = EndpointTotals()
+    app.extensions["query_budget"] = totals
+
+    # Listening on the Engine class covers engines created lazily by Flask-SQLAlchemy
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+    @app.before_request
+    def start_sql_stats():
+        g.sql_stats = _RequestStats()
+
+    @app.after_request
+    def check_sql_stats(response):
+        stats = g.pop("sql_stats", None)
+        if stats is None:
+            return response
+        endpoint = request.endpoint or "unknown"
+        totals.add(endpoint, stats)
+        if app.debug:
+            response.headers["X-SQL-Queries"] = str(stats.count)
+            response.headers["X-SQL-Time-ms"] = f"{stats.seconds * 1000:.1f}"
+        problems = _check(stats, endpoint, app.config)
+        if problems:
+            message = f"Query budget exceeded on {endpoint} ({request.path}): " + "; ".join(problems)
+            if mode == "raise":
+                raise QueryBudgetExceeded(message)
+            current_app.logger.warning(message)
+        return response
+
+    if app.debug:
+        @app.route("/debug/queries")
+        def debug_queries():
+            return jsonify(totals.snapshot())
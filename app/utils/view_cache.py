@@ -0,0 +1,227 @@
+# Response and fragment caching for rendered pages
+#
+# Rendered HTML is cached in-process, keyed by a version of the data it
+# shows. A version is one cheap query on an indexed column (e.g. the newest
+# users.updated_at plus the row count). When the data changes, the version
+# changes and old entries are never looked up again; they age out of the
+# LRU. Invalidation needs no hooks, so writes made by the bot process or by
+# other web workers are picked up too.
+#
+# * cached_page(version): full-page caching for pages that render the same
+#   for everyone (main.index, keyed by the settings version).
+# * fragment(name, version, *key, render=...): cached rendering of part of a
+#   page (the admin users table per page).
+# * not_modified() / set_validators(): ETag and Last-Modified headers. A
+#   conditional GET that still matches gets a 304 before anything is queried
+#   beyond the version or rendered.
+#
+# ETags also cover a hash of the templates and of the asset manifest, so a
+# deploy that changes a page or an asset URL in it changes its ETag. Responses showing flashed messages are never cached.
+#
+# Config:
+#   VIEW_CACHE_ENABLED  default True
+#   VIEW_CACHE_SIZE     rendered pages/fragments kept per process (default 512)
+#   VIEW_CACHE_TTL      seconds an entry may be served at most (default 300)
+import functools
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import timezone
+
+from flask import current_app, g, make_response, request, session
+from markupsafe import Markup
+from sqlalchemy import func, select
+
+from app.utils import assets
+from services import metrics
+
+Version = namedtuple("Version", ["tag", "last_modified"])
+
+
+class RenderCache:
+    def __init__(self, max_entries=512, ttl=300, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < self.clock():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, self.clock() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+cache = RenderCache()
+_build_id = ""
+
+
+def init_app(app):
+    global _build_id
+    app.config.setdefault("VIEW_CACHE_ENABLED", True)
+    cache.max_entries = app.config.setdefault("VIEW_CACHE_SIZE", 512)
+    cache.ttl = app.config.setdefault("VIEW_CACHE_TTL", 300)
+    digest = hashlib.sha1()
+    for root, _, files in sorted(os.walk(os.path.join(app.root_path, app.template_folder))):
+        for name in sorted(files):
+            with open(os.path.join(root, name), "rb") as f:
+                digest.update(f.read())
+    digest.update(assets.manifest_hash().encode("ascii"))
+    _build_id = digest.hexdigest()[:12]
+
+
+def _enabled():
+    return current_app.config.get("VIEW_CACHE_ENABLED", True)
+
+
+def _page_cacheable():
+    # Flashed messages are part of the page (base.html) and shown only once.
+    # Decided on first use: rendering the page consumes them.
+    if "view_cache_page" not in g:
+        g.view_cache_page = _enabled() and not session.get("_flashes")
+    return g.view_cache_page
+
+
+def _key(*parts):
+    return hashlib.sha1("\x1f".join(map(str, (_build_id,) + parts)).encode("utf-8")).hexdigest()
+
+
+def _utc(value):
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc) # Naive datetimes are stored as UTC
+    return value.replace(microsecond=0)
+
+
+# --- Versions ---
+
+def combine(*versions):
+    return Version("/".join(v.tag for v in versions),
+                   max((v.last_modified for v in versions if v.last_modified), default=None))
+
+
+def static_version():
+    """For pages that only change with a deploy (the template hash covers that)."""
+    return Version("static", None)
+
+
+def settings_version():
+    from app import db
+    from app.models import Setting
+
+    # visitor_count changes on every /api/stats call and is not shown in pages
+    newest, count = db.session.execute(
+        select(func.max(Setting.last_updated), func.count(Setting.id)).where(Setting.key != "visitor_count")
+    ).one()
+    return Version(f"settings:{count}:{newest}", _utc(newest))
+
+
+def users_version():
+    """Version of the admin users table, and the user count for pagination."""
+    from app import db
+    from app.models import User
+    from services.activity import user_activity
+
+    newest, count = db.session.execute(select(func.max(User.updated_at), func.count(User.id))).one()
+    # Download counts shown in the table come from user_activity
+    active = db.session.execute(select(func.max(user_activity.c.updated_at))).scalar()
+    return combine(Version(f"users:{count}:{newest}", _utc(newest)), Version(f"activity:{active}", _utc(active))), count
+
+
+# --- Conditional GET ---
+
+def etag_for(*parts):
+    return _key(*parts)
+
+
+def not_modified(etag, last_modified=None, public=False):
+    """A 304 response if the request's validators still match, else None."""
+    if not _page_cacheable():
+        return None
+    if request.if_none_match:
+        matched = request.if_none_match.contains(etag)
+    elif request.if_modified_since and last_modified:
+        matched = last_modified <= request.if_modified_since
+    else:
+        matched = False
+    if not matched:
+        return None
+    metrics.CACHE_REQUESTS_TOTAL.inc(cache="page", result="not_modified")
+    response = make_response("", 304)
+    set_validators(response, etag, last_modified, public)
+    return response
+
+
+def set_validators(response, etag, last_modified=None, public=False):
+    if not _page_cacheable():
+        return response
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    # Browsers keep the page but ask every time; a matching ETag costs a 304
+    response.headers["Cache-Control"] = "public, no-cache" if public else "private, no-cache"
+    return response
+
+
+# --- Caching ---
+
+def cached_page(version, public=True):
+    """Caches the rendered body of a view, keyed by ``version()`` and the URL."""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not _page_cacheable():
+                return view(*args, **kwargs)
+            current = version()
+            etag = etag_for(request.endpoint, request.full_path, current.tag)
+            response = not_modified(etag, current.last_modified, public)
+            if response is not None:
+                return response
+            body = cache.get(etag)
+            if body is None:
+                metrics.CACHE_REQUESTS_TOTAL.inc(cache="page", result="miss")
+                body = view(*args, **kwargs)
+                if not isinstance(body, str):
+                    return body # Redirects and the like are not cached
+                cache.set(etag, body)
+            else:
+                metrics.CACHE_REQUESTS_TOTAL.inc(cache="page", result="hit")
+            return set_validators(make_response(body), etag, current.last_modified, public)
+        return wrapper
+    return decorator
+
+
+def fragment(name, version, *key, render):
+    """The cached HTML of a page fragment; ``render()`` produces it on a miss."""
+    if not _enabled():
+        return Markup(render())
+    cache_key = _key("fragment", name, version.tag, *key)
+    html = cache.get(cache_key)
+    if html is None:
+        metrics.CACHE_REQUESTS_TOTAL.inc(cache="fragment", result="miss")
+        html = Markup(render())
+        cache.set(cache_key, html)
+    else:
+        metrics.CACHE_REQUESTS_TOTAL.inc(cache="fragment", result="hit")
+    return html
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of the bot handlers against a fake Telegram and a stub download API.
+
+Drives a scripted traffic mix through the same handler chain Pyrogram would
+run (throttle_message -> handle_message, or the command handlers), with a
+bounded number of concurrent handlers like Pyrogram's dispatcher workers.
+Reports latency percentiles, throughput, SQL statement counts, Telegram call
+counts and memory, and can write them to a JSON file for later comparison.
+
+    python -m benchmarks.bot_pipeline --scenario burst --messages 200 --output bench.json
+
+Scenarios:
+    burst      every message arrives at once, one distinct link per user
+    viral      many users send the same link over --duration seconds
+    broadcast  users reacting to a broadcast: mostly /start, some /stats and links
+    steady     Poisson arrivals spread over --duration seconds
+    multi      every message carries 5 distinct links, spread over --duration seconds
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+from benchmarks.fakes import FakeClient, FakeMessage, FakeUser, StubDownloadAPI
+from benchmarks.report import percentile
+
+SCENARIOS = ("burst", "viral", "broadcast", "steady", "multi")
+
+
+def build_traffic(scenario, count, duration, rng):
+    """Returns (arrival offset in seconds, user id, text) tuples."""
+    traffic = []
+    if scenario == "burst":
+        for i in range(count):
+            traffic.append((0.0, 1000 + i, f"https://www.instagram.com/p/BURST{i}/"))
+    elif scenario == "viral":
+        for i in range(count):
+            traffic.append((rng.uniform(0, duration), 1000 + i, "https://www.instagram.com/reel/VIRAL123/"))
+    elif scenario == "broadcast":
+        for i in range(count):
+            roll = rng.random()
+            if roll < 0.6:
+                text = "/start"
+            elif roll < 0.7:
+                text = "/stats"
+            else:
+                text = f"https://www.instagram.com/p/BCAST{i}/"
+            # Reactions cluster right after the broadcast lands
+            traffic.append((rng.expovariate(3 / max(duration, 0.001)), 1000 + i, text))
+    elif scenario == "steady":
+        offset = 0.0
+        rate = count / max(duration, 0.001)
+        for i in range(count):
+            offset += rng.expovariate(rate)
+            traffic.append((offset, 1000 + rng.randrange(count // 4 + 1), f"https://www.instagram.com/p/STEADY{i}/"))
+    elif scenario == "multi":
+        for i in range(count):
+            links = " ".join(f"https://instagram.com/p/MULTI{i}x{j}/" for j in range(5))
+            traffic.append((rng.uniform(0, duration), 1000 + i, f"شوف هذول {links}"))
+    traffic.sort(key=lambda item: item[0])
+    return traffic
+
+
+def configure_environment(args, api_url, db_path):
+    """bot.py reads its configuration at import time, so set it up first."""
+    os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+    os.environ["DOWNLOAD_API_URL"] = api_url
+    os.environ["REQUIRED_CHANNEL_USERNAME"] = "benchmark_channel"
+    os.environ["TELEGRAM_CHANNEL_ID"] = "-1001"
+    os.environ["BOT_MODE"] = "single"
+    os.environ["TRACE_SAMPLE_RATE"] = str(args.trace_sample_rate)
+    os.environ["TRACE_FILE"] = os.path.join(os.path.dirname(db_path), "bench_traces.jsonl")
+    if not args.rate_limit:
+        os.environ["RATE_LIMIT_BURST"] = str(10 ** 9)
+    os.environ["CACHE_CHAT_ID"] = "-1002" if args.warm else "0"
+    os.environ["WARM_MAX_LIVE_RATE"] = str(10 ** 9) # Warm even under benchmark load
+
+
+async def run_traffic(bot, client, traffic, concurrency):
+    from pyrogram import StopPropagation
+
+    link_chain = [bot.throttle_message, bot.handle_message]
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    warmer_task = None
+    if bot.CACHE_CHAT_ID:
+        bot.cache_warmer = bot.create_cache_warmer(client)
+        warmer_task = asyncio.create_task(bot.cache_warmer.run())
+
+    async def deliver(offset, user_id, text, message_id):
+        nonlocal errors
+        await asyncio.sleep(max(0.0, started + offset - time.perf_counter()))
+        arrived = time.perf_counter()
+        message = FakeMessage(client, message_id, user_id, from_user=FakeUser(user_id), text=text)
+        if text.startswith("/start"):
+            chain = [bot.start_command]
+        elif text.startswith("/stats"):
+            chain = [bot.stats_command]
+        else:
+            chain = link_chain
+        async with semaphore:
+            try:
+                for handler in chain:
+                    await handler(client, message)
+            except StopPropagation:
+                pass
+            except Exception as e:
+                errors += 1
+                logging.getLogger(__name__).error("Handler error: %s", e)
+        latencies.append(time.perf_counter() - arrived)
+
+    await asyncio.gather(*(
+        deliver(offset, user_id, text, index + 1)
+        for index, (offset, user_id, text) in enumerate(traffic)
+    ))
+    if warmer_task is not None:
+        warmer_task.cancel()
+    return latencies, errors, time.perf_counter() - started
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    tmpdir = tempfile.mkdtemp(prefix="bot_bench_")
+    db_path = os.path.join(tmpdir, "bench.db")
+
+    with StubDownloadAPI(latency=args.api_latency, error_rate=args.api_error_rate, seed=args.seed) as api:
+        configure_environment(args, api.url, db_path)
+        import bot
+        from sqlalchemy import event
+
+        bot.init_database()
+
+        logging.getLogger().setLevel(logging.WARNING)
+        statements = {"count": 0}
+
+        @event.listens_for(bot.engine, "before_cursor_execute")
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            statements["count"] += 1
+
+        client = FakeClient(
+            latency=args.telegram_latency,
+            upload_latency=args.upload_latency,
+            flood_wait_rate=args.flood_wait_rate,
+            error_rate=args.telegram_error_rate,
+            seed=args.seed,
+        )
+        traffic = build_traffic(args.scenario, args.messages, args.duration, rng)
+
+        if args.tracemalloc:
+            tracemalloc.start()
+        latencies, errors, elapsed = asyncio.run(run_traffic(bot, client, traffic, args.concurrency))
+        traced_peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+        tracemalloc.stop()
+
+        api_requests = api.requests
+        bot.engine.dispose()
+    shutil.rmtree(tmpdir, ignore_errors=True)
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # KiB on Linux
+    return {
+        "benchmark": "bot_pipeline",
+        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "scenario": args.scenario,
+        "messages": len(traffic),
+        "concurrency": args.concurrency,
+        "config": {
+            "duration": args.duration,
+            "telegram_latency": args.telegram_latency,
+            "upload_latency": args.upload_latency,
+            "api_latency": args.api_latency,
+            "api_error_rate": args.api_error_rate,
+            "telegram_error_rate": args.telegram_error_rate,
+            "flood_wait_rate": args.flood_wait_rate,
+            "warm": args.warm,
+            "seed": args.seed,
+        },
+        "elapsed_s": round(elapsed, 3),
+        "throughput_per_s": round(len(traffic) / elapsed, 2) if elapsed else None,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 1),
+            "p95": round(percentile(latencies, 95) * 1000, 1),
+            "p99": round(percentile(latencies, 99) * 1000, 1),
+            "max": round(max(latencies) * 1000, 1),
+        },
+        "handler_errors": errors,
+        "db_statements": statements["count"],
+        "db_statements_per_message": round(statements["count"] / max(len(traffic), 1), 2),
+        "api_requests": api_requests,
+        "media_cache": {
+            result: int(bot.metrics.CACHE_REQUESTS_TOTAL.value(cache="media", result=result)) for result in ("hit", "miss")
+        },
+        "telegram_calls": dict(client.calls),
+        "max_rss_kb": max_rss,
+        "tracemalloc_peak_kb": round(traced_peak / 1024) if traced_peak is not None else None,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the bot handlers with fake Telegram and API.")
+    parser.add_argument("--scenario", choices=SCENARIOS, default="burst")
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=5.0, help="arrival window for spread-out scenarios (s)")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent handlers, like Pyrogram workers")
+    parser.add_argument("--telegram-latency", type=float, default=0.05)
+    parser.add_argument("--upload-latency", type=float, default=0.3)
+    parser.add_argument("--api-latency", type=float, default=0.5)
+    parser.add_argument("--api-error-rate", type=float, default=0.0)
+    parser.add_argument("--telegram-error-rate", type=float, default=0.0)
+    parser.add_argument("--flood-wait-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit", action="store_true", help="keep the bot's per-user rate limiter on")
+    parser.add_argument("--warm", action="store_true", help="enable trending-post cache warming")
+    parser.add_argument("--trace-sample-rate", type=float, default=0.0)
+    parser.add_argument("--tracemalloc", action="store_true", help="report Python heap peak (slower)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="append the result as a JSON line to this file")
+    args = parser.parse_args(argv)
+
+    result = run(args)
+    json.dump(result, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
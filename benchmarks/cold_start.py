@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""Cold-start benchmark for the bot worker.
+
+Starts fresh interpreters that run ``run_telegram_bot.prepare()`` (importing
+the bot, checking the schema revision, migrating if needed, creating the bot
+tables), i.e. everything before the bot connects to Telegram. Reports the wall
+time per process and per stage, once against an empty database (migrations
+run) and then repeatedly against an up-to-date one (the normal restart).
+
+    python -m benchmarks.cold_start --runs 10
+    python -m benchmarks.cold_start --importtime   # also list the slowest imports
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from benchmarks.report import percentile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = """
+import json, logging, time
+started = time.perf_counter()
+import run_telegram_bot
+logging.disable(logging.CRITICAL)
+timings = run_telegram_bot.prepare()
+timings["total_in_process"] = time.perf_counter() - started
+print("TIMINGS " + json.dumps(timings))
+"""
+
+
+def start_once(database_url, extra_args=()):
+    env = dict(os.environ, DATABASE_URL=database_url, PYTHONPATH=REPO_ROOT)
+    started = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, *extra_args, "-c", CHILD],
+        cwd=REPO_ROOT, env=env, capture_output=True, text=True, check=True,
+    )
+    wall = time.perf_counter() - started
+    for line in completed.stdout.splitlines():
+        if line.startswith("TIMINGS "):
+            timings = json.loads(line[len("TIMINGS "):])
+            timings["wall"] = wall
+            return timings, completed.stderr
+    raise RuntimeError(f"Child did not report timings:\n{completed.stderr}")
+
+
+def slowest_imports(stderr, limit=10, max_depth=3):
+    """Slowest imports by cumulative time from ``-X importtime`` output.
+
+    Only the first levels of the import tree are kept, so the entries are
+    what the bot's own modules import rather than library internals.
+    """
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2 + 1
+        if cumulative.strip().isdigit() and depth <= max_depth:
+            rows.append((int(cumulative), name.strip()))
+    rows.sort(reverse=True)
+    return [{"module": name, "ms": round(us / 1000, 1)} for us, name in rows[:limit]]
+
+
+def summarize(samples):
+    stages = sorted({stage for sample in samples for stage in sample})
+    return {
+        stage: {
+            "p50_ms": round(percentile([s[stage] for s in samples if stage in s], 50) * 1000, 1),
+            "max_ms": round(max(s[stage] for s in samples if stage in s) * 1000, 1),
+        }
+        for stage in stages
+    }
+
+
+def run(args):
+    tmpdir = tempfile.mkdtemp(prefix="cold_start_")
+    database_url = args.database_url or "sqlite:///" + os.path.join(tmpdir, "bench.db")
+    try:
+        first, _ = start_once(database_url)
+        warm = [start_once(database_url)[0] for _ in range(args.runs)]
+        result = {
+            "benchmark": "cold_start",
+            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "database": database_url.split(":", 1)[0],
+            "runs": args.runs,
+            "first_boot_ms": {stage: round(seconds * 1000, 1) for stage, seconds in first.items()},
+            "restart": summarize(warm),
+        }
+        if args.importtime:
+            _, stderr = start_once(database_url, ("-X", "importtime"))
+            result["slowest_imports"] = slowest_imports(stderr)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure bot worker startup time.")
+    parser.add_argument("--runs", type=int, default=5, help="restarts against the migrated database")
+    parser.add_argument("--database-url", help="defaults to a temporary SQLite file (must start empty)")
+    parser.add_argument("--importtime", action="store_true", help="report the slowest imports")
+    parser.add_argument("--output", help="append the result as a JSON line to this file")
+    args = parser.parse_args(argv)
+
+    result = run(args)
+    json.dump(result, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
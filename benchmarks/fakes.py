@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""In-process stand-ins for Telegram and the download API, for benchmarks.
+
+``FakeClient`` implements the handful of Pyrogram client methods the bot
+handlers call, with configurable latency, FloodWait and error rates.
+``StubDownloadAPI`` is a local HTTP server answering like the external
+download API, so the real ``requests`` code path is exercised.
+"""
+import asyncio
+import json
+import random
+import threading
+import time
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+
+from pyrogram import StopPropagation
+from pyrogram.errors import FloodWait
+
+
+class FakeUser:
+    def __init__(self, user_id, first_name=None, last_name=None, username=None):
+        self.id = user_id
+        self.first_name = first_name or f"user{user_id}"
+        self.last_name = last_name
+        self.username = username or f"user{user_id}"
+
+    @property
+    def mention(self):
+        return f"[{self.first_name}](tg://user?id={self.id})"
+
+
+class FakeMessage:
+    def __init__(self, client, message_id, chat_id, from_user=None, text=None):
+        self._client = client
+        self.id = message_id
+        self.chat = SimpleNamespace(id=chat_id)
+        self.from_user = from_user
+        self.text = text
+
+    async def reply_text(self, text, quote=None, reply_markup=None, **kwargs):
+        return await self._client.send_message(self.chat.id, text, reply_markup=reply_markup)
+
+    async def edit_text(self, text, **kwargs):
+        await self._client._call("edit_message_text", self._client.latency)
+        return self
+
+    async def delete(self):
+        await self._client._call("delete_messages", self._client.latency)
+        return True
+
+    def stop_propagation(self):
+        raise StopPropagation
+
+    def continue_propagation(self):
+        pass
+
+
+class FakeClient:
+    """Pyrogram ``Client`` look-alike that only sleeps and counts calls."""
+
+    def __init__(self, latency=0.05, upload_latency=0.3, flood_wait_rate=0.0, error_rate=0.0,
+                 flood_wait_seconds=1, seed=None):
+        self.latency = latency
+        self.upload_latency = upload_latency
+        self.flood_wait_rate = flood_wait_rate
+        self.error_rate = error_rate
+        self.flood_wait_seconds = flood_wait_seconds
+        self.random = random.Random(seed)
+        self.me = SimpleNamespace(id=1, username="benchmark_bot")
+        self.calls = Counter()
+        self._message_ids = 0
+
+    async def _call(self, method, latency):
+        self.calls[method] += 1
+        # +/-50% jitter around the configured latency
+        await asyncio.sleep(latency * self.random.uniform(0.5, 1.5))
+        roll = self.random.random()
+        if roll < self.flood_wait_rate:
+            self.calls["flood_wait"] += 1
+            raise FloodWait(value=self.flood_wait_seconds)
+        if roll < self.flood_wait_rate + self.error_rate:
+            self.calls["error"] += 1
+            raise RuntimeError(f"fake {method} failure")
+
+    def _message(self, chat_id, text=None):
+        self._message_ids += 1
+        return FakeMessage(self, self._message_ids, chat_id, from_user=None, text=text)
+
+    async def get_me(self):
+        return self.me
+
+    async def get_chat_member(self, chat_id, user_id):
+        await self._call("get_chat_member", self.latency)
+        return SimpleNamespace(user=SimpleNamespace(id=user_id), chat=SimpleNamespace(id=chat_id))
+
+    async def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        await self._call("send_message", self.latency)
+        return self._message(chat_id, text)
+
+    async def _send_media(self, method, kind, chat_id, media, **kwargs):
+        # Resending a file_id skips the upload, like on Telegram
+        reused = media.startswith("fake-file-")
+        await self._call(method, self.latency if reused else self.upload_latency)
+        message = self._message(chat_id)
+        file_id = media if reused else f"fake-file-{message.id}"
+        setattr(message, kind, SimpleNamespace(file_id=file_id))
+        return message
+
+    async def send_video(self, chat_id, video, **kwargs):
+        return await self._send_media("send_video", "video", chat_id, video, **kwargs)
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        return await self._send_media("send_photo", "photo", chat_id, photo, **kwargs)
+
+    async def send_document(self, chat_id, document, **kwargs):
+        return await self._send_media("send_document", "document", chat_id, document, **kwargs)
+
+
+class StubDownloadAPI:
+    """Local HTTP server mimicking the external Instagram download API."""
+
+    def __init__(self, latency=0.5, error_rate=0.0, host="127.0.0.1", port=0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_address[1]}/media/instagram/download"
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with stub._lock:
+                    stub.requests += 1
+                    delay = stub.latency * stub.random.uniform(0.5, 1.5)
+                    failed = stub.random.random() < stub.error_rate
+                time.sleep(delay)
+                if failed:
+                    self.send_error(502)
+                    return
+                query = parse_qs(urlparse(self.path).query)
+                post_url = query.get("url", [""])[0]
+                shortcode = post_url.rstrip("/").rsplit("/", 1)[-1] or "unknown"
+                media_type = "image" if zlib.crc32(shortcode.encode()) % 3 == 0 else "video"
+                extension = "jpg" if media_type == "image" else "mp4"
+                body = json.dumps([{"url": f"https://cdn.example.invalid/{shortcode}.{extension}", "type": media_type}])
+                body = body.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""HTTP load benchmark for the Flask public and admin endpoints.
+
+Seeds a database with synthetic users and downloads, serves ``create_app()``
+from a threaded WSGI server and hammers each endpoint with concurrent
+clients. Reports latency percentiles, throughput and the number of SQL
+statements issued per request for every endpoint.
+
+    python -m benchmarks.http_endpoints --users 10000 --downloads 50000
+    python -m benchmarks.http_endpoints --database-url postgresql://.../scratch --wipe-database --users 1000000
+
+The schema is built with the Alembic migrations, as in production. A
+database given with ``--database-url`` is emptied first, so that takes
+``--wipe-database`` (or ``--reuse`` to keep its data).
+
+Pass ``--baseline`` with an earlier ``--output`` file to use it as a
+regression guard: the run fails when an endpoint's p95 latency or SQL
+statement count grows past the allowed margin.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+from flask import has_request_context, request
+from sqlalchemy import MetaData, event
+from werkzeug.serving import make_server
+
+from benchmarks.report import percentile
+from config import Config
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "migrations")
+
+ENDPOINTS = {
+    "api_stats": "/api/stats",
+    "admin_users": "/admin/users",
+    "admin_users_deep_page": "/admin/users?page=50",
+    "admin_settings": "/admin/settings",
+}
+
+ADMIN_USERNAME = "benchmark_admin"
+ADMIN_PASSWORD = "benchmark-password"
+
+
+def seed_database(db, users, downloads, batch_size=50000, seed=1):
+    """Bulk-inserts synthetic rows with bulk_load (COPY on PostgreSQL)."""
+    from app.models import Admin
+    from bulk_load import bulk_insert, existing_user_ids, generate_downloads, generate_users
+
+    bulk_insert(db.engine, "users", generate_users(users, 10 ** 9, seed), batch_size)
+    if downloads:
+        bulk_insert(db.engine, "downloads", generate_downloads(downloads, existing_user_ids(db.engine), seed), batch_size)
+
+    admin = Admin(username=ADMIN_USERNAME)
+    admin.set_password(ADMIN_PASSWORD)
+    db.session.add(admin)
+    db.session.commit()
+
+
+class StatementCounter:
+    """Counts SQL statements and their time per Flask endpoint."""
+
+    def __init__(self, engine):
+        self.lock = threading.Lock()
+        self.statements = {}
+        self.seconds = {}
+        event.listen(engine, "before_cursor_execute", self._before)
+        event.listen(engine, "after_cursor_execute", self._after)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_started"].pop()
+        endpoint = request.endpoint if has_request_context() else None
+        with self.lock:
+            self.statements[endpoint] = self.statements.get(endpoint, 0) + 1
+            self.seconds[endpoint] = self.seconds.get(endpoint, 0.0) + elapsed
+
+    def reset(self):
+        with self.lock:
+            self.statements.clear()
+            self.seconds.clear()
+
+
+def hammer(base_url, path, requests_total, concurrency, cookies):
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    local = threading.local()
+
+    def one(_):
+        nonlocal errors
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+            session.cookies.update(cookies)
+        started = time.perf_counter()
+        response = session.get(base_url + path, allow_redirects=False)
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            if response.status_code != 200:
+                errors += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(requests_total)))
+    return latencies, errors, time.perf_counter() - started
+
+
+def run(args):
+    from app import create_app, db
+
+    tmpdir = None
+    database_url = args.database_url
+    if not database_url:
+        tmpdir = tempfile.mkdtemp(prefix="http_bench_")
+        database_url = "sqlite:///" + os.path.join(tmpdir, "bench.db")
+
+    class BenchmarkConfig(Config):
+        SQLALCHEMY_DATABASE_URI = database_url
+        TRACE_FILE = os.devnull
+
+    app = create_app(BenchmarkConfig)
+    with app.app_context():
+        if not args.reuse:
+            from flask_migrate import upgrade
+
+            if not tmpdir:
+                # Every table, including the ones only the bot creates and alembic_version
+                metadata = MetaData()
+                metadata.reflect(bind=db.engine)
+                metadata.drop_all(bind=db.engine)
+            upgrade(directory=MIGRATIONS_DIR)
+            seed_started = time.perf_counter()
+            seed_database(db, args.users, args.downloads)
+            print(f"Seeded {args.users} users and {args.downloads} downloads "
+                  f"in {time.perf_counter() - seed_started:.1f}s", file=sys.stderr)
+        counter = StatementCounter(db.engine)
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    try:
+        login = requests.post(base_url + "/auth/login", data={"username": ADMIN_USERNAME, "password": ADMIN_PASSWORD},
+                              allow_redirects=False)
+        cookies = login.cookies.get_dict()
+
+        results = {}
+        for name, path in ENDPOINTS.items():
+            hammer(base_url, path, min(10, args.requests), 1, cookies) # Warm up
+            counter.reset()
+            latencies, errors, elapsed = hammer(base_url, path, args.requests, args.concurrency, cookies)
+            endpoint_statements = sum(v for k, v in counter.statements.items() if k)
+            endpoint_sql_seconds = sum(v for k, v in counter.seconds.items() if k)
+            results[name] = {
+                "path": path,
+                "requests": args.requests,
+                "errors": errors,
+                "throughput_per_s": round(args.requests / elapsed, 2),
+                "latency_ms": {
+                    "p50": round(percentile(latencies, 50) * 1000, 2),
+                    "p95": round(percentile(latencies, 95) * 1000, 2),
+                    "p99": round(percentile(latencies, 99) * 1000, 2),
+                },
+                "sql_statements_per_request": round(endpoint_statements / args.requests, 2),
+                "sql_ms_per_request": round(endpoint_sql_seconds / args.requests * 1000, 3),
+            }
+    finally:
+        server.shutdown()
+        if tmpdir:
+            with app.app_context():
+                db.engine.dispose()
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return {
+        "benchmark": "http_endpoints",
+        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "database": database_url.split(":", 1)[0],
+        "users": args.users,
+        "downloads": args.downloads,
+        "concurrency": args.concurrency,
+        "endpoints": results,
+    }
+
+
+def compare(result, baseline, max_regression):
+    """Returns a list of regressions of ``result`` against ``baseline``."""
+    problems = []
+    for name, current in result["endpoints"].items():
+        previous = baseline.get("endpoints", {}).get(name)
+        if not previous:
+            continue
+        allowed = previous["latency_ms"]["p95"] * (1 + max_regression)
+        if current["latency_ms"]["p95"] > allowed:
+            problems.append(f"{name}: p95 {current['latency_ms']['p95']}ms > {allowed:.2f}ms allowed")
+        if current["sql_statements_per_request"] > previous["sql_statements_per_request"]:
+            problems.append(f"{name}: {current['sql_statements_per_request']} SQL statements per request, "
+                            f"was {previous['sql_statements_per_request']}")
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test the Flask endpoints.")
+    parser.add_argument("--database-url", help="defaults to a temporary SQLite file")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--downloads", type=int, default=5000)
+    parser.add_argument("--reuse", action="store_true", help="keep the existing data instead of reseeding")
+    parser.add_argument("--requests", type=int, default=200, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--output", help="write the result as JSON to this file")
+    parser.add_argument("--baseline", help="earlier --output file to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.25, help="allowed p95 growth (0.25 = 25%%)")
+    parser.add_argument("--wipe-database", action="store_true",
+                        help="allow dropping every table of --database-url before seeding")
+    args = parser.parse_args(argv)
+    if args.database_url and not args.reuse and not args.wipe_database:
+        parser.error("--database-url would be wiped and reseeded; pass --wipe-database to confirm, or --reuse")
+
+    result = run(args)
+    json.dump(result, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            problems = compare(result, json.load(f), args.max_regression)
+        for problem in problems:
+            print(f"REGRESSION {problem}", file=sys.stderr)
+        if problems:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""Load test for the durable update queue.
+
+Fills a queue with synthetic updates and drains it with 1, 2, 4, ... worker
+processes, each simulating a handler that spends ``--latency`` seconds on
+network work. Throughput should grow roughly with the number of workers.
+
+    python -m benchmarks.queue_throughput --jobs 400 --workers 1 2 4 8
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+
+from services.update_queue import UpdateQueue
+
+
+def _worker(url, worker_id, latency):
+    queue = UpdateQueue.from_url(url)
+    idle_since = None
+    while True:
+        jobs = queue.claim(worker_id)
+        if not jobs:
+            # The queue is pre-filled, so a short idle period means we're done
+            idle_since = idle_since or time.monotonic()
+            if time.monotonic() - idle_since > 1.0:
+                break
+            time.sleep(0.01)
+            continue
+        idle_since = None
+        for job in jobs:
+            time.sleep(latency)
+            queue.ack(job)
+    queue.engine.dispose()
+
+
+def run(jobs, workers, latency):
+    fd, path = tempfile.mkstemp(suffix=".db", prefix="queue_bench_")
+    os.close(fd)
+    url = f"sqlite:///{path}"
+    try:
+        queue = UpdateQueue.from_url(url)
+        for i in range(jobs):
+            queue.enqueue(f"1:{i}", {"chat_id": 1, "message_id": i, "text": "https://instagram.com/p/x/"})
+        queue.engine.dispose()
+
+        started = time.monotonic()
+        processes = [
+            multiprocessing.Process(target=_worker, args=(url, f"bench-{n}", latency))
+            for n in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        # Workers wait ~1s on an empty queue before exiting; don't count it
+        elapsed = time.monotonic() - started - 1.0
+
+        queue = UpdateQueue.from_url(url)
+        remaining = queue.depth()
+        queue.engine.dispose()
+        return {
+            "workers": workers,
+            "jobs": jobs,
+            "seconds": round(elapsed, 3),
+            "jobs_per_second": round(jobs / elapsed, 1) if elapsed > 0 else None,
+            "unfinished": remaining,
+        }
+    finally:
+        os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=400)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--latency", type=float, default=0.02, help="simulated handler time per job (s)")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    results = []
+    for workers in args.workers:
+        result = run(args.jobs, workers, args.latency)
+        results.append(result)
+        print(f"{workers:>3} workers: {result['jobs_per_second']:>8} jobs/s "
+              f"({result['seconds']}s, {result['unfinished']} unfinished)")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
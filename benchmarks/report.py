@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+"""Helpers shared by the benchmark scripts."""
+import math
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of ``values`` (None when empty)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
@@ -2,22 +2,38 @@
 import os
 import re
 import logging
+import time
 import asyncio
-import requests
+import functools
 from datetime import datetime, timedelta
 from urllib.parse import urlparse
 
-from flask import Flask, request, jsonify
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean
+from sqlalchemy import create_engine, inspect, func, Column, Index, BigInteger, Integer, String, DateTime, Boolean
 from sqlalchemy.orm import sessionmaker, declarative_base
 from sqlalchemy.exc import SQLAlchemyError
 
 from pyrogram import Client, filters, enums
-from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message, CallbackQuery
-from pyrogram.errors import UserNotParticipant, FloodWait
+from pyrogram.handlers import MessageHandler, CallbackQueryHandler, InlineQueryHandler
+from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message, CallbackQuery, Chat, InlineQuery
+from pyrogram.types import (
+    InlineQueryResultArticle, InlineQueryResultCachedDocument, InlineQueryResultCachedPhoto,
+    InlineQueryResultCachedVideo, InputTextMessageContent,
+)
+from pyrogram.types import User as TelegramUser
+from pyrogram.errors import UserNotParticipant, FloodWait, ExternalUrlInvalid, MediaEmpty, WebpageCurlFailed, WebpageMediaEmpty
+
+from services import activity, logs, metrics, segments, tracing
+from services.ban_list import BanList
+from services.media_cache import MediaCache, file_id_of
+from services.lifecycle import JobJournal, Lifecycle
+from services.media_store import MediaStore
+from services.progress import ProgressDebouncer
+from services.rate_limit import RateLimiter, DatabaseRateLimiter, rate_limits
+from services.update_queue import UpdateQueue, update_queue
+from services.warming import CacheWarmer, TrendingTracker
 
 # --- Configuration ---
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# Logging is set up by main() (or run_telegram_bot.py), not on import
 logger = logging.getLogger(__name__)
 
 # Load environment variables
@@ -28,20 +44,89 @@ TELEGRAM_CHANNEL_ID = int(os.environ.get("TELEGRAM_CHANNEL_ID", 0))
 REQUIRED_CHANNEL_USERNAME = os.environ.get("REQUIRED_CHANNEL_USERNAME")
 DATABASE_URL = os.environ.get("DATABASE_URL")
 ADMIN_USER_IDS = [int(admin_id.strip()) for admin_id in os.environ.get("ADMIN_USER_IDS", "").split(',') if admin_id.strip().isdigit()]
+# "single" handles updates in this process, "ingest" only queues them and
+# "worker" only consumes the queue (run as many worker processes as needed).
+BOT_MODE = os.environ.get("BOT_MODE", "single").lower()
+UPDATE_QUEUE_URL = os.environ.get("UPDATE_QUEUE_URL") # Defaults to DATABASE_URL
+WORKER_CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", 4))
+QUEUE_POLL_INTERVAL = float(os.environ.get("QUEUE_POLL_INTERVAL", 0.5))
+# Finished jobs are kept QUEUE_RETENTION seconds (they also stop duplicate
+# updates) and deleted every QUEUE_PURGE_INTERVAL seconds (0 disables)
+QUEUE_RETENTION = float(os.environ.get("QUEUE_RETENTION", 24 * 3600))
+QUEUE_PURGE_INTERVAL = float(os.environ.get("QUEUE_PURGE_INTERVAL", 3600))
+# Per-user quota for link messages: a burst of RATE_LIMIT_BURST, refilled at
+# RATE_LIMIT_PER_MINUTE. Exceeding it starts a cooldown that doubles each time;
+# RATE_LIMIT_BAN_AFTER such strikes bans the user (0 disables auto-bans).
+RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND", "memory").lower() # memory | database
+RATE_LIMIT_BURST = int(os.environ.get("RATE_LIMIT_BURST", 5))
+RATE_LIMIT_PER_MINUTE = float(os.environ.get("RATE_LIMIT_PER_MINUTE", 5))
+RATE_LIMIT_COOLDOWN = int(os.environ.get("RATE_LIMIT_COOLDOWN", 60))
+RATE_LIMIT_MAX_COOLDOWN = int(os.environ.get("RATE_LIMIT_MAX_COOLDOWN", 3600))
+RATE_LIMIT_BAN_AFTER = int(os.environ.get("RATE_LIMIT_BAN_AFTER", 5))
+BAN_LIST_REFRESH_INTERVAL = float(os.environ.get("BAN_LIST_REFRESH_INTERVAL", 2))
+RATE_LIMIT_PRUNE_INTERVAL = float(os.environ.get("RATE_LIMIT_PRUNE_INTERVAL", 3600)) # Forgets idle users, 0 disables
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0)) # 0 disables the metrics exporter
+# Fraction of link messages traced stage by stage (0 disables tracing).
+# Traces are appended to TRACE_FILE, which the admin panel reads.
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 0))
+DOWNLOAD_API_URL = os.environ.get("DOWNLOAD_API_URL", "https://api.rival.rocks/media/instagram/download")
+# Seconds between rebuilds of the per-user activity summaries from download_logs (0 disables)
+ACTIVITY_RECONCILE_INTERVAL = float(os.environ.get("ACTIVITY_RECONCILE_INTERVAL", 24 * 3600))
+# Inline mode (enable it with BotFather's /setinline). Cached posts are answered
+# at once; others get a placeholder while the cache warmer fetches them, which
+# needs CACHE_CHAT_ID.
+INLINE_MAX_RESULTS = int(os.environ.get("INLINE_MAX_RESULTS", 5))
+INLINE_CACHE_TIME = int(os.environ.get("INLINE_CACHE_TIME", 300)) # Seconds Telegram may reuse a complete answer
+MAX_LINKS_PER_MESSAGE = int(os.environ.get("MAX_LINKS_PER_MESSAGE", 10))
+LINK_CONCURRENCY = int(os.environ.get("LINK_CONCURRENCY", 4)) # Links of one message resolved at once
+RESOLVE_THREADS = int(os.environ.get("RESOLVE_THREADS", 32)) # Concurrent download API requests, all users
+SEGMENT_REFRESH_INTERVAL = float(os.environ.get("SEGMENT_REFRESH_INTERVAL", 15 * 60)) # Broadcast audiences, 0 disables
+# file_ids of posts already sent, so repeat requests skip the resolve and the upload
+MEDIA_CACHE_SIZE = int(os.environ.get("MEDIA_CACHE_SIZE", 10000))
+MEDIA_CACHE_TTL = float(os.environ.get("MEDIA_CACHE_TTL", 7 * 24 * 3600))
+# Trending posts are pre-uploaded to this private chat (the bot must be able to
+# post there); 0 disables warming. WARM_THRESHOLDS is "window seconds:requests,..."
+CACHE_CHAT_ID = int(os.environ.get("CACHE_CHAT_ID", 0))
+WARM_THRESHOLDS = {
+    int(window): int(count)
+    for window, count in (item.split(":") for item in os.environ.get("WARM_THRESHOLDS", "60:3,900:10").split(","))
+}
+WARM_MAX_PER_HOUR = int(os.environ.get("WARM_MAX_PER_HOUR", 30))
+WARM_MAX_LIVE_RATE = float(os.environ.get("WARM_MAX_LIVE_RATE", 2)) # Link messages/s above which warming pauses
+WARM_HISTORY_HOURS = float(os.environ.get("WARM_HISTORY_HOURS", 24)) # Startup warming looks this far back
+WARM_STARTUP_LIMIT = int(os.environ.get("WARM_STARTUP_LIMIT", 20))
+# Media the bot had to download itself is kept here for later re-uploads ("" disables)
+MEDIA_STORE_DIR = os.environ.get("MEDIA_STORE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "media_store"))
+MEDIA_STORE_MAX_BYTES = int(os.environ.get("MEDIA_STORE_MAX_BYTES", 2 * 1024 ** 3))
+MEDIA_STORE_EVICT_INTERVAL = float(os.environ.get("MEDIA_STORE_EVICT_INTERVAL", 300))
+# Status messages show download/upload progress, edited at most once every
+# PROGRESS_EDIT_INTERVAL seconds per chat and only after PROGRESS_MIN_STEP points
+PROGRESS_EDIT_INTERVAL = float(os.environ.get("PROGRESS_EDIT_INTERVAL", 3))
+PROGRESS_MIN_STEP = int(os.environ.get("PROGRESS_MIN_STEP", 10))
+# On SIGTERM running jobs get SHUTDOWN_TIMEOUT seconds to finish; unfinished
+# ones are journaled in JOB_JOURNAL_DIR ("" disables) for the next process
+SHUTDOWN_TIMEOUT = float(os.environ.get("SHUTDOWN_TIMEOUT", 25))
+JOB_JOURNAL_DIR = os.environ.get("JOB_JOURNAL_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "journal"))
+JOB_RESUME_MAX_AGE = float(os.environ.get("JOB_RESUME_MAX_AGE", 3600)) # Older unfinished jobs are dropped
+JOB_ADOPT_INTERVAL = float(os.environ.get("JOB_ADOPT_INTERVAL", 30)) # Checks for journals of stopped processes
+TRACE_FILE = os.environ.get("TRACE_FILE") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "traces.jsonl")
 
 # --- Database Setup ---
 Base = declarative_base()
 
 class User(Base):
+    # The table the web app's migrations create (app/models.py); only the
+    # columns the bot reads or writes. Download counts live in user_activity.
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, unique=True, nullable=False)
+    telegram_user_id = Column(BigInteger, unique=True, nullable=False, index=True)
     first_name = Column(String)
     last_name = Column(String)
     username = Column(String)
     joined_at = Column(DateTime, default=datetime.utcnow)
-    download_count = Column(Integer, default=0)
-    last_download_at = Column(DateTime)
+    is_subscribed = Column(Boolean, default=False, nullable=False)
+    is_banned = Column(Boolean, default=False, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
 class DownloadLog(Base):
     __tablename__ = 'download_logs'
@@ -52,9 +137,16 @@ class DownloadLog(Base):
     success = Column(Boolean, default=True)
     error_message = Column(String)
 
+    __table_args__ = (
+        # Per-user history and the activity reconcile job (GROUP BY user_id)
+        Index('ix_download_logs_user_id_download_time', 'user_id', 'download_time'),
+    )
+
 engine = None
 SessionLocal = None
 
+# Nothing below connects to the database at import time; create_engine is
+# lazy and the tables are checked once by init_database() at startup.
 if DATABASE_URL:
     try:
         # Adjust DATABASE_URL for SQLAlchemy if it starts with postgres://
@@ -62,15 +154,116 @@ if DATABASE_URL:
             DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
         engine = create_engine(DATABASE_URL)
         SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-        Base.metadata.create_all(bind=engine)
-        logger.info("Database connected and tables created/verified.")
     except Exception as e:
-        logger.error(f"Database connection failed: {e}")
+        logger.error("Database setup failed: %s", e)
         engine = None
         SessionLocal = None
 else:
     logger.warning("DATABASE_URL not set. Database features will be disabled.")
 
+# --- Update Queue Setup ---
+job_queue = None
+
+if BOT_MODE in ("ingest", "worker"):
+    queue_url = UPDATE_QUEUE_URL or DATABASE_URL
+    if queue_url:
+        try:
+            job_queue = UpdateQueue.from_url(queue_url, create_tables=False)
+            metrics.QUEUE_DEPTH.set_function(job_queue.depth, queue="updates")
+            logger.info("Update queue ready. Running in %s mode.", BOT_MODE)
+        except Exception as e:
+            logger.error("Update queue setup failed: %s", e)
+    if not job_queue:
+        logger.warning("Update queue unavailable. Falling back to single-process mode.")
+        BOT_MODE = "single"
+
+tracer = tracing.Tracer(sample_rate=TRACE_SAMPLE_RATE, export_path=TRACE_FILE)
+
+# --- Ban List Setup ---
+# Banned user ids are kept in memory so messages from them are dropped
+# without touching the database. Loaded in main() and refreshed in the background.
+ban_list = BanList(engine, User.telegram_user_id, User.is_banned, User.updated_at) if engine else None
+
+# --- Rate Limiter Setup ---
+rate_limiter_options = dict(
+    capacity=RATE_LIMIT_BURST,
+    refill_per_second=RATE_LIMIT_PER_MINUTE / 60,
+    base_cooldown=RATE_LIMIT_COOLDOWN,
+    max_cooldown=RATE_LIMIT_MAX_COOLDOWN,
+    ban_after=RATE_LIMIT_BAN_AFTER,
+)
+rate_limiter = None
+
+if RATE_LIMIT_BACKEND == "database" and engine:
+    try:
+        rate_limiter = DatabaseRateLimiter(engine, create_tables=False, **rate_limiter_options)
+    except Exception as e:
+        logger.error("Shared rate limiter setup failed: %s", e)
+if not rate_limiter:
+    rate_limiter = RateLimiter(**rate_limiter_options)
+
+# --- Media Cache Setup ---
+media_cache = MediaCache(max_entries=MEDIA_CACHE_SIZE, ttl=MEDIA_CACHE_TTL)
+trending = TrendingTracker(WARM_THRESHOLDS)
+cache_warmer = None # Created in main() once the client exists, if CACHE_CHAT_ID is set
+media_store = None # Opened (and recovered) by init_media_store() at startup
+lifecycle = Lifecycle() # Gets its journal from init_job_journal() at startup
+progress_debouncer = ProgressDebouncer(min_interval=PROGRESS_EDIT_INTERVAL, min_step=PROGRESS_MIN_STEP)
+
+_database_ready = False
+
+def _create_missing_tables(target_engine, tables):
+    # One round trip to list the tables instead of a has_table query per table
+    existing = set(inspect(target_engine).get_table_names())
+    missing = [table for table in tables if table.name not in existing]
+    for table in missing:
+        table.create(bind=target_engine)
+    if missing:
+        logger.info("Created tables: %s", ', '.join(table.name for table in missing))
+
+def init_database():
+    """Creates the bot's tables if they are missing. Runs once, at startup."""
+    global _database_ready
+    if _database_ready:
+        return
+    if engine is not None:
+        try:
+            tables = list(Base.metadata.sorted_tables) + [activity.user_activity]
+            tables += list(segments.metadata.sorted_tables)
+            if isinstance(rate_limiter, DatabaseRateLimiter):
+                tables.append(rate_limits)
+            _create_missing_tables(engine, tables)
+            logger.info("Database connected and tables verified.")
+        except Exception as e:
+            logger.error("Database initialization failed: %s", e)
+    if job_queue is not None:
+        try:
+            _create_missing_tables(job_queue.engine, [update_queue])
+        except Exception as e:
+            logger.error("Update queue initialization failed: %s", e)
+    _database_ready = True
+
+def init_media_store():
+    """Opens the local media store and repairs it after an unclean shutdown."""
+    global media_store
+    if media_store is not None or not MEDIA_STORE_DIR:
+        return
+    try:
+        store = MediaStore(MEDIA_STORE_DIR, max_bytes=MEDIA_STORE_MAX_BYTES)
+        store.recover()
+        media_store = store
+    except Exception as e:
+        logger.error("Media store unavailable, media will not be kept locally: %s", e)
+
+def init_job_journal():
+    """Opens this process's job journal. Not used by queue workers."""
+    if not JOB_JOURNAL_DIR or BOT_MODE == "worker":
+        return
+    try:
+        lifecycle.journal = JobJournal(JOB_JOURNAL_DIR, max_age=JOB_RESUME_MAX_AGE)
+    except Exception as e:
+        logger.error("Job journal unavailable, unfinished jobs will not survive a restart: %s", e)
+
 # --- Helper Functions ---
 def get_db():
     if not SessionLocal:
@@ -81,72 +274,76 @@ def get_db():
     finally:
         db.close()
 
+@metrics.DB_QUERY_SECONDS.time(helper="add_or_update_user")
 def add_or_update_user(db_session, user_data):
     if not db_session:
         return
     try:
-        user = db_session.query(User).filter(User.user_id == user_data.id).first()
+        user = db_session.query(User).filter(User.telegram_user_id == user_data.id).first()
         if not user:
             user = User(
-                user_id=user_data.id,
+                telegram_user_id=user_data.id,
                 first_name=user_data.first_name,
                 last_name=user_data.last_name,
                 username=user_data.username
             )
             db_session.add(user)
-            logger.info(f"New user added: {user_data.id}")
+            logger.info("New user added: %s", user_data.id)
         else:
             # Optionally update user info if it changed
             user.first_name = user_data.first_name
             user.last_name = user_data.last_name
             user.username = user_data.username
-            logger.debug(f"User info updated: {user_data.id}")
+            logger.debug("User info updated: %s", user_data.id)
         db_session.commit()
     except SQLAlchemyError as e:
         db_session.rollback()
-        logger.error(f"Error adding/updating user {user_data.id}: {e}")
+        logger.error("Error adding/updating user %s: %s", user_data.id, e)
     except Exception as e:
-        logger.error(f"Unexpected error with user {user_data.id}: {e}")
+        logger.error("Unexpected error with user %s: %s", user_data.id, e)
 
-def log_download(db_session, user_id, url, success=True, error_message=None):
+@metrics.DB_QUERY_SECONDS.time(helper="log_download")
+def log_download(db_session, user_id, url, success=True, error_message=None, media_type=None):
     if not db_session:
         return
     try:
+        now = datetime.utcnow()
         log_entry = DownloadLog(
             user_id=user_id,
             url=url,
+            download_time=now,
             success=success,
             error_message=error_message
         )
         db_session.add(log_entry)
 
-        # Update user download count
-        user = db_session.query(User).filter(User.user_id == user_id).first()
-        if user:
-            user.download_count += 1
-            user.last_download_at = datetime.utcnow()
+        # Per-user counters live in user_activity (one upsert, same transaction).
+        # Updating the users row instead would bump users.updated_at and make
+        # every downloader look like a ban list change.
+        activity.record_download(db_session, user_id, success, media_type, at=now)
 
-        db_session.commit()
-        logger.info(f"Download logged for user {user_id}. Success: {success}")
+        with tracing.span("db_commit"):
+            db_session.commit()
+        logger.info("Download logged for user %s. Success: %s", user_id, success)
     except SQLAlchemyError as e:
         db_session.rollback()
-        logger.error(f"Error logging download for user {user_id}: {e}")
+        logger.error("Error logging download for user %s: %s", user_id, e)
     except Exception as e:
-        logger.error(f"Unexpected error logging download for user {user_id}: {e}")
+        logger.error("Unexpected error logging download for user %s: %s", user_id, e)
 
 def get_user_stats(db_session, user_id):
     if not db_session:
         return None, None
     try:
-        user = db_session.query(User).filter(User.user_id == user_id).first()
-        if user:
-            return user.download_count, user.last_download_at
+        summary = activity.get_summary(db_session, user_id)
+        if summary:
+            return summary.download_count, summary.last_download_at
         return 0, None
     except SQLAlchemyError as e:
-        logger.error(f"Error getting stats for user {user_id}: {e}")
+        logger.error("Error getting stats for user %s: %s", user_id, e)
         return None, None
     except Exception as e:
-        logger.error(f"Unexpected error getting stats for user {user_id}: {e}")
+        logger.error("Unexpected error getting stats for user %s: %s", user_id, e)
         return None, None
 
 def get_total_users(db_session):
@@ -155,96 +352,304 @@ def get_total_users(db_session):
     try:
         return db_session.query(User).count()
     except SQLAlchemyError as e:
-        logger.error(f"Error getting total users: {e}")
+        logger.error("Error getting total users: %s", e)
         return 0
     except Exception as e:
-        logger.error(f"Unexpected error getting total users: {e}")
+        logger.error("Unexpected error getting total users: %s", e)
         return 0
 
 def get_total_downloads(db_session):
     if not db_session:
         return 0
     try:
-        # Efficiently sum download counts from User table
-        total = db_session.query(func.sum(User.download_count)).scalar()
-        return total or 0
+        # Sum of the per-user successful download counters
+        return activity.total_downloads(db_session)
         # Alternative: Count DownloadLog entries
         # return db_session.query(DownloadLog).filter(DownloadLog.success == True).count()
     except SQLAlchemyError as e:
-        logger.error(f"Error getting total downloads: {e}")
+        logger.error("Error getting total downloads: %s", e)
         return 0
     except Exception as e:
-        logger.error(f"Unexpected error getting total downloads: {e}")
+        logger.error("Unexpected error getting total downloads: %s", e)
         return 0
 
+def ban_user(db_session, user_id):
+    if ban_list is not None:
+        ban_list.add(user_id)
+    if not db_session:
+        return
+    try:
+        updated = db_session.query(User).filter(User.telegram_user_id == user_id).update({User.is_banned: True})
+        db_session.commit()
+        if updated:
+            logger.warning("User %s banned automatically for repeated flooding.", user_id)
+    except SQLAlchemyError as e:
+        db_session.rollback()
+        logger.error("Error banning user %s: %s", user_id, e)
+
+async def check_rate_limit(user_id, cost=1, strike=True):
+    if rate_limiter.shared:
+        return await asyncio.to_thread(rate_limiter.check, user_id, cost, strike)
+    return rate_limiter.check(user_id, cost, strike)
+
 async def is_user_subscribed(client: Client, user_id: int) -> bool:
     if not REQUIRED_CHANNEL_USERNAME or not TELEGRAM_CHANNEL_ID:
         logger.warning("Subscription check skipped: Channel username or ID not configured.")
         return True # Skip check if not configured
     try:
         await client.get_chat_member(chat_id=TELEGRAM_CHANNEL_ID, user_id=user_id)
-        logger.debug(f"User {user_id} is subscribed.")
+        logger.debug("User %s is subscribed.", user_id)
         return True
     except UserNotParticipant:
-        logger.info(f"User {user_id} is not subscribed.")
+        logger.info("User %s is not subscribed.", user_id)
         return False
     except FloodWait as e:
-        logger.warning(f"Flood wait of {e.value} seconds when checking subscription for {user_id}.")
+        metrics.FLOOD_WAITS_TOTAL.inc(method="get_chat_member")
+        logger.warning("Flood wait of %s seconds when checking subscription for %s.", e.value, user_id)
         await asyncio.sleep(e.value + 1)
         return await is_user_subscribed(client, user_id) # Retry after waiting
     except Exception as e:
-        logger.error(f"Error checking subscription for user {user_id}: {e}")
+        logger.error("Error checking subscription for user %s: %s", user_id, e)
         return False # Assume not subscribed on error
 
 # --- Instagram Download Logic ---
 
-# Improved regex to handle various Instagram URL formats
-INSTAGRAM_REGEX = r"https?://(?:www\.) ?instagram\.com/(?:p|reel|tv)/([A-Za-z0-9_\-]+)/?"
+# Post, reel and IGTV links, with or without "www."; group 1 is the shortcode
+INSTAGRAM_URL_RE = re.compile(r"https?://(?:www\.)?instagram\.com/(?:p|reels?|tv)/([A-Za-z0-9_\-]+)/?")
+
+def extract_links(text):
+    """(shortcode, url) for each distinct Instagram post in ``text``, in order."""
+    links = {}
+    for match in INSTAGRAM_URL_RE.finditer(text or ""):
+        links.setdefault(match.group(1), match.group(0))
+    return list(links.items())
+
+_http_session = None
+_resolve_executor = None
+
+def http_session():
+    """Shared requests session, so resolves reuse connections to the API."""
+    global _http_session
+    if _http_session is None:
+        import requests # Imported on first use to keep bot startup fast
+        from requests.adapters import HTTPAdapter
+        _http_session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=RESOLVE_THREADS)
+        _http_session.mount("http://", adapter)
+        _http_session.mount("https://", adapter)
+    return _http_session
+
+def resolve_executor():
+    # Own pool for the blocking API calls: the default executor has only
+    # cpu_count + 4 threads and is shared with every asyncio.to_thread call
+    global _resolve_executor
+    if _resolve_executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _resolve_executor = ThreadPoolExecutor(max_workers=RESOLVE_THREADS, thread_name_prefix="resolve")
+    return _resolve_executor
 
 async def download_instagram_media(url: str):
     """Downloads media from an Instagram URL using an external API."""
-    api_url = f"https://api.rival.rocks/media/instagram/download?url={url}"
+    import requests
     headers = {
         "accept": "application/json",
         # Add any necessary API keys or headers here if required by api.rival.rocks
         # "Authorization": "Bearer YOUR_API_KEY"
     }
     try:
-        response = requests.get(api_url, headers=headers, timeout=60)  # Increased timeout
+        # requests blocks, so run it in a thread: other links and users keep moving
+        request = functools.partial(http_session().get, DOWNLOAD_API_URL, params={"url": url}, headers=headers, timeout=60)
+        response = await asyncio.get_running_loop().run_in_executor(resolve_executor(), request)
         response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
         data = response.json()
 
         if data and isinstance(data, list) and data[0].get('url'):
             media_url = data[0]['url']
             media_type = data[0].get('type', 'unknown') # video or image
-            logger.info(f"Successfully retrieved media URL: {media_url} (Type: {media_type})")
+            logger.info("Successfully retrieved media URL: %s (Type: %s)", media_url, media_type)
             return media_url, media_type
         else:
-            logger.warning(f"API response format unexpected or missing URL for {url}. Data: {data}")
+            logger.warning("API response format unexpected or missing URL for %s. Data: %s", url, data)
             return None, None
 
     except requests.exceptions.RequestException as e:
-        logger.error(f"Error fetching from download API for {url}: {e}")
+        logger.error("Error fetching from download API for %s: %s", url, e)
         return None, None
     except Exception as e:
-        logger.error(f"Unexpected error during Instagram download for {url}: {e}")
+        logger.error("Unexpected error during Instagram download for %s: %s", url, e)
         return None, None
 
-# --- Pyrogram Bot Setup ---
-if not TELEGRAM_BOT_TOKEN:
-    logger.critical("TELEGRAM_BOT_TOKEN not found in environment variables. Exiting.")
-    exit()
+async def send_media(client: Client, chat_id: int, media_url: str, media_type: str, progress=None):
+    """Sends a media URL, a cached Telegram file_id or a file object. Returns
+    the sent message. ``progress`` is only called for file uploads."""
+    caption = f"تم التحميل بواسطة @{client.me.username}"
+    with metrics.UPLOAD_SECONDS.time(media_type=media_type or "unknown"), tracing.span("upload"):
+        if media_type == 'video':
+            return await client.send_video(chat_id, media_url, caption=caption, progress=progress)
+        elif media_type == 'image':
+            return await client.send_photo(chat_id, media_url, caption=caption, progress=progress)
+        else: # Handle cases where type might be unknown or different
+            # Try sending as document as a fallback
+            return await client.send_document(chat_id, media_url, caption=caption, progress=progress)
 
-# Use API ID and Hash if available, otherwise rely on Bot Token only
-if TELEGRAM_API_ID and TELEGRAM_API_HASH:
-    app = Client("instagram_downloader_bot", api_id=int(TELEGRAM_API_ID), api_hash=TELEGRAM_API_HASH, bot_token=TELEGRAM_BOT_TOKEN)
-else:
-    logger.warning("API_ID or API_HASH not found. Running in bot token mode.")
-    app = Client("instagram_downloader_bot", bot_token=TELEGRAM_BOT_TOKEN, no_updates=False)
+# Telegram could not fetch the media URL itself
+URL_REJECTED_ERRORS = (WebpageCurlFailed, WebpageMediaEmpty, ExternalUrlInvalid, MediaEmpty)
+
+PROGRESS_DOWNLOAD_TEXT = "📥 جاري تنزيل الملف...\n{bar} {percent}%\n{current} / {total}"
+PROGRESS_UPLOAD_TEXT = "📤 جاري رفع الملف إلى تيليجرام...\n{bar} {percent}%\n{current} / {total}"
+
+async def send_stored_media(client: Client, chat_id: int, shortcode: str, media_url: str = None, media_type: str = None,
+                            status_message: Message = None):
+    """Uploads a post's bytes from the local media store, downloading them
+    first if needed (and ``media_url`` is given). Returns the sent message.
+
+    Both transfers report their progress in ``status_message``, if given.
+    """
+    try:
+        stored = await asyncio.to_thread(media_store.get, shortcode)
+        metrics.CACHE_REQUESTS_TOTAL.inc(cache="media_store", result="hit" if stored else "miss")
+        if stored is None:
+            if not media_url:
+                return None
+            progress = None
+            if status_message:
+                reporter = progress_debouncer.reporter(status_message, PROGRESS_DOWNLOAD_TEXT)
+                progress = reporter.threadsafe(asyncio.get_running_loop()) # fetch runs in a thread
+            with tracing.span("fetch_media"):
+                stored = await asyncio.to_thread(media_store.fetch, shortcode, media_url, media_type, progress=progress)
+        progress = None
+        if status_message:
+            progress = progress_debouncer.reporter(status_message, PROGRESS_UPLOAD_TEXT).update
+        with media_store.open(stored) as media_file:
+            return await send_media(client, chat_id, media_file, stored.media_type, progress=progress)
+    finally:
+        # The caller edits or deletes the status message next
+        await progress_debouncer.finish(status_message)
+
+async def upload_media(client: Client, chat_id: int, shortcode: str, media_url: str, media_type: str,
+                       status_message: Message = None):
+    """Sends a post by URL, uploading the bytes ourselves if Telegram refuses the URL."""
+    try:
+        return await send_media(client, chat_id, media_url, media_type)
+    except URL_REJECTED_ERRORS as e:
+        if media_store is None:
+            raise
+        logger.info("Telegram rejected the media URL for %s, uploading the file instead: %s", shortcode, e)
+    return await send_stored_media(client, chat_id, shortcode, media_url, media_type, status_message)
+
+async def send_cached_media(client: Client, chat_id: int, shortcode: str):
+    """Serves a post from the media cache. Returns the cache entry, or None on
+    a miss or a file_id Telegram no longer accepts."""
+    cached = media_cache.get(shortcode)
+    metrics.CACHE_REQUESTS_TOTAL.inc(cache="media", result="hit" if cached else "miss")
+    if not cached:
+        return None
+    for attempt in range(2):
+        try:
+            await send_media(client, chat_id, cached.file_id, cached.media_type)
+            return cached
+        except FloodWait as e:
+            metrics.FLOOD_WAITS_TOTAL.inc(method="send_media")
+            logger.warning("Flood wait of %s seconds when sending cached media to %s.", e.value, chat_id)
+            await asyncio.sleep(e.value + 1)
+        except Exception as e:
+            logger.warning("Cached file_id for %s failed: %s", shortcode, e)
+            media_cache.invalidate(shortcode)
+            break
+    else:
+        return None # Still flood-waited after the retry
+    if media_store is not None:
+        # Re-upload from local disk if we have the bytes, else resolve again
+        try:
+            sent = await send_stored_media(client, chat_id, shortcode)
+        except Exception as e:
+            logger.warning("Re-uploading %s from the media store failed: %s", shortcode, e)
+            sent = None
+        if sent is not None:
+            media_cache.set(shortcode, file_id_of(sent), cached.media_type)
+            return cached
+    return None
+
+# --- Cache Warming ---
+
+def create_cache_warmer(client: Client) -> CacheWarmer:
+    async def upload(shortcode, media_url, media_type):
+        sent = await upload_media(client, CACHE_CHAT_ID, shortcode, media_url, media_type)
+        return file_id_of(sent)
+
+    return CacheWarmer(
+        media_cache, download_instagram_media, upload,
+        max_per_hour=WARM_MAX_PER_HOUR, max_live_rate=WARM_MAX_LIVE_RATE, live_rate=trending.rate,
+    )
+
+def popular_recent_posts(db_session, hours, limit):
+    """(shortcode, url) of the most downloaded posts in the last ``hours``."""
+    since = datetime.utcnow() - timedelta(hours=hours)
+    rows = (
+        db_session.query(DownloadLog.url, func.count().label("downloads"))
+        .filter(DownloadLog.success == True, DownloadLog.download_time >= since) # noqa: E712
+        .group_by(DownloadLog.url)
+        .order_by(func.count().desc())
+        .limit(limit * 3) # The same post is often logged under several URL spellings
+        .all()
+    )
+    posts = {}
+    for url, _ in rows:
+        for shortcode, _ in extract_links(url):
+            posts.setdefault(shortcode, url)
+    return list(posts.items())[:limit]
+
+async def warm_from_history():
+    """Queues yesterday's most popular posts so a restart does not start cold."""
+    db_session = next(get_db(), None)
+    if not db_session:
+        return
+    try:
+        posts = await asyncio.to_thread(popular_recent_posts, db_session, WARM_HISTORY_HOURS, WARM_STARTUP_LIMIT)
+    except Exception as e:
+        logger.error("Error reading download history for cache warming: %s", e)
+        return
+    finally:
+        db_session.close()
+    queued = sum(cache_warmer.offer(shortcode, url, source="history") for shortcode, url in posts)
+    logger.info("Queued %s popular posts for cache warming.", queued)
 
 # --- Bot Handlers ---
 
-@app.on_message(filters.command("start") & filters.private)
+# Text messages that are not commands are treated as links to download
+LINK_MESSAGE_FILTER = filters.text & filters.private & ~filters.command("start") & ~filters.command("stats")
+
+async def throttle_message(client: Client, message: Message):
+    """Drops link messages from banned or flooding users before any real work.
+
+    Runs ahead of the ingest (group -1) and handle_message (group 0) handlers.
+    """
+    user_id = message.from_user.id
+    if user_id in ADMIN_USER_IDS:
+        return
+
+    if ban_list is not None:
+        if user_id in ban_list:
+            metrics.CACHE_REQUESTS_TOTAL.inc(cache="ban_list", result="hit")
+            metrics.MESSAGES_TOTAL.inc(outcome="banned")
+            logger.info("Ignoring message from banned user %s.", user_id)
+            message.stop_propagation()
+        metrics.CACHE_REQUESTS_TOTAL.inc(cache="ban_list", result="miss")
+
+    decision = await check_rate_limit(user_id)
+    if not decision.allowed:
+        if decision.banned:
+            ban_user(next(get_db(), None), user_id)
+            await message.reply_text("🚫 تم حظرك من استخدام البوت بسبب الإرسال المتكرر.", quote=True)
+        elif decision.notify:
+            await message.reply_text(
+                f"⏳ لقد أرسلت الكثير من الروابط. يرجى الانتظار {int(decision.retry_after)} ثانية قبل المحاولة مرة أخرى.",
+                quote=True
+            )
+        metrics.MESSAGES_TOTAL.inc(outcome="rate_limited")
+        logger.info("Rate limited user %s for %ss.", user_id, int(decision.retry_after))
+        message.stop_propagation()
+
 async def start_command(client: Client, message: Message):
     user = message.from_user
     db_session = next(get_db(), None)
@@ -254,6 +659,7 @@ async def start_command(client: Client, message: Message):
         keyboard = InlineKeyboardMarkup([
             [InlineKeyboardButton("اشترك في القناة", url=f"https://t.me/{REQUIRED_CHANNEL_USERNAME}")],
             [InlineKeyboardButton("تحققت", callback_data="check_subscription")]
+        ])
         text_content = f"""👋 أهلًا بك {user.mention}!\n\nلاستخدام البوت، يرجى الاشتراك في قناتنا أولاً: @{REQUIRED_CHANNEL_USERNAME}\n\nاضغط على الزر أدناه للاشتراك ثم اضغط على \'تحققت\'."""
         await message.reply_text(
             text_content,
@@ -266,7 +672,6 @@ async def start_command(client: Client, message: Message):
             f"👋 أهلًا بك {user.mention}!\nأرسل لي رابط منشور (صورة أو فيديو أو Reels) من انستقرام لتحميله.",
             quote=True
         )
-@app.on_message(filters.command("stats") & filters.private)
 async def stats_command(client: Client, message: Message):
     user_id = message.from_user.id
     db_session = next(get_db(), None)
@@ -296,15 +701,19 @@ async def stats_command(client: Client, message: Message):
             await message.reply_text("حدث خطأ أثناء جلب إحصائياتك.", quote=True)
 
 
-@app.on_message(filters.text & filters.private & ~filters.command("start") & ~filters.command("stats"))
+@tracer.traced("handle_message")
 async def handle_message(client: Client, message: Message):
     user = message.from_user
     text = message.text
+    tracing.annotate(user_id=user.id, chat_id=message.chat.id)
     db_session = next(get_db(), None)
-    add_or_update_user(db_session, user)
+    with tracing.span("add_or_update_user"):
+        add_or_update_user(db_session, user)
 
     # 1. Check subscription
-    if not await is_user_subscribed(client, user.id):
+    with tracing.span("is_user_subscribed"):
+        subscribed = await is_user_subscribed(client, user.id)
+    if not subscribed:
         keyboard = InlineKeyboardMarkup([
             [InlineKeyboardButton("اشترك في القناة", url=f"https://t.me/{REQUIRED_CHANNEL_USERNAME}") ],
             [InlineKeyboardButton("تحققت", callback_data="check_subscription")]
@@ -314,67 +723,353 @@ async def handle_message(client: Client, message: Message):
             reply_markup=keyboard,
             quote=True
         )
+        metrics.MESSAGES_TOTAL.inc(outcome="not_subscribed")
         return
 
-    # 2. Validate Instagram URL
-    url_match = re.search(INSTAGRAM_REGEX, text)
-    if not url_match:
+    # 2. Extract the Instagram links
+    links = extract_links(text)
+    if not links:
         await message.reply_text(
             "⚠️ الرابط الذي أرسلته لا يبدو كرابط منشور انستقرام صالح (صورة، فيديو، أو Reels). يرجى التأكد من الرابط وإعادة المحاولة.",
             quote=True
         )
+        metrics.MESSAGES_TOTAL.inc(outcome="invalid_link")
+        return
+
+    # 3. Process download(s)
+    if len(links) == 1:
+        await process_link(client, message, db_session, *links[0])
         return
 
-    instagram_url = url_match.group(0) # Get the full matched URL
-    logger.info(f"User {user.id} sent URL: {instagram_url}")
+    # Several links: the checks above were paid once for all of them. Each
+    # extra link costs one more rate-limit token (throttle_message paid for
+    # the first); links the quota does not cover are skipped, without the
+    # strike and cooldown a flood would get.
+    truncated = max(0, len(links) - MAX_LINKS_PER_MESSAGE)
+    links = links[:MAX_LINKS_PER_MESSAGE]
+    skipped = 0
+    if user.id not in ADMIN_USER_IDS:
+        decision = await check_rate_limit(user.id, cost=len(links) - 1, strike=False)
+        skipped = len(links) - 1 - decision.granted
+        links = links[:1 + decision.granted]
+    tracing.annotate(links=len(links))
+    logger.info("User %s sent %s links (%s over quota, %s over the limit).", user.id, len(links), skipped, truncated)
 
-    # 3. Process download
-    status_message = await message.reply_text("⏳ جاري معالجة الرابط، يرجى الانتظار...", quote=True)
+    with tracing.span("reply_status"):
+        status_message = await message.reply_text(f"⏳ جاري معالجة {len(links)} روابط، يرجى الانتظار...", quote=True)
 
-    media_url, media_type = await download_instagram_media(instagram_url)
+    semaphore = asyncio.Semaphore(LINK_CONCURRENCY)
 
-    if media_url:
-        try:
-            if media_type == 'video':
-                await client.send_video(message.chat.id, media_url, caption=f"تم التحميل بواسطة @{client.me.username}")
-            elif media_type == 'image':
-                await client.send_photo(message.chat.id, media_url, caption=f"تم التحميل بواسطة @{client.me.username}")
-            else: # Handle cases where type might be unknown or different
-                # Try sending as document as a fallback
-                await client.send_document(message.chat.id, media_url, caption=f"تم التحميل بواسطة @{client.me.username}")
-            
-            log_download(db_session, user.id, instagram_url, success=True)
-            await status_message.delete()
-            logger.info(f"Media sent successfully to user {user.id} for URL: {instagram_url}")
+    async def process_one(shortcode, instagram_url):
+        async with semaphore:
+            return await process_link(client, message, db_session, shortcode, instagram_url, report=False)
 
-        except FloodWait as e:
-            logger.warning(f"Flood wait of {e.value} seconds when sending media to {user.id}.")
+    results = await asyncio.gather(*(process_one(*link) for link in links), return_exceptions=True)
+    failed = [url for (_, url), result in zip(links, results) if result is not True]
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error("Error processing a link for user %s: %s", user.id, result)
+
+    summary = f"✅ تم إرسال {len(links) - len(failed)} من {len(links)} روابط."
+    if failed:
+        summary += "\n\n❌ تعذر تحميل:\n" + "\n".join(failed)
+    if skipped:
+        summary += f"\n\n⏳ تم تجاهل {skipped} روابط لتجاوز الحد المسموح، أعد إرسالها بعد قليل."
+    if truncated:
+        summary += f"\n\n⚠️ تتم معالجة أول {MAX_LINKS_PER_MESSAGE} روابط فقط في الرسالة الواحدة."
+    await status_message.edit_text(summary)
+
+async def process_link(client: Client, message: Message, db_session, shortcode: str, instagram_url: str, report=True):
+    """Downloads one post and sends it to the message's chat. True if sent.
+
+    With ``report`` (single-link messages) progress and errors are shown in a
+    status message of its own; for batches handle_message reports once.
+    """
+    user = message.from_user
+    tracing.annotate(url=instagram_url)
+    logger.info("User %s sent URL: %s", user.id, instagram_url)
+
+    if cache_warmer is not None and trending.record(shortcode):
+        cache_warmer.offer(shortcode, instagram_url)
+    with tracing.span("media_cache"):
+        cached = await send_cached_media(client, message.chat.id, shortcode)
+    if cached:
+        metrics.MESSAGES_TOTAL.inc(outcome="sent")
+        log_download(db_session, user.id, instagram_url, success=True, media_type=cached.media_type)
+        logger.info("Media sent from cache to user %s for URL: %s", user.id, instagram_url)
+        return True
+
+    status_message = None
+    if report:
+        with tracing.span("reply_status"):
+            status_message = await message.reply_text("⏳ جاري معالجة الرابط، يرجى الانتظار...", quote=True)
+
+    resolve_started = time.perf_counter()
+    with tracing.span("download_instagram_media"):
+        media_url, media_type = await download_instagram_media(instagram_url)
+    metrics.RESOLVE_SECONDS.observe(time.perf_counter() - resolve_started, outcome="ok" if media_url else "failed")
+
+    if not media_url:
+        metrics.FAILURES_TOTAL.inc(stage="resolve")
+        if status_message:
+            await status_message.edit_text("❌ فشل تحميل الميديا من الرابط. قد يكون المنشور خاصًا، محذوفًا، أو أن هناك مشكلة في الخدمة الخارجية.")
+        log_download(db_session, user.id, instagram_url, success=False, error_message="Failed to retrieve media URL from API")
+        return False
+
+    try:
+        sent = await upload_media(client, message.chat.id, shortcode, media_url, media_type, status_message)
+    except FloodWait as e:
+        metrics.FLOOD_WAITS_TOTAL.inc(method="send_media")
+        logger.warning("Flood wait of %s seconds when sending media to %s.", e.value, user.id)
+        if status_message:
             await status_message.edit_text(f"⏳ نواجه بعض الضغط، سيتم إرسال الملف خلال {e.value} ثانية...")
-            await asyncio.sleep(e.value + 1)
-            # Retry sending after wait
+        await asyncio.sleep(e.value + 1)
+        # Retry sending after wait
+        try:
+            sent = await upload_media(client, message.chat.id, shortcode, media_url, media_type, status_message)
+        except Exception as retry_e:
+            metrics.FAILURES_TOTAL.inc(stage="upload")
+            logger.error("Error sending media to %s after flood wait: %s", user.id, retry_e)
+            if status_message:
+                await status_message.edit_text("❌ حدث خطأ أثناء إرسال الملف بعد الانتظار. يرجى المحاولة مرة أخرى.")
+            log_download(db_session, user.id, instagram_url, success=False, error_message=str(retry_e))
+            return False
+    except Exception as e:
+        metrics.FAILURES_TOTAL.inc(stage="upload")
+        logger.error("Error sending media to %s: %s", user.id, e)
+        if status_message:
+            await status_message.edit_text("❌ حدث خطأ أثناء إرسال الملف. قد يكون الملف كبيرًا جدًا أو غير مدعوم.")
+        log_download(db_session, user.id, instagram_url, success=False, error_message=str(e))
+        return False
+
+    media_cache.set(shortcode, file_id_of(sent), media_type)
+    metrics.MESSAGES_TOTAL.inc(outcome="sent")
+    log_download(db_session, user.id, instagram_url, success=True, media_type=media_type)
+    if status_message:
+        await status_message.delete()
+    logger.info("Media sent successfully to user %s for URL: %s", user.id, instagram_url)
+    return True
+
+# --- Inline Mode ---
+
+def inline_result(shortcode: str, cached, caption: str):
+    title = f"منشور انستقرام {shortcode}"
+    if cached.media_type == 'video':
+        return InlineQueryResultCachedVideo(cached.file_id, title, id=shortcode, caption=caption)
+    if cached.media_type == 'image':
+        return InlineQueryResultCachedPhoto(cached.file_id, id=shortcode, title=title, caption=caption)
+    return InlineQueryResultCachedDocument(cached.file_id, title, id=shortcode, caption=caption)
+
+async def handle_inline_query(client: Client, inline_query: InlineQuery):
+    started = time.perf_counter()
+    result = "error"
+    try:
+        result = await answer_inline_query(client, inline_query)
+    except Exception as e:
+        logger.error("Error answering inline query from %s: %s", inline_query.from_user.id, e)
+    finally:
+        metrics.INLINE_ANSWER_SECONDS.observe(time.perf_counter() - started, result=result)
+
+async def answer_inline_query(client: Client, inline_query: InlineQuery) -> str:
+    """Answers ``@bot <links>`` from the media cache only, so the answer never
+    waits for a download. Returns the kind of answer, for the metrics."""
+    user_id = inline_query.from_user.id
+    links = extract_links(inline_query.query)[:INLINE_MAX_RESULTS]
+    if not links:
+        await inline_query.answer([], cache_time=INLINE_CACHE_TIME, switch_pm_text="أرسل رابط منشور انستقرام", switch_pm_parameter="inline")
+        return "invalid"
+    if ban_list is not None and user_id in ban_list:
+        await inline_query.answer([], cache_time=0, is_personal=True)
+        return "banned"
+    if not await is_user_subscribed(client, user_id):
+        await inline_query.answer([], cache_time=0, is_personal=True, switch_pm_text="اشترك في القناة لاستخدام البوت", switch_pm_parameter="subscribe")
+        return "not_subscribed"
+
+    caption = f"تم التحميل بواسطة @{client.me.username}"
+    results = []
+    missing = []
+    for shortcode, url in links:
+        cached = media_cache.get(shortcode)
+        metrics.CACHE_REQUESTS_TOTAL.inc(cache="media", result="hit" if cached else "miss")
+        if cached:
+            results.append(inline_result(shortcode, cached, caption))
+        else:
+            missing.append((shortcode, url))
+
+    for shortcode, url in missing:
+        if cache_warmer is not None and not cache_warmer.is_pending(shortcode):
+            # Telegram repeats the query as the user types; only new fetches
+            # cost quota, and an empty bucket just means no fetch (no strike)
+            decision = await check_rate_limit(user_id, strike=False)
+            if decision.allowed:
+                cache_warmer.offer(shortcode, url, source="inline", urgent=True)
+        if cache_warmer is not None:
+            description = "جاري التجهيز، اكتب الرابط مرة أخرى بعد ثوانٍ ليظهر الملف."
+        else:
+            description = "أرسل الرابط إلى البوت مباشرة لتحميله."
+        results.append(InlineQueryResultArticle(
+            "⏳ المنشور غير جاهز بعد",
+            InputTextMessageContent(f"📥 لتحميل هذا المنشور أرسله إلى @{client.me.username}:\n{url}", disable_web_page_preview=True),
+            id=f"pending-{shortcode}",
+            description=description,
+        ))
+
+    if missing:
+        # Not cacheable by Telegram: the next identical query should see the file
+        await inline_query.answer(results, cache_time=0, is_personal=True)
+        return "placeholder" if len(missing) == len(links) else "partial"
+    await inline_query.answer(results, cache_time=INLINE_CACHE_TIME)
+    return "cached"
+
+# --- Update Queue (ingest / worker modes) ---
+
+def message_to_payload(message: Message) -> dict:
+    """Keeps just what handle_message needs to rebuild the message in a worker."""
+    user = message.from_user
+    return {
+        "chat_id": message.chat.id,
+        "message_id": message.id,
+        "text": message.text,
+        "user": {
+            "id": user.id,
+            "first_name": user.first_name,
+            "last_name": user.last_name,
+            "username": user.username,
+        },
+    }
+
+def message_from_payload(client: Client, payload: dict) -> Message:
+    user = TelegramUser(client=client, **payload["user"])
+    chat = Chat(client=client, id=payload["chat_id"], type=enums.ChatType.PRIVATE)
+    return Message(client=client, id=payload["message_id"], chat=chat, from_user=user, text=payload["text"])
+
+async def enqueue_message(client: Client, message: Message):
+    """Ingest mode: queues link messages for the workers instead of handling them.
+
+    Runs before handle_message (group 0) and stops it from seeing the update.
+    """
+    update_id = f"{message.chat.id}:{message.id}"
+    try:
+        await asyncio.to_thread(job_queue.enqueue, update_id, message_to_payload(message))
+    except Exception as e:
+        # Let the update fall through to handle_message rather than drop it
+        logger.error("Error queueing update %s, handling it inline: %s", update_id, e)
+        return
+    message.stop_propagation()
+
+async def run_queue_worker(client: Client, worker_id: str):
+    """Claims queued updates and feeds them to handle_message until shutdown."""
+    while lifecycle.accepting:
+        try:
+            jobs = await asyncio.to_thread(job_queue.claim, worker_id)
+        except Exception as e:
+            logger.error("Worker %s failed to claim updates: %s", worker_id, e)
+            jobs = []
+        if not jobs:
+            await asyncio.sleep(QUEUE_POLL_INTERVAL)
+            continue
+        for job in jobs:
             try:
-                if media_type == 'video':
-                    await client.send_video(message.chat.id, media_url, caption=f"تم التحميل بواسطة @{client.me.username}")
-                elif media_type == 'image':
-                    await client.send_photo(message.chat.id, media_url, caption=f"تم التحميل بواسطة @{client.me.username}")
+                message = message_from_payload(client, job.payload)
+                if await lifecycle.run(job.update_id, handle_message(client, message)):
+                    await asyncio.to_thread(job_queue.ack, job)
                 else:
-                    await client.send_document(message.chat.id, media_url, caption=f"تم التحميل بواسطة @{client.me.username}")
-                log_download(db_session, user.id, instagram_url, success=True)
-                await status_message.delete()
-            except Exception as retry_e:
-                logger.error(f"Error sending media to {user.id} after flood wait: {retry_e}")
-                await status_message.edit_text("❌ حدث خطأ أثناء إرسال الملف بعد الانتظار. يرجى المحاولة مرة أخرى.")
-                log_download(db_session, user.id, instagram_url, success=False, error_message=str(retry_e))
+                    # Shutting down: another worker can take it right away
+                    await asyncio.to_thread(job_queue.release, job)
+            except Exception as e:
+                logger.error("Worker %s failed on update %s: %s", worker_id, job.update_id, e)
+                await asyncio.to_thread(job_queue.fail, job, str(e))
 
+# --- Job Lifecycle ---
+
+async def run_message_job(client: Client, message: Message):
+    """Runs handle_message as a journaled job, so a restart resumes it if it
+    is cut off. During shutdown the message is only journaled."""
+    job_id = f"{message.chat.id}:{message.id}"
+    await lifecycle.run(job_id, handle_message(client, message), payload=message_to_payload(message))
+
+async def resume_jobs(client: Client):
+    """Resumes the unfinished jobs of stopped processes (and of our own
+    previous run), at startup and then periodically."""
+    while True:
+        try:
+            jobs = await asyncio.to_thread(lifecycle.journal.adopt)
         except Exception as e:
-            logger.error(f"Error sending media to {user.id}: {e}")
-            await status_message.edit_text("❌ حدث خطأ أثناء إرسال الملف. قد يكون الملف كبيرًا جدًا أو غير مدعوم.")
-            log_download(db_session, user.id, instagram_url, success=False, error_message=str(e))
-    else:
-        await status_message.edit_text("❌ فشل تحميل الميديا من الرابط. قد يكون المنشور خاصًا، محذوفًا، أو أن هناك مشكلة في الخدمة الخارجية.")
-        log_download(db_session, user.id, instagram_url, success=False, error_message="Failed to retrieve media URL from API")
+            logger.error("Error adopting unfinished jobs: %s", e)
+            jobs = []
+        for job_id, payload in jobs:
+            if not lifecycle.accepting:
+                break # Still journaled, the next process gets them
+            logger.info("Resuming unfinished job %s.", job_id)
+            message = message_from_payload(client, payload)
+            # Rate limits were paid when the message first arrived
+            asyncio.create_task(lifecycle.run(job_id, handle_message(client, message), payload=payload))
+        await asyncio.sleep(JOB_ADOPT_INTERVAL)
+
+def close_resources():
+    """Last writes before exit: job journal, media store index, traces, DB pool."""
+    if lifecycle.journal is not None:
+        lifecycle.journal.close()
+    if media_store is not None:
+        media_store.close()
+    tracer.close()
+    if engine is not None:
+        engine.dispose()
+
+async def refresh_ban_list():
+    """Polls the users table for ban changes until cancelled."""
+    while True:
+        await asyncio.sleep(BAN_LIST_REFRESH_INTERVAL)
+        await asyncio.to_thread(ban_list.refresh)
+
+async def purge_update_queue():
+    """Deletes finished queue jobs past QUEUE_RETENTION."""
+    while True:
+        await asyncio.sleep(QUEUE_PURGE_INTERVAL)
+        try:
+            purged = await asyncio.to_thread(job_queue.purge, QUEUE_RETENTION)
+            if purged:
+                logger.info("Purged %s finished jobs from the update queue.", purged)
+        except Exception as e:
+            logger.error("Error purging the update queue: %s", e)
+
+async def prune_rate_limits():
+    """Forgets the buckets of users who have been quiet long enough."""
+    while True:
+        await asyncio.sleep(RATE_LIMIT_PRUNE_INTERVAL)
+        try:
+            pruned = await asyncio.to_thread(rate_limiter.prune)
+            logger.debug("Pruned %s idle rate-limit buckets.", pruned)
+        except Exception as e:
+            logger.error("Error pruning rate-limit buckets: %s", e)
+
+async def reconcile_activity():
+    """Periodically repairs drift in the user_activity summaries."""
+    while True:
+        await asyncio.sleep(ACTIVITY_RECONCILE_INTERVAL)
+        try:
+            await asyncio.to_thread(activity.reconcile, engine)
+        except Exception as e:
+            logger.error("Error reconciling user activity: %s", e)
+
+async def evict_media_store():
+    """Keeps the local media store under MEDIA_STORE_MAX_BYTES."""
+    while True:
+        await asyncio.sleep(MEDIA_STORE_EVICT_INTERVAL)
+        try:
+            await asyncio.to_thread(media_store.evict)
+        except Exception as e:
+            logger.error("Error evicting from the media store: %s", e)
+
+async def refresh_segments():
+    """Recomputes the broadcast audience segments, now and then periodically."""
+    while True:
+        try:
+            await asyncio.to_thread(segments.refresh, engine)
+        except Exception as e:
+            logger.error("Error refreshing audience segments: %s", e)
+        await asyncio.sleep(SEGMENT_REFRESH_INTERVAL)
 
-@app.on_callback_query(filters.regex("^check_subscription$"))
 async def check_subscription_callback(client: Client, callback_query: CallbackQuery):
     user = callback_query.from_user
 
@@ -388,34 +1083,105 @@ async def check_subscription_callback(client: Client, callback_query: CallbackQu
     else:
         await callback_query.answer("لم يتم التحقق من اشتراكك بعد. يرجى التأكد من اشتراكك في القناة والمحاولة مرة أخرى.", show_alert=True)
 
+# --- Pyrogram Bot Setup ---
+def create_client() -> Client:
+    # Use API ID and Hash if available, otherwise rely on Bot Token only
+    if TELEGRAM_API_ID and TELEGRAM_API_HASH:
+        return Client("instagram_downloader_bot", api_id=int(TELEGRAM_API_ID), api_hash=TELEGRAM_API_HASH, bot_token=TELEGRAM_BOT_TOKEN, no_updates=BOT_MODE == "worker")
+    logger.warning("API_ID or API_HASH not found. Running in bot token mode.")
+    return Client("instagram_downloader_bot", bot_token=TELEGRAM_BOT_TOKEN, no_updates=BOT_MODE == "worker")
+
+def register_handlers(client: Client):
+    # Lower groups run first; a handler calling stop_propagation() hides the
+    # update from the groups after it.
+    client.add_handler(MessageHandler(throttle_message, LINK_MESSAGE_FILTER), group=-2)
+    if BOT_MODE == "ingest":
+        client.add_handler(MessageHandler(enqueue_message, LINK_MESSAGE_FILTER), group=-1)
+    client.add_handler(MessageHandler(start_command, filters.command("start") & filters.private))
+    client.add_handler(MessageHandler(stats_command, filters.command("stats") & filters.private))
+    client.add_handler(MessageHandler(run_message_job, LINK_MESSAGE_FILTER))
+    client.add_handler(CallbackQueryHandler(check_subscription_callback, filters.regex("^check_subscription$")))
+    client.add_handler(InlineQueryHandler(handle_inline_query))
+
 # --- Flask App (Optional - for webhooks or simple status page) ---
-flask_app = Flask(__name__)
+def create_flask_app():
+    # Flask is only imported when a status page is actually wanted
+    from flask import Flask
+
+    flask_app = Flask(__name__)
 
-@flask_app.route('/')
-def index():
-    return "Bot is running!", 200
+    @flask_app.route('/')
+    def index():
+        return "Bot is running!", 200
 
-# Add more Flask routes if needed, e.g., for webhook
-# @flask_app.route('/webhook', methods=['POST'])
-# def webhook():
-#     # Process Telegram update
-#     return jsonify(success=True)
+    # Add more Flask routes if needed, e.g., for webhook
+    # @flask_app.route('/webhook', methods=['POST'])
+    # def webhook():
+    #     # Process Telegram update
+    #     return jsonify(success=True)
+    return flask_app
 
 # --- Main Execution ---
 async def main():
+    global cache_warmer
+    # JSON lines written from a background thread, see services/logs.py
+    logs.setup_logging("bot")
+    if not TELEGRAM_BOT_TOKEN:
+        logger.critical("TELEGRAM_BOT_TOKEN not found in environment variables. Exiting.")
+        return
+
+    init_database()
+    await asyncio.to_thread(init_media_store)
+    await asyncio.to_thread(init_job_journal)
+    lifecycle.install_signal_handlers()
+    app = create_client()
+    register_handlers(app)
     try:
+        if ban_list is not None and BOT_MODE != "worker":
+            try:
+                await asyncio.to_thread(ban_list.load)
+            except Exception as e:
+                logger.error("Error loading ban list, retrying in the background: %s", e)
+            ban_refresh_task = asyncio.create_task(refresh_ban_list())
+        if RATE_LIMIT_PRUNE_INTERVAL:
+            prune_task = asyncio.create_task(prune_rate_limits())
+        if job_queue is not None and QUEUE_PURGE_INTERVAL and BOT_MODE == "ingest":
+            purge_task = asyncio.create_task(purge_update_queue())
+        if engine is not None and ACTIVITY_RECONCILE_INTERVAL and BOT_MODE != "worker":
+            reconcile_task = asyncio.create_task(reconcile_activity())
+        if engine is not None and SEGMENT_REFRESH_INTERVAL and BOT_MODE != "worker":
+            segments_task = asyncio.create_task(refresh_segments())
+        if media_store is not None and MEDIA_STORE_EVICT_INTERVAL:
+            evict_task = asyncio.create_task(evict_media_store())
+        if METRICS_PORT:
+            metrics.start_http_server(METRICS_PORT)
         logger.info("Starting Pyrogram client...")
         await app.start()
         me = await app.get_me()
-        logger.info(f"Bot @{me.username} started successfully!")
-        # Keep the bot running
-        await asyncio.Event().wait() # Keep running indefinitely
+        logger.info("Bot @%s started successfully!", me.username)
+        if CACHE_CHAT_ID:
+            # Ingest processes only warm for inline queries, which they receive
+            cache_warmer = create_cache_warmer(app)
+            warmer_task = asyncio.create_task(cache_warmer.run())
+            if WARM_STARTUP_LIMIT and BOT_MODE != "ingest":
+                await warm_from_history()
+        if lifecycle.journal is not None:
+            resume_task = asyncio.create_task(resume_jobs(app))
+        if BOT_MODE == "worker":
+            worker_ids = [f"{me.username}-{os.getpid()}-{i}" for i in range(WORKER_CONCURRENCY)]
+            logger.info("Consuming update queue with %s concurrent jobs.", WORKER_CONCURRENCY)
+            worker_tasks = [asyncio.create_task(run_queue_worker(app, worker_id)) for worker_id in worker_ids]
+        # Keep the bot running until SIGTERM/SIGINT
+        await lifecycle.stopping.wait()
+        # The client keeps running while draining, so jobs can still send
+        await lifecycle.drain(SHUTDOWN_TIMEOUT)
     except Exception as e:
-        logger.critical(f"Critical error during bot startup or runtime: {e}")
+        logger.critical("Critical error during bot startup or runtime: %s", e)
     finally:
         logger.info("Stopping Pyrogram client...")
         if app.is_initialized:
              await app.stop()
+        await asyncio.to_thread(close_resources)
         logger.info("Bot stopped.")
 
 if __name__ == "__main__":
@@ -424,7 +1190,7 @@ if __name__ == "__main__":
     # from threading import Thread
     # bot_thread = Thread(target=asyncio.run, args=(main(),))
     # bot_thread.start()
-    # flask_app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
+    # create_flask_app().run(host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
     
     # To run only the Pyrogram bot (polling mode):
     asyncio.run(main())
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+"""Bulk generator/importer for the users and downloads tables.
+
+Bypasses the ORM: rows are streamed to the database with COPY on PostgreSQL
+and with batched executemany on SQLite.
+
+    python bulk_load.py generate --users 1000000 --downloads 5000000
+    python bulk_load.py import users users.csv
+    zcat downloads.jsonl.gz | python bulk_load.py import downloads - --format jsonl --drop-indexes
+"""
+import argparse
+import csv
+import io
+import json
+import random
+import sys
+import time
+from array import array
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+USER_COLUMNS = [
+    "telegram_user_id", "first_name", "last_name", "username", "joined_at",
+    "last_active_at", "updated_at", "is_subscribed", "is_banned",
+]
+DOWNLOAD_COLUMNS = ["user_id", "url", "download_time", "status", "error_message"]
+TABLE_COLUMNS = {"users": USER_COLUMNS, "downloads": DOWNLOAD_COLUMNS}
+
+DATETIME_COLUMNS = {"joined_at", "last_active_at", "updated_at", "download_time"}
+BOOLEAN_COLUMNS = {"is_subscribed", "is_banned"}
+INTEGER_COLUMNS = {"telegram_user_id", "user_id"}
+
+
+# Values used when an imported row leaves a NOT NULL column out
+DEFAULTS = {"is_subscribed": False, "is_banned": False, "status": "success"}
+
+
+# --- Row sources ---
+# Rows are tuples in TABLE_COLUMNS order. Datetimes are pre-formatted strings
+# and booleans stay bool, which both sqlite3 and COPY (as "True"/"False") take
+# as-is, so the writers never have to touch individual values.
+
+def _timestamps(rng, count=4096):
+    """A pool of random timestamps over the last year, formatted once."""
+    now = datetime.utcnow()
+    return [(now - timedelta(seconds=rng.randrange(365 * 86400))).isoformat(sep=" ") for _ in range(count)]
+
+
+def generate_users(count, first_telegram_id, seed=None):
+    rng = random.Random(seed)
+    stamps = _timestamps(rng)
+    for telegram_id in range(first_telegram_id, first_telegram_id + count):
+        joined = rng.choice(stamps)
+        yield (
+            telegram_id, f"User {telegram_id}", None, f"user_{telegram_id}",
+            joined, joined, joined, rng.random() < 0.7, rng.random() < 0.01,
+        )
+
+
+def existing_user_ids(engine):
+    """Every users.id, compactly. Ids have gaps once users are deleted, so
+    downloads pick from the real ones instead of a MIN..MAX range."""
+    ids = array("q")
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(text("SELECT id FROM users"))
+        for chunk in result.scalars().partitions(100000):
+            ids.extend(chunk)
+    return ids
+
+
+def generate_downloads(count, user_ids, seed=None):
+    """``user_ids`` is a sequence of existing users.id values."""
+    rng = random.Random(seed)
+    stamps = _timestamps(rng)
+    for i in range(count):
+        if rng.random() < 0.1:
+            status, error = "failed", "Failed to retrieve media URL from API"
+        else:
+            status, error = "success", None
+        yield (rng.choice(user_ids), f"https://www.instagram.com/p/GEN{i:x}/",
+               rng.choice(stamps), status, error)
+
+
+def read_rows(stream, fmt):
+    """Yields dicts from a CSV (with header) or JSON-lines text stream."""
+    if fmt == "csv":
+        yield from csv.DictReader(stream)
+    else:
+        for line in stream:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def _parse(column, value):
+    if value is None or value == "":
+        return DEFAULTS.get(column)
+    if column in DATETIME_COLUMNS and isinstance(value, str):
+        value = datetime.fromisoformat(value.replace("Z", "+00:00")).replace(tzinfo=None)
+        return value.isoformat(sep=" ")
+    if column in BOOLEAN_COLUMNS and isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "t", "yes")
+    if column in INTEGER_COLUMNS:
+        return int(value)
+    return value
+
+
+def normalize(rows, columns):
+    """Turns imported dict rows into tuples in ``columns`` order."""
+    for row in rows:
+        yield tuple(_parse(column, row.get(column)) for column in columns)
+
+
+# --- Writers ---
+
+class _CsvStream(io.TextIOBase):
+    """File-like object producing CSV text from row tuples, for COPY."""
+
+    def __init__(self, rows):
+        self._rows = rows
+        self._buffer = ""
+        self.count = 0
+
+    def read(self, size=-1):
+        out = io.StringIO()
+        writer = csv.writer(out)
+        while size < 0 or len(self._buffer) < size:
+            row = next(self._rows, None)
+            if row is None:
+                break
+            # csv writes None as an empty unquoted field, which COPY reads as NULL
+            writer.writerow(row)
+            self.count += 1
+            self._buffer += out.getvalue()
+            out.seek(0)
+            out.truncate()
+        if size < 0:
+            size = len(self._buffer)
+        chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+    readline = read
+
+
+def _batches(rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _copy_postgres(engine, table, columns, rows, batch_size):
+    connection = engine.raw_connection()
+    total = 0
+    try:
+        cursor = connection.cursor()
+        sql = f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+        for batch in _batches(rows, batch_size):
+            stream = _CsvStream(iter(batch))
+            cursor.copy_expert(sql, stream)
+            connection.commit()
+            total += stream.count
+    finally:
+        connection.close()
+    return total
+
+
+def _executemany(engine, table, columns, rows, batch_size):
+    connection = engine.raw_connection()
+    total = 0
+    try:
+        cursor = connection.cursor()
+        if engine.dialect.name == "sqlite":
+            # Durability is pointless for a load that can simply be rerun
+            cursor.execute("PRAGMA synchronous = OFF")
+        placeholder = "?" if engine.dialect.paramstyle == "qmark" else "%s"
+        sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join([placeholder] * len(columns))})"
+        for batch in _batches(rows, batch_size):
+            cursor.executemany(sql, batch)
+            connection.commit()
+            total += len(batch)
+    finally:
+        connection.close()
+    return total
+
+
+def bulk_insert(engine, table, rows, batch_size=50000):
+    """Streams row tuples into ``table``. Returns the number of rows written."""
+    columns = TABLE_COLUMNS[table]
+    if engine.dialect.name == "postgresql":
+        return _copy_postgres(engine, table, columns, rows, batch_size)
+    return _executemany(engine, table, columns, rows, batch_size)
+
+
+# --- Index management ---
+
+def _droppable_indexes(conn, table):
+    """[(name, CREATE INDEX statement)] of the plain indexes of ``table``.
+
+    Unique indexes stay: without them duplicates get in and the rebuild
+    fails halfway. Partial indexes stay too, they are small by design.
+    The statement is the database's own, so DESC and expression indexes
+    come back exactly as they were.
+    """
+    if conn.dialect.name == "postgresql":
+        return [tuple(row) for row in conn.execute(text(
+            "SELECT c.relname, pg_get_indexdef(i.indexrelid) FROM pg_index i"
+            " JOIN pg_class c ON c.oid = i.indexrelid"
+            " WHERE i.indrelid = CAST(:table AS regclass) AND NOT i.indisunique AND i.indpred IS NULL"
+            " AND NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conindid = i.indexrelid)"
+        ), {"table": table})]
+    if conn.dialect.name == "sqlite":
+        # origin "c" is CREATE INDEX (not a UNIQUE or PRIMARY KEY constraint)
+        names = [row[1] for row in conn.execute(text(f"PRAGMA index_list({table})"))
+                 if not row[2] and row[3] == "c" and not row[4]]
+        sql = dict(conn.execute(text("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = :table"),
+                                {"table": table}).all())
+        return [(name, sql[name]) for name in names]
+    return []
+
+
+def drop_indexes(engine, table):
+    """Drops the plain secondary indexes of ``table`` and returns their DDL."""
+    with engine.begin() as conn:
+        indexes = _droppable_indexes(conn, table)
+        quote = conn.dialect.identifier_preparer.quote
+        for name, _ in indexes:
+            conn.execute(text(f"DROP INDEX {quote(name)}"))
+    return indexes
+
+
+def rebuild_indexes(engine, table, indexes):
+    with engine.begin() as conn:
+        for _, ddl in indexes:
+            conn.execute(text(ddl))
+
+
+def load(engine, table, rows, batch_size=50000, without_indexes=False):
+    """bulk_insert, optionally with the table's indexes dropped meanwhile."""
+    indexes = drop_indexes(engine, table) if without_indexes else []
+    try:
+        return bulk_insert(engine, table, rows, batch_size)
+    finally:
+        if indexes:
+            started = time.perf_counter()
+            rebuild_indexes(engine, table, indexes)
+            print(f"Rebuilt {len(indexes)} indexes on {table} in {time.perf_counter() - started:.1f}s")
+
+
+def _report(table, count, started):
+    elapsed = time.perf_counter() - started
+    rate = count / elapsed if elapsed else 0
+    print(f"Loaded {count} rows into {table} in {elapsed:.1f}s ({rate:,.0f} rows/s)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk-load users and downloads.")
+    # Accepted before or after the subcommand. SUPPRESS keeps a subcommand
+    # from resetting a value given before it.
+    common = argparse.ArgumentParser(add_help=False, argument_default=argparse.SUPPRESS)
+    for target in (parser, common):
+        target.add_argument("--batch-size", type=int)
+        target.add_argument("--drop-indexes", action="store_true",
+                            help="drop plain (non-unique, non-partial) indexes during the load and rebuild them after")
+    parser.set_defaults(batch_size=50000, drop_indexes=False)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    generate = subparsers.add_parser("generate", parents=[common], help="insert synthetic rows")
+    generate.add_argument("--users", type=int, default=0)
+    generate.add_argument("--downloads", type=int, default=0)
+    generate.add_argument("--seed", type=int, default=None)
+
+    import_ = subparsers.add_parser("import", parents=[common], help="import rows from a CSV or JSON-lines file")
+    import_.add_argument("table", choices=sorted(TABLE_COLUMNS))
+    import_.add_argument("path", help="file to read, or - for stdin")
+    import_.add_argument("--format", choices=("csv", "jsonl"), help="defaults to the file extension")
+    args = parser.parse_args(argv)
+
+    from app import create_app, db
+
+    app = create_app()
+    with app.app_context():
+        engine = db.engine
+        if args.command == "generate":
+            if args.users:
+                with engine.connect() as conn:
+                    first_id = (conn.execute(text("SELECT MAX(telegram_user_id) FROM users")).scalar() or 10 ** 9) + 1
+                started = time.perf_counter()
+                count = load(engine, "users", generate_users(args.users, first_id, args.seed),
+                             args.batch_size, args.drop_indexes)
+                _report("users", count, started)
+            if args.downloads:
+                user_ids = existing_user_ids(engine)
+                if not user_ids:
+                    print("No users to attach downloads to. Generate users first.")
+                    sys.exit(1)
+                started = time.perf_counter()
+                count = load(engine, "downloads", generate_downloads(args.downloads, user_ids, args.seed),
+                             args.batch_size, args.drop_indexes)
+                _report("downloads", count, started)
+        else:
+            fmt = args.format or ("jsonl" if args.path.endswith((".jsonl", ".ndjson")) else "csv")
+            stream = sys.stdin if args.path == "-" else open(args.path, newline="", encoding="utf-8")
+            try:
+                started = time.perf_counter()
+                rows = normalize(read_rows(stream, fmt), TABLE_COLUMNS[args.table])
+                count = load(engine, args.table, rows, args.batch_size, args.drop_indexes)
+                _report(args.table, count, started)
+            finally:
+                if stream is not sys.stdin:
+                    stream.close()
+
+
+if __name__ == "__main__":
+    main()
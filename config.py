@@ -13,4 +13,17 @@ class Config:
     TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
     ADMIN_USERNAME = os.environ.get('ADMIN_USERNAME') or 'admin'
     ADMIN_PASSWORD = os.environ.get('ADMIN_PASSWORD') or 'password' # Store hashed password in production
-
+    TRACE_FILE = os.environ.get('TRACE_FILE') or os.path.join(basedir, 'traces.jsonl') # Written by the bot, read by the admin panel
+    # Per-request SQL budget (app/utils/query_budget.py); SQL_BUDGET_MODE is warn, raise or off
+    SQL_QUERY_BUDGET = int(os.environ.get('SQL_QUERY_BUDGET', 20))
+    SQL_TIME_BUDGET_MS = float(os.environ.get('SQL_TIME_BUDGET_MS', 500))
+    SQL_REPEAT_THRESHOLD = int(os.environ.get('SQL_REPEAT_THRESHOLD', 5))
+    SQL_BUDGET_MODE = os.environ.get('SQL_BUDGET_MODE', 'warn')
+    # Static asset fingerprinting (app/utils/assets.py)
+    ASSETS_FINGERPRINT = os.environ.get('ASSETS_FINGERPRINT', '1').lower() not in ('0', 'false', 'no')
+    ASSETS_BUILD_ON_STARTUP = os.environ.get('ASSETS_BUILD_ON_STARTUP', '1').lower() not in ('0', 'false', 'no')
+    # Rendered page/fragment cache (app/utils/view_cache.py)
+    VIEW_CACHE_ENABLED = os.environ.get('VIEW_CACHE_ENABLED', '1').lower() not in ('0', 'false', 'no')
+    VIEW_CACHE_SIZE = int(os.environ.get('VIEW_CACHE_SIZE', 512))
+    VIEW_CACHE_TTL = int(os.environ.get('VIEW_CACHE_TTL', 300))
+    ADMIN_IDENTITY_TTL = int(os.environ.get('ADMIN_IDENTITY_TTL', 60)) # Seconds a logged-in admin is served from memory
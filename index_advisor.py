@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""Runs EXPLAIN on the app's hot query shapes and flags full scans of big tables.
+
+    python index_advisor.py                  # report
+    python index_advisor.py --min-rows 1000  # also flag scans of smaller tables
+    python index_advisor.py --strict         # exit 1 if anything is flagged (CI)
+
+Works on PostgreSQL (EXPLAIN (FORMAT JSON), table sizes from pg_class) and
+SQLite (EXPLAIN QUERY PLAN, table sizes from COUNT(*)). Add a query shape to
+query_shapes() whenever a new hot query goes in.
+"""
+import argparse
+import json
+import sys
+
+import sqlalchemy as sa
+
+
+def query_shapes():
+    """(name, statement) pairs mirroring the queries the bot and panel run."""
+    from app.models import Download, User
+    from services import segments
+    from services.activity import download_logs, user_activity
+
+    now = sa.func.current_timestamp()
+    return [
+        ("admin users list", sa.select(User).order_by(User.joined_at.desc()).limit(15).offset(0)),
+        ("admin users activity", sa.select(user_activity).where(user_activity.c.telegram_user_id.in_([1, 2, 3]))),
+        ("ban list load", sa.select(User.telegram_user_id).where(User.is_banned == True)), # noqa: E712
+        ("ban list refresh", sa.select(User.telegram_user_id, User.is_banned, User.updated_at).where(User.updated_at >= now)),
+        ("user lookup", sa.select(User).where(User.telegram_user_id == 1)),
+        ("user download history", sa.select(Download).where(Download.user_id == 1)
+            .order_by(Download.download_time.desc()).limit(20)),
+        ("bot download history", sa.select(download_logs).where(download_logs.c.user_id == 1)
+            .order_by(download_logs.c.download_time.desc()).limit(20)),
+        ("admin users cache version", sa.select(sa.func.max(user_activity.c.updated_at))),
+        ("broadcast segment page", segments.members_query("all", after=1)),
+        ("broadcast joined after", segments.members_query(segments.JOINED_AFTER, since=now)),
+        ("segment refresh (all)", segments.definitions()["all"]),
+    ]
+
+
+# Queries that read (nearly) the whole table by design; a scan is the right plan
+EXPECTED_SCANS = {"segment refresh (all)"}
+
+
+def _sql(statement, dialect):
+    return str(statement.compile(dialect=dialect, compile_kwargs={"literal_binds": True}))
+
+
+def _table_sizes(conn):
+    if conn.dialect.name == "postgresql":
+        rows = conn.execute(sa.text(
+            "SELECT relname, reltuples::bigint FROM pg_class WHERE relkind = 'r' AND relnamespace = 'public'::regnamespace"
+        ))
+        return {name: max(int(count), 0) for name, count in rows}
+    return {
+        name: conn.execute(sa.text(f'SELECT COUNT(*) FROM "{name}"')).scalar()
+        for name in sa.inspect(conn).get_table_names()
+    }
+
+
+def _postgres_scans(conn, sql):
+    plan = conn.execute(sa.text("EXPLAIN (FORMAT JSON) " + sql)).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    scans, summary = [], []
+
+    def walk(node):
+        summary.append(node["Node Type"] + (f" on {node['Relation Name']}" if "Relation Name" in node else "")
+                       + (f" using {node['Index Name']}" if "Index Name" in node else ""))
+        if node["Node Type"] == "Seq Scan":
+            scans.append(node["Relation Name"])
+        for child in node.get("Plans", []):
+            walk(child)
+
+    walk(plan[0]["Plan"])
+    return scans, summary
+
+
+def _sqlite_scans(conn, sql):
+    scans, summary = [], []
+    for row in conn.execute(sa.text("EXPLAIN QUERY PLAN " + sql)):
+        detail = row[-1]
+        summary.append(detail)
+        # "SCAN users" is a full scan; "SCAN users USING INDEX ..." walks an index
+        if detail.startswith("SCAN ") and " USING " not in detail:
+            scans.append(detail.split()[1])
+    return scans, summary
+
+
+def advise(engine, min_rows=10000):
+    """Returns one report dict per query shape."""
+    reports = []
+    with engine.connect() as conn:
+        sizes = _table_sizes(conn)
+        explain = _postgres_scans if conn.dialect.name == "postgresql" else _sqlite_scans
+        for name, statement in query_shapes():
+            tables = {table.name for table in statement.get_final_froms()}
+            missing = sorted(table for table in tables if table not in sizes)
+            if missing:
+                reports.append({"query": name, "skipped": f"missing table {', '.join(missing)}"})
+                continue
+            scans, summary = explain(conn, _sql(statement, conn.dialect))
+            flagged = [table for table in scans if sizes.get(table, 0) >= min_rows and name not in EXPECTED_SCANS]
+            reports.append({"query": name, "plan": summary, "full_scans": scans, "flagged": flagged,
+                            "rows": {table: sizes.get(table) for table in sorted(tables)}})
+    return reports
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Flag full table scans in the app's hot queries.")
+    parser.add_argument("--min-rows", type=int, default=10000, help="only flag scans of tables at least this big")
+    parser.add_argument("--strict", action="store_true", help="exit with status 1 if any query is flagged")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    from app import create_app, db
+
+    app = create_app()
+    with app.app_context():
+        reports = advise(db.engine, args.min_rows)
+
+    if args.json:
+        json.dump(reports, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        for report in reports:
+            if "skipped" in report:
+                print(f"-  {report['query']}: skipped ({report['skipped']})")
+                continue
+            mark = "!!" if report["flagged"] else "ok"
+            print(f"{mark} {report['query']}: {' / '.join(report['plan'])}")
+            for table in report["flagged"]:
+                print(f"   full scan of {table} ({report['rows'][table]} rows): add an index for this query")
+    if args.strict and any(report.get("flagged") for report in reports):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,9 @@
 import logging
+import os
 from logging.config import fileConfig
 
 from flask import current_app
+from sqlalchemy import text
 
 from alembic import context
 
@@ -14,6 +16,8 @@ config = context.config
 fileConfig(config.config_file_name)
 logger = logging.getLogger('alembic.env')
 
+MIGRATION_LOCK_KEY = 724_305_118 # Arbitrary, shared by every process that runs upgrade()
+
 
 def get_engine():
     try:
@@ -94,17 +98,36 @@ def run_migrations_online():
     if conf_args.get("process_revision_directives") is None:
         conf_args["process_revision_directives"] = process_revision_directives
 
+    # Commit after each revision, so a long online migration (see
+    # services/online_migrations.py) does not keep earlier DDL locks held
+    conf_args.setdefault("transaction_per_migration", True)
+
     connectable = get_engine()
 
     with connectable.connect() as connection:
-        context.configure(
-            connection=connection,
-            target_metadata=get_metadata(),
-            **conf_args
-        )
-
-        with context.begin_transaction():
-            context.run_migrations()
+        if connection.dialect.name == 'postgresql':
+            # The web app and the bot may both try to upgrade on deploy;
+            # the second one waits here and then finds nothing to do
+            connection.execute(text('SELECT pg_advisory_lock(:key)'), {'key': MIGRATION_LOCK_KEY})
+            # Give up on a DDL lock instead of queueing every query behind it
+            connection.execute(text(f"SET lock_timeout = '{os.environ.get('MIGRATION_LOCK_TIMEOUT', '5s')}'"))
+            connection.commit()
+
+        try:
+            context.configure(
+                connection=connection,
+                target_metadata=get_metadata(),
+                **conf_args
+            )
+
+            with context.begin_transaction():
+                context.run_migrations()
+        finally:
+            if connection.dialect.name == 'postgresql':
+                # The connection goes back to the pool, so release explicitly
+                connection.rollback()
+                connection.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': MIGRATION_LOCK_KEY})
+                connection.commit()
 
 
 if context.is_offline_mode():
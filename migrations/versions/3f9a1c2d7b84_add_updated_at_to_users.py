@@ -0,0 +1,34 @@
+"""Add updated_at to users for ban list change polling
+
+Revision ID: 3f9a1c2d7b84
+Revises: cff6a03aeeb1
+Create Date: 2026-10-19 09:12:31.504217
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from services import online_migrations
+
+
+# revision identifiers, used by Alembic.
+revision = '3f9a1c2d7b84'
+down_revision = 'cff6a03aeeb1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Nullable and without a default: no table rewrite
+    op.add_column('users', sa.Column('updated_at', sa.DateTime(), nullable=True))
+
+    # Existing rows have never been updated; their join date is the best guess
+    online_migrations.backfill('users', 'updated_at = joined_at', where='updated_at IS NULL')
+
+    online_migrations.create_index('ix_users_updated_at', 'users', ['updated_at'])
+
+
+def downgrade():
+    online_migrations.drop_index('ix_users_updated_at', 'users')
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.drop_column('updated_at')
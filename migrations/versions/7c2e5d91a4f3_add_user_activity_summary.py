@@ -0,0 +1,34 @@
+"""Add user_activity per-user download summary
+
+Revision ID: 7c2e5d91a4f3
+Revises: 3f9a1c2d7b84
+Create Date: 2026-10-19 11:40:12.318842
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c2e5d91a4f3'
+down_revision = '3f9a1c2d7b84'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Maintained by the bot (services/activity.py); filled in by its reconcile job
+    op.create_table('user_activity',
+    sa.Column('telegram_user_id', sa.BigInteger(), autoincrement=False, nullable=False),
+    sa.Column('download_count', sa.Integer(), nullable=False),
+    sa.Column('failure_count', sa.Integer(), nullable=False),
+    sa.Column('last_active_at', sa.DateTime(), nullable=True),
+    sa.Column('last_download_at', sa.DateTime(), nullable=True),
+    sa.Column('last_media_type', sa.String(length=16), nullable=True),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('telegram_user_id')
+    )
+
+
+def downgrade():
+    op.drop_table('user_activity')
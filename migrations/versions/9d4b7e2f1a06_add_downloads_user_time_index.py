@@ -0,0 +1,38 @@
+"""Add (user_id, download_time) indexes on downloads and download_logs
+
+Revision ID: 9d4b7e2f1a06
+Revises: 7c2e5d91a4f3
+Create Date: 2026-10-19 14:05:47.902113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from services import online_migrations
+
+
+# revision identifiers, used by Alembic.
+revision = '9d4b7e2f1a06'
+down_revision = '7c2e5d91a4f3'
+branch_labels = None
+depends_on = None
+
+
+def _has_download_logs():
+    # download_logs belongs to the bot (bot.DownloadLog) and only exists once
+    # the bot has run against this database; the bot model carries the same
+    # index for databases where it creates the table later.
+    return sa.inspect(op.get_bind()).has_table('download_logs')
+
+
+def upgrade():
+    online_migrations.create_index('ix_downloads_user_id_download_time', 'downloads', ['user_id', 'download_time'])
+    if _has_download_logs():
+        online_migrations.create_index('ix_download_logs_user_id_download_time', 'download_logs',
+                                       ['user_id', 'download_time'])
+
+
+def downgrade():
+    if _has_download_logs():
+        online_migrations.drop_index('ix_download_logs_user_id_download_time', 'download_logs')
+    online_migrations.drop_index('ix_downloads_user_id_download_time', 'downloads')
@@ -0,0 +1,32 @@
+"""Add users joined_at index and partial index on banned users
+
+Revision ID: b81f3c6d9e25
+Revises: 9d4b7e2f1a06
+Create Date: 2026-10-19 14:11:03.558420
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from services import online_migrations
+
+
+# revision identifiers, used by Alembic.
+revision = 'b81f3c6d9e25'
+down_revision = '9d4b7e2f1a06'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Admin users list: ORDER BY joined_at DESC LIMIT n
+    online_migrations.create_index('ix_users_joined_at', 'users', ['joined_at'])
+    # Ban list load: the few banned users without scanning everyone
+    online_migrations.create_index('ix_users_banned', 'users', ['telegram_user_id'],
+                                   postgresql_where=sa.text('is_banned = true'),
+                                   sqlite_where=sa.text('is_banned = 1'))
+
+
+def downgrade():
+    online_migrations.drop_index('ix_users_banned', 'users')
+    online_migrations.drop_index('ix_users_joined_at', 'users')
@@ -0,0 +1,36 @@
+"""Add precomputed broadcast audience segments
+
+Revision ID: e6a1d4b8c372
+Revises: b81f3c6d9e25
+Create Date: 2026-10-19 15:02:47.551930
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e6a1d4b8c372'
+down_revision = 'b81f3c6d9e25'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Filled in by services/segments.py refresh (run periodically by the bot)
+    op.create_table('audience_segments',
+    sa.Column('segment', sa.String(length=32), nullable=False),
+    sa.Column('telegram_user_id', sa.BigInteger(), autoincrement=False, nullable=False),
+    sa.PrimaryKeyConstraint('segment', 'telegram_user_id')
+    )
+    op.create_table('audience_segment_sizes',
+    sa.Column('segment', sa.String(length=32), nullable=False),
+    sa.Column('size', sa.Integer(), nullable=False),
+    sa.Column('refreshed_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('segment')
+    )
+
+
+def downgrade():
+    op.drop_table('audience_segment_sizes')
+    op.drop_table('audience_segments')
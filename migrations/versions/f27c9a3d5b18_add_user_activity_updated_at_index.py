@@ -0,0 +1,27 @@
+"""Add user_activity updated_at index
+
+Revision ID: f27c9a3d5b18
+Revises: e6a1d4b8c372
+Create Date: 2026-10-19 16:02:47.118305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from services import online_migrations
+
+
+# revision identifiers, used by Alembic.
+revision = 'f27c9a3d5b18'
+down_revision = 'e6a1d4b8c372'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Admin users page cache version: MAX(updated_at) without a scan
+    online_migrations.create_index('ix_user_activity_updated_at', 'user_activity', ['updated_at'])
+
+
+def downgrade():
+    online_migrations.drop_index('ix_user_activity_updated_at', 'user_activity')
@@ -1,55 +1,106 @@
 # This script is dedicated to running the Telegram bot independently.
+#
+# Startup is kept short: the Flask app and Alembic are only loaded when the
+# database is behind the latest migration, which is checked by comparing the
+# alembic_version table with the newest revision in migrations/versions.
 
+import asyncio
+import glob
 import os
+import re
 import logging
-# import subprocess # No longer needed for migrations
-from bot import run_bot
-from app import create_app, db # Import db
-from flask_migrate import upgrade # <<< Import upgrade function
-
-# Enable logging (optional but recommended for worker process)
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
+import time
+
+from services import logs
+
+# Same queue-backed JSON logging as bot.py sets up, from the first line on
+logs.setup_logging("bot")
 logger = logging.getLogger(__name__)
 
-logger.info("Starting Telegram bot worker process...")
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+_REVISION_RE = re.compile(r"^(down_revision|revision)\s*=\s*['\"]?([0-9a-f]+|None)['\"]?", re.MULTILINE)
+
+def head_revisions():
+    """Newest migration revisions, read from the files without importing them."""
+    revisions, parents = set(), set()
+    for path in glob.glob(os.path.join(MIGRATIONS_DIR, "versions", "*.py")):
+        with open(path, encoding="utf-8") as f:
+            for name, value in _REVISION_RE.findall(f.read()):
+                if name == "revision":
+                    revisions.add(value)
+                elif value != "None":
+                    parents.add(value)
+    return revisions - parents
+
+def current_revisions(engine):
+    from sqlalchemy import inspect, text
 
-# Create the Flask app instance to provide context if needed by the bot
-# and to run migrations
-app = create_app()
+    with engine.connect() as conn:
+        if not inspect(conn).has_table("alembic_version"):
+            return set()
+        return {row[0] for row in conn.execute(text("SELECT version_num FROM alembic_version"))}
 
-# --- Run Database Migrations Programmatically ---
-try:
+def run_migrations():
+    # Heavy imports, only needed when there is something to migrate
+    from app import create_app
+    from flask_migrate import upgrade
+
+    app = create_app()
     with app.app_context():
-        logger.info("Applying database migrations for worker...")
-        upgrade() # <<< Run migrations using the imported function
-        logger.info("Database migrations completed successfully for worker.")
-except Exception as e:
-    logger.error(f"Error applying database migrations for worker: {e}", exc_info=True)
-    # Decide if you want the bot to continue running even if migrations fail
-    # For now, we log the error and continue
-
-# --- Start the Bot ---
-# Check if essential bot environment variables are set
-BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
-CHANNEL_ID = os.environ.get("TELEGRAM_CHANNEL_ID")
-CHANNEL_USERNAME = os.environ.get("REQUIRED_CHANNEL_USERNAME")
-
-if not BOT_TOKEN:
-    logger.error("CRITICAL: TELEGRAM_BOT_TOKEN environment variable not set. Bot cannot start.")
-else:
-    if not CHANNEL_ID:
+        upgrade(directory=MIGRATIONS_DIR)
+
+def prepare():
+    """Imports the bot and brings the schema up to date. Returns stage timings."""
+    timings = {}
+
+    started = time.perf_counter()
+    import bot
+    timings["import_bot"] = time.perf_counter() - started
+
+    if bot.engine is not None:
+        started = time.perf_counter()
+        try:
+            heads = head_revisions()
+            current = current_revisions(bot.engine)
+            timings["check_revision"] = time.perf_counter() - started
+            if current != heads:
+                logger.info("Database at revision %s, migrating to %s...", sorted(current) or 'none', sorted(heads))
+                started = time.perf_counter()
+                run_migrations()
+                timings["migrate"] = time.perf_counter() - started
+                logger.info("Database migrations completed successfully for worker.")
+        except Exception as e:
+            logger.error("Error applying database migrations for worker: %s", e, exc_info=True)
+            # Decide if you want the bot to continue running even if migrations fail
+            # For now, we log the error and continue
+
+    # Bot-only tables (download logs, queue, ...) come after the migrations so
+    # the web schema's users table is the one that gets created
+    started = time.perf_counter()
+    bot.init_database()
+    timings["init_database"] = time.perf_counter() - started
+    return timings
+
+def main():
+    logger.info("Starting Telegram bot worker process...")
+
+    # Check if essential bot environment variables are set
+    if not os.environ.get("TELEGRAM_BOT_TOKEN"):
+        logger.error("CRITICAL: TELEGRAM_BOT_TOKEN environment variable not set. Bot cannot start.")
+        return
+    if not os.environ.get("TELEGRAM_CHANNEL_ID"):
         logger.warning("TELEGRAM_CHANNEL_ID not set. Subscription check will be skipped.")
-    if not CHANNEL_USERNAME:
+    if not os.environ.get("REQUIRED_CHANNEL_USERNAME"):
         logger.warning("REQUIRED_CHANNEL_USERNAME not set. Channel link might be missing in messages.")
-    
-    # Run the bot function, passing the app context
-    # The run_bot function should contain the bot's main loop (e.g., application.run_polling())
+
+    timings = prepare()
+    logger.info("Startup stages: %s", ", ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in timings.items()))
+
+    import bot
     try:
-        # Ensure the bot runs within the app context if it needs db access
-        with app.app_context(): 
-            run_bot(app) # Pass app if run_bot needs it, otherwise remove
+        asyncio.run(bot.main())
     except Exception as e:
-        logger.critical(f"An error occurred while running the bot: {e}", exc_info=True)
+        logger.critical("An error occurred while running the bot: %s", e, exc_info=True)
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""Denormalized per-user download activity.
+
+``user_activity`` holds one narrow row per Telegram user with the figures
+``/stats`` and the admin panel show, so they come from a single primary-key
+lookup instead of counting ``download_logs``. The bot's write path upserts it
+in the same transaction as the log row (``record_download``), and
+``reconcile`` recomputes it from ``download_logs`` to repair any drift, e.g.
+after a crash between the two writes on a backend without transactions, or
+rows written by older bot versions.
+
+    python -m services.activity reconcile --database-url sqlite:///bot_database.db
+"""
+import argparse
+import logging
+from datetime import datetime
+
+from sqlalchemy import (
+    BigInteger, Boolean, Column, DateTime, Integer, MetaData, String, Table,
+    case, create_engine, delete, func, literal, select,
+)
+
+logger = logging.getLogger(__name__)
+
+metadata = MetaData()
+
+user_activity = Table(
+    'user_activity', metadata,
+    Column('telegram_user_id', BigInteger, primary_key=True, autoincrement=False),
+    Column('download_count', Integer, nullable=False, default=0), # Successful downloads
+    Column('failure_count', Integer, nullable=False, default=0),
+    Column('last_active_at', DateTime), # Last download attempt, successful or not
+    Column('last_download_at', DateTime), # Last successful download
+    Column('last_media_type', String(16)),
+    Column('updated_at', DateTime, nullable=False, default=datetime.utcnow, index=True), # Admin page cache version
+)
+
+# The bot's log table (bot.DownloadLog), read by reconcile. Kept out of
+# ``metadata`` so create_table never creates it.
+download_logs = Table(
+    'download_logs', MetaData(),
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer),
+    Column('download_time', DateTime),
+    Column('success', Boolean),
+)
+
+
+def create_table(engine):
+    metadata.create_all(bind=engine)
+
+
+def drop_table(engine):
+    metadata.drop_all(bind=engine)
+
+
+def _insert(dialect_name):
+    if dialect_name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(user_activity)
+
+
+def record_download(session, telegram_user_id, success, media_type=None, at=None):
+    """Adds one download attempt to the user's summary (one upsert, no read).
+
+    Runs on the caller's session so it commits together with the log row.
+    """
+    at = at or datetime.utcnow()
+    stmt = _insert(session.get_bind().dialect.name).values(
+        telegram_user_id=telegram_user_id,
+        download_count=1 if success else 0,
+        failure_count=0 if success else 1,
+        last_active_at=at,
+        last_download_at=at if success else None,
+        last_media_type=media_type if success else None,
+        updated_at=at,
+    )
+    c = user_activity.c
+    if success:
+        changes = {
+            'download_count': c.download_count + 1,
+            'last_download_at': at,
+            'last_media_type': func.coalesce(stmt.excluded.last_media_type, c.last_media_type),
+        }
+    else:
+        changes = {'failure_count': c.failure_count + 1}
+    changes.update(last_active_at=at, updated_at=at)
+    session.execute(stmt.on_conflict_do_update(index_elements=[c.telegram_user_id], set_=changes))
+
+
+def get_summary(session, telegram_user_id):
+    """The user's summary row, or None if they never downloaded anything."""
+    return session.execute(
+        select(user_activity).where(user_activity.c.telegram_user_id == telegram_user_id)
+    ).first()
+
+
+def get_summaries(session, telegram_user_ids):
+    """{telegram_user_id: row} for a page of users, in one query."""
+    if not telegram_user_ids:
+        return {}
+    rows = session.execute(
+        select(user_activity).where(user_activity.c.telegram_user_id.in_(list(telegram_user_ids)))
+    )
+    return {row.telegram_user_id: row for row in rows}
+
+
+def total_downloads(session):
+    return session.execute(select(func.coalesce(func.sum(user_activity.c.download_count), 0))).scalar()
+
+
+def _recompute(user_ids=None):
+    """SELECT of the summary figures, per user, from ``download_logs``."""
+    logs = download_logs
+    query = select(
+        logs.c.user_id,
+        func.sum(case((logs.c.success, 1), else_=0)).label('download_count'),
+        func.sum(case((logs.c.success, 0), else_=1)).label('failure_count'),
+        func.max(logs.c.download_time).label('last_active_at'),
+        func.max(case((logs.c.success, logs.c.download_time), else_=None)).label('last_download_at'),
+    )
+    if user_ids is not None:
+        query = query.where(logs.c.user_id.in_(user_ids))
+    return query.group_by(logs.c.user_id)
+
+
+def reconcile(engine, batch_size=5000):
+    """Recomputes the summaries from ``download_logs``. Returns rows fixed.
+
+    Counts and timestamps are rebuilt; ``last_media_type`` is not stored in
+    the log, so existing values are kept.
+
+    Drift is found with a plain read. Each drifted row is then rewritten by
+    a single INSERT ... SELECT that recomputes it, so a ``record_download``
+    committed after the read is counted, not overwritten. On PostgreSQL the
+    summary rows are locked first: a concurrent download either committed
+    before the recompute (and is in it) or waits and adds its +1 after.
+    SQLite's single writer gives the same ordering.
+    """
+    fixed = 0
+    fields = ('download_count', 'failure_count', 'last_active_at', 'last_download_at')
+    with engine.connect() as reader:
+        result = reader.execution_options(yield_per=batch_size).execute(_recompute().order_by(download_logs.c.user_id))
+        if engine.dialect.name == 'sqlite':
+            # An open SQLite read cursor would keep the writer from committing
+            rows = result.all()
+            batches = (rows[i:i + batch_size] for i in range(0, len(rows), batch_size))
+        else:
+            batches = result.partitions()
+        for batch in batches:
+            with engine.connect() as conn:
+                current = {
+                    row.telegram_user_id: row for row in conn.execute(
+                        select(user_activity).where(user_activity.c.telegram_user_id.in_([row.user_id for row in batch]))
+                    )
+                }
+            drifted = [
+                row.user_id for row in batch
+                if row.user_id not in current
+                or any(getattr(current[row.user_id], field) != getattr(row, field) for field in fields)
+            ]
+            if drifted:
+                fixed += _rewrite(engine, drifted, fields)
+
+    with engine.begin() as conn:
+        # Summaries whose log rows are all gone
+        orphans = conn.execute(
+            delete(user_activity).where(
+                user_activity.c.telegram_user_id.not_in(select(download_logs.c.user_id).distinct())
+            )
+        ).rowcount
+    if fixed or orphans:
+        logger.warning("Activity summaries reconciled: %s rows fixed, %s orphans removed.", fixed, orphans)
+    return fixed + orphans
+
+
+def _rewrite(engine, user_ids, fields):
+    """Recomputes and upserts the summaries of ``user_ids`` in one statement."""
+    recompute = _recompute(user_ids).add_columns(literal(datetime.utcnow(), DateTime).label('updated_at'))
+    stmt = _insert(engine.dialect.name).from_select(('telegram_user_id',) + fields + ('updated_at',), recompute)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[user_activity.c.telegram_user_id],
+        set_={field: stmt.excluded[field] for field in fields + ('updated_at',)},
+    )
+    with engine.begin() as conn:
+        if engine.dialect.name == 'postgresql':
+            conn.execute(
+                select(user_activity.c.telegram_user_id)
+                .where(user_activity.c.telegram_user_id.in_(user_ids))
+                .order_by(user_activity.c.telegram_user_id) # Same lock order as any other reconcile
+                .with_for_update()
+            )
+        conn.execute(stmt)
+    return len(user_ids)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain the user_activity summary table.")
+    parser.add_argument("command", choices=["reconcile"])
+    parser.add_argument("--database-url", required=True)
+    parser.add_argument("--batch-size", type=int, default=5000)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    url = args.database_url
+    if url.startswith("postgres://"):
+        url = url.replace("postgres://", "postgresql://", 1)
+    engine = create_engine(url)
+    create_table(engine)
+    print(f"Reconciled user_activity: {reconcile(engine, args.batch_size)} rows changed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""In-memory copy of the banned Telegram user ids.
+
+The full list is loaded once in bulk, then kept fresh by polling for rows
+whose ``updated_at`` moved since the last poll, so checking a user is a set
+lookup instead of a query per message.
+"""
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select
+from sqlalchemy.exc import SQLAlchemyError
+
+logger = logging.getLogger(__name__)
+
+
+class BanList:
+    def __init__(self, engine, id_column, banned_column, updated_column, lookback=5):
+        self.engine = engine
+        self.id_column = id_column
+        self.banned_column = banned_column
+        self.updated_column = updated_column
+        # Rows are stamped by the writer's clock and become visible at commit,
+        # so re-read a few seconds behind the cursor to not miss late commits.
+        self.lookback = timedelta(seconds=lookback)
+        self.cursor = None
+        self._banned = set()
+
+    def __contains__(self, user_id):
+        return user_id in self._banned
+
+    def __len__(self):
+        return len(self._banned)
+
+    def add(self, user_id):
+        """Records a ban made by this process without waiting for the next poll."""
+        self._banned.add(user_id)
+
+    def load(self):
+        """Replaces the set with every banned id in the database."""
+        with self.engine.connect() as conn:
+            banned = set(conn.execute(
+                # "= true", not "IS true", so the partial index on banned users applies
+                select(self.id_column).where(self.banned_column == True) # noqa: E712
+            ).scalars())
+            latest = conn.execute(select(func.max(self.updated_column))).scalar()
+        self._banned = banned
+        self.cursor = latest or datetime(1970, 1, 1)
+        logger.info("Ban list loaded: %s banned users.", len(banned))
+
+    def refresh(self):
+        """Applies bans and unbans written since the previous poll."""
+        try:
+            if self.cursor is None:
+                return self.load()
+            with self.engine.connect() as conn:
+                rows = conn.execute(
+                    select(self.id_column, self.banned_column, self.updated_column)
+                    .where(self.updated_column >= self.cursor - self.lookback)
+                ).all()
+        except SQLAlchemyError as e:
+            logger.error("Error refreshing ban list: %s", e)
+            return
+        for user_id, is_banned, updated_at in rows:
+            if is_banned:
+                self._banned.add(user_id)
+            else:
+                self._banned.discard(user_id)
+            if updated_at and updated_at > self.cursor:
+                self.cursor = updated_at
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""Graceful shutdown, and resuming the jobs a shutdown or crash cut off.
+
+On SIGTERM (a deploy) or SIGINT the bot stops taking new work, gives the
+jobs already running up to a deadline to finish, and only then stops the
+client. Nothing is dropped silently:
+
+* every link message handled in this process is a job in a ``JobJournal``.
+  The job is written (and fsynced) before it starts and marked done when it
+  ends, so after a crash the journal lists exactly the unfinished ones;
+* messages that arrive while draining are journaled without being run;
+* jobs still running at the deadline are cancelled and stay in the journal.
+
+Each process appends to its own journal file and holds an exclusive lock on
+it while it runs. Another process that manages to lock a journal knows its
+owner is gone, so it adopts the open jobs and resumes them. During a rolling
+deploy the new process picks up whatever the old one left behind. Delivery
+is at-least-once: a job cut off after its media was sent is sent again.
+
+Worker processes (BOT_MODE=worker) already get this from the update queue;
+they use ``Lifecycle.run`` without a payload, so nothing is journaled, and
+release cut-off jobs back to the queue.
+"""
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import signal
+import socket
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def _read_journal(f):
+    """{job id: (started at, payload)} of the jobs a journal file leaves open."""
+    jobs = {}
+    f.seek(0)
+    for line in f:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue # Torn last line of a crashed process
+        if entry.get('op') == 'begin':
+            jobs[entry['id']] = (entry['at'], entry['payload'])
+        elif entry.get('op') == 'end':
+            jobs.pop(entry['id'], None)
+    return jobs
+
+
+class JobJournal:
+    """Append-only journal of the jobs running in this process.
+
+    Lines are ``{"op": "begin", "id", "at", "payload"}`` and ``{"op": "end",
+    "id"}``. Begins are fsynced; ends are only flushed, since losing one just
+    means the job may run once more.
+    """
+
+    def __init__(self, directory, max_age=3600, compact_after=1000, clock=time.time):
+        self.directory = directory
+        self.max_age = max_age # Older unfinished jobs are not worth resuming
+        self.compact_after = compact_after # Lines before the file is rewritten
+        self.clock = clock
+        os.makedirs(directory, exist_ok=True)
+        # Hostname too: in containers every process may be pid 1
+        self.path = os.path.join(directory, f"jobs-{socket.gethostname()}-{os.getpid()}.jsonl")
+        self._lock = threading.Lock()
+        self._file = open(self.path, 'a+', encoding='utf-8')
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        self._open = _read_journal(self._file) # Left by an earlier process with our name
+        self._lines = len(self._open)
+        self._leftover = list(self._open) # Handed out by the first adopt()
+
+    def __len__(self):
+        return len(self._open)
+
+    def _write(self, entry, sync):
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+        self._lines += 1
+
+    def begin(self, job_id, payload, at=None):
+        with self._lock:
+            at = at or self.clock()
+            self._write({'op': 'begin', 'id': job_id, 'at': at, 'payload': payload}, sync=True)
+            self._open[job_id] = (at, payload)
+
+    def end(self, job_id):
+        with self._lock:
+            if self._open.pop(job_id, None) is None:
+                return
+            self._write({'op': 'end', 'id': job_id}, sync=False)
+            if self._lines > self.compact_after:
+                self._compact()
+
+    def _compact(self):
+        """Rewrites the file with only the open jobs. Called with the lock held."""
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        f = os.fdopen(fd, 'a+', encoding='utf-8')
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX) # Locked before it becomes our journal
+        for job_id, (at, payload) in self._open.items():
+            f.write(json.dumps({'op': 'begin', 'id': job_id, 'at': at, 'payload': payload}, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._file.close()
+        self._file = f
+        self._lines = len(self._open)
+
+    def adopt(self):
+        """Takes over the open jobs of journals whose process is gone (and,
+        the first time, those left in our own file). Returns [(job id, payload)]."""
+        adopted = []
+        with self._lock:
+            now = self.clock()
+            leftover, self._leftover = self._leftover, []
+            for job_id in leftover:
+                at, payload = self._open[job_id]
+                if now - at > self.max_age:
+                    self._open.pop(job_id)
+                    logger.warning("Dropping job %s: unfinished for %.0fs.", job_id, now - at)
+                else:
+                    adopted.append((job_id, payload))
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if not name.startswith('jobs-') or not name.endswith('.jsonl') or path == self.path:
+                    continue
+                try:
+                    f = open(path, 'r', encoding='utf-8')
+                except FileNotFoundError:
+                    continue # Adopted by someone else meanwhile
+                with f:
+                    try:
+                        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue # Its process is still running (maybe draining)
+                    if os.fstat(f.fileno()).st_nlink == 0:
+                        continue # Replaced by a compaction or adopted while we waited
+                    jobs = _read_journal(f)
+                    for job_id, (at, payload) in jobs.items():
+                        if now - at > self.max_age:
+                            logger.warning("Dropping job %s from %s: unfinished for %.0fs.", job_id, name, now - at)
+                            continue
+                        # Ours now, durably, before the orphan file goes
+                        self._write({'op': 'begin', 'id': job_id, 'at': at, 'payload': payload}, sync=True)
+                        self._open[job_id] = (at, payload)
+                        adopted.append((job_id, payload))
+                    os.remove(path)
+                    if jobs:
+                        logger.info("Adopted %s unfinished jobs from %s.", len(jobs), name)
+        return adopted
+
+    def close(self):
+        """Releases the journal. It is removed if no job is left open; else
+        the next process adopts it."""
+        with self._lock:
+            if not self._open:
+                os.remove(self.path)
+            self._file.close()
+
+
+class Lifecycle:
+    def __init__(self, journal=None):
+        self.journal = journal
+        self.accepting = True
+        self.stopping = asyncio.Event()
+        self._running = {} # job id -> task
+
+    def install_signal_handlers(self, signals=(signal.SIGTERM, signal.SIGINT)):
+        loop = asyncio.get_running_loop()
+        for sig in signals:
+            loop.add_signal_handler(sig, self.stop, sig)
+
+    def stop(self, sig=None):
+        if self.stopping.is_set():
+            # Asked twice: don't wait for the deadline; cut off jobs stay journaled
+            logger.warning("Stopping now, cancelling %s jobs.", len(self._running))
+            for task in self._running.values():
+                task.cancel()
+            return
+        logger.info("Shutdown requested%s, no longer taking new jobs.", f' ({signal.Signals(sig).name})' if sig else '')
+        self.accepting = False
+        self.stopping.set()
+
+    async def run(self, job_id, coro, payload=None):
+        """Runs ``coro`` as a tracked job. True if it ran to the end (or
+        failed); False if it was put aside or cut off by the shutdown.
+
+        With a ``payload`` (and a journal) the job is journaled, and put aside
+        in the journal instead of run once the shutdown has begun.
+        """
+        journaled = payload is not None and self.journal is not None
+        if not self.accepting:
+            coro.close()
+            if journaled:
+                await asyncio.to_thread(self.journal.begin, job_id, payload)
+            return False
+        if journaled:
+            await asyncio.to_thread(self.journal.begin, job_id, payload)
+        task = asyncio.create_task(coro)
+        self._running[job_id] = task
+        try:
+            await asyncio.wait([task])
+        finally:
+            self._running.pop(job_id, None)
+        if task.cancelled():
+            return False # Stays in the journal for the next process
+        if journaled:
+            await asyncio.to_thread(self.journal.end, job_id)
+        task.result() # The job's own exception, if any
+        return True
+
+    async def drain(self, timeout):
+        """Waits up to ``timeout`` seconds for running jobs, then cancels the
+        rest. Returns how many were cut off."""
+        self.accepting = False
+        tasks = list(self._running.values())
+        if not tasks:
+            return 0
+        logger.info("Draining %s running jobs (up to %.0fs)...", len(tasks), timeout)
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+            logger.warning("%s jobs did not finish in time and were left for the next process.", len(pending))
+        return len(pending)
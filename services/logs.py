@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""Non-blocking, structured logging for the bot and the web app.
+
+``setup_logging`` replaces the root handlers with a ``QueueHandler``. A
+logging call then only checks the rate limit, stamps the trace id and puts
+the record on an in-memory queue. Formatting the message (log calls use
+``%s`` arguments, so it is lazy), building the JSON and writing to stderr
+all happen in a ``QueueListener`` thread. A slow terminal or log shipper
+never stalls the event loop or a request.
+
+Repetitive lines are rate limited per call site (logger, level and message
+template): ``rate`` records a second with bursts of ``burst``. Past the
+limit only one record in ``sample_every`` gets through, carrying the number
+it stands for in ``suppressed``, so an error storm stays visible without
+flooding. CRITICAL is never limited. When the queue is full, records are
+dropped rather than waited on. Both kinds of drop are counted in
+``log_records_dropped_total``.
+
+Environment:
+    LOG_LEVEL         default INFO
+    LOG_FORMAT        json (default) or text
+    LOG_QUEUE_SIZE    records buffered for the writer thread (default 10000)
+    LOG_RATE          records per second per call site (default 10)
+    LOG_BURST         default 50
+    LOG_SAMPLE_EVERY  over-limit records let through, 1 in N (default 100)
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+from services import metrics
+from services.tracing import TraceIdFilter
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s'
+
+# LogRecord attributes that are not user ``extra`` fields
+_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'trace_id', 'suppressed'}
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; ``extra={...}`` fields become keys."""
+
+    def __init__(self, service=None):
+        super().__init__()
+        self.service = service
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        if self.service:
+            entry['service'] = self.service
+        trace_id = getattr(record, 'trace_id', '-')
+        if trace_id != '-':
+            entry['trace_id'] = trace_id
+        if getattr(record, 'suppressed', 0):
+            entry['suppressed'] = record.suppressed
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket per call site, with sampling past the limit."""
+
+    def __init__(self, rate=10.0, burst=50, sample_every=100, clock=time.monotonic):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.sample_every = sample_every
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._buckets = {} # key -> [tokens, updated at, suppressed since last pass]
+
+    def filter(self, record):
+        if record.levelno >= logging.CRITICAL or not self.rate:
+            return True
+        key = (record.name, record.levelno, record.msg if isinstance(record.msg, str) else type(record.msg))
+        now = self.clock()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) > 10000:
+                    self._buckets.clear() # f-string call sites make every message a key
+                bucket = self._buckets[key] = [self.burst, now, 0]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+            elif bucket[2] + 1 < self.sample_every:
+                bucket[2] += 1
+                metrics.LOG_RECORDS_DROPPED_TOTAL.inc(reason='rate_limited')
+                return False
+            record.suppressed, bucket[2] = bucket[2], 0
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Puts records on the queue as they are; never waits for room."""
+
+    def prepare(self, record):
+        # The listener formats: the caller pays for neither the message nor
+        # the traceback. (The record is not pickled, the queue is in-process.)
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.LOG_RECORDS_DROPPED_TOTAL.inc(reason='queue_full')
+
+
+def setup_logging(service=None, level=None, fmt=None):
+    """Routes all logging through a queue and a writer thread. Idempotent."""
+    global _listener
+    if _listener is not None:
+        return
+    level = level or os.environ.get('LOG_LEVEL', 'INFO').upper()
+    fmt = fmt or os.environ.get('LOG_FORMAT', 'json').lower()
+
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(JsonFormatter(service) if fmt == 'json' else logging.Formatter(TEXT_FORMAT))
+
+    records = queue.Queue(maxsize=int(os.environ.get('LOG_QUEUE_SIZE', 10000)))
+    handler = NonBlockingQueueHandler(records)
+    # Both run on the caller's side: the trace id lives in the caller's context
+    handler.addFilter(TraceIdFilter())
+    handler.addFilter(RateLimitFilter(
+        rate=float(os.environ.get('LOG_RATE', 10)),
+        burst=int(os.environ.get('LOG_BURST', 50)),
+        sample_every=int(os.environ.get('LOG_SAMPLE_EVERY', 100)),
+    ))
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown)
+
+
+def shutdown():
+    """Writes out what is still queued and stops the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""Telegram file_id cache for Instagram posts.
+
+Once a post has been sent to Telegram, its file_id can be sent again to any
+chat without resolving the link or uploading the file a second time. The
+cache maps an Instagram shortcode to the ``(file_id, media_type)`` of the
+last successful send, least recently used entries going first when it is
+full. It lives in process memory: file_ids are cheap to get back, and the
+warmer (services/warming.py) refills the popular ones after a restart.
+"""
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+CachedMedia = namedtuple('CachedMedia', ['file_id', 'media_type', 'cached_at'])
+
+
+def file_id_of(message):
+    """The file_id of the media in a sent Pyrogram message, or None."""
+    for attribute in ('video', 'photo', 'animation', 'document'):
+        media = getattr(message, attribute, None)
+        if media is not None and getattr(media, 'file_id', None):
+            return media.file_id
+    return None
+
+
+class MediaCache:
+    def __init__(self, max_entries=10000, ttl=7 * 24 * 3600, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl # Telegram keeps file_ids valid far longer; this bounds stale entries
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def __contains__(self, shortcode):
+        return self.get(shortcode, touch=False) is not None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, shortcode, touch=True):
+        with self._lock:
+            entry = self._entries.get(shortcode)
+            if entry is None:
+                return None
+            if entry.cached_at + self.ttl < self.clock():
+                del self._entries[shortcode]
+                return None
+            if touch:
+                self._entries.move_to_end(shortcode)
+            return entry
+
+    def set(self, shortcode, file_id, media_type):
+        if not file_id:
+            return
+        with self._lock:
+            self._entries[shortcode] = CachedMedia(file_id, media_type, self.clock())
+            self._entries.move_to_end(shortcode)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, shortcode):
+        with self._lock:
+            self._entries.pop(shortcode, None)
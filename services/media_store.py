@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""Local, content-addressed store for media bytes the bot had to download.
+
+Usually Telegram fetches the media URL itself. When it refuses (or a cached
+file_id stops working and the post has to be uploaded again), the bot
+downloads the file and uploads the bytes. Those bytes are kept here, so the
+next upload of the same post reads local disk instead of the CDN.
+
+Layout under ``root``::
+
+    objects/ab/abcdef...   file contents, named by their SHA-256
+    tmp/                   downloads in progress
+    index.db               shortcode -> digest, sizes and last access (SQLite)
+
+* Writes are atomic. A download streams into ``tmp/`` and is fsynced before
+  ``os.replace`` moves it into ``objects/``. The index row is written only
+  after that. Identical content from different shortcodes is stored once.
+* Files are handed to the uploader as read-only memory maps (``open``), so
+  the upload reads straight from the page cache.
+* ``evict`` keeps the total size under ``max_bytes``, least recently used
+  first, down to ``low_watermark`` of it. The bot runs it in the background.
+* ``recover`` runs at startup and repairs whatever a crash left behind:
+  partial downloads, index rows without a file, files without an index row,
+  or an unreadable index.
+"""
+import hashlib
+import io
+import logging
+import mmap
+import os
+import tempfile
+import time
+from collections import namedtuple
+
+from sqlalchemy import (
+    BigInteger, Column, Float, MetaData, String, Table, create_engine, delete, event, func, select,
+)
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import DatabaseError
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 256 * 1024
+TOUCH_INTERVAL = 60 # Seconds between last_access updates of the same object
+EXTENSIONS = {'video': '.mp4', 'image': '.jpg'}
+
+StoredMedia = namedtuple('StoredMedia', ['shortcode', 'digest', 'path', 'size', 'media_type'])
+
+metadata = MetaData()
+
+media_objects = Table(
+    'media_objects', metadata,
+    Column('digest', String(64), primary_key=True),
+    Column('size', BigInteger, nullable=False),
+    Column('last_access', Float, nullable=False, index=True),
+)
+
+media_entries = Table(
+    'media_entries', metadata,
+    Column('shortcode', String(64), primary_key=True),
+    Column('digest', String(64), nullable=False, index=True),
+    Column('media_type', String(16)),
+    Column('created_at', Float, nullable=False),
+)
+
+
+class MappedFile(io.RawIOBase):
+    """Read-only file object over a memory map, with the name uploaders use
+    to guess the file type."""
+
+    def __init__(self, path, name):
+        super().__init__()
+        self.name = name
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        return self._map.read(None if size is None or size < 0 else size)
+
+    def readinto(self, buffer):
+        data = self._map.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._map.seek(offset, whence)
+        return self._map.tell()
+
+    def tell(self):
+        return self._map.tell()
+
+    def close(self):
+        if not self.closed:
+            self._map.close()
+        super().close()
+
+
+def _fsync_directory(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class MediaStore:
+    def __init__(self, root, max_bytes=2 * 1024 ** 3, low_watermark=0.9, max_file_bytes=2 * 1024 ** 3,
+                 clock=time.time):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.low_watermark = low_watermark
+        self.max_file_bytes = max_file_bytes
+        self.clock = clock
+        self.objects_dir = os.path.join(root, 'objects')
+        self.tmp_dir = os.path.join(root, 'tmp')
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        self.index_path = os.path.join(root, 'index.db')
+        self.engine = None
+        try:
+            self.engine = self._open_index()
+        except DatabaseError:
+            self._rebuild_index()
+
+    # --- Index ---
+
+    def _open_index(self):
+        engine = create_engine(f"sqlite:///{self.index_path}")
+
+        @event.listens_for(engine, "connect")
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.close()
+
+        metadata.create_all(bind=engine)
+        return engine
+
+    def _rebuild_index(self):
+        """Moves an unreadable index aside and starts an empty one."""
+        if self.engine is not None:
+            self.engine.dispose()
+        broken = f"{self.index_path}.broken-{int(self.clock())}"
+        os.replace(self.index_path, broken)
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(self.index_path + suffix):
+                os.remove(self.index_path + suffix)
+        logger.error("Media store index was unreadable, moved to %s; starting empty.", broken)
+        self.engine = self._open_index()
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def _object_files(self):
+        for prefix in os.listdir(self.objects_dir):
+            directory = os.path.join(self.objects_dir, prefix)
+            if os.path.isdir(directory):
+                for name in os.listdir(directory):
+                    yield name, os.path.join(directory, name)
+
+    def recover(self):
+        """Brings the index and the files back in line after a crash."""
+        for name in os.listdir(self.tmp_dir):
+            os.remove(os.path.join(self.tmp_dir, name)) # Interrupted downloads
+        try:
+            with self.engine.connect() as conn:
+                if conn.exec_driver_sql("PRAGMA quick_check").scalar() != 'ok':
+                    raise DatabaseError("PRAGMA quick_check", None, Exception("index corrupt"))
+        except DatabaseError:
+            self._rebuild_index()
+
+        files = dict(self._object_files())
+        with self.engine.begin() as conn:
+            indexed = dict(conn.execute(select(media_objects.c.digest, media_objects.c.size)).all())
+            # Rows whose file is gone or was cut short
+            lost = [digest for digest, size in indexed.items()
+                    if digest not in files or os.path.getsize(files[digest]) != size]
+            if lost:
+                conn.execute(delete(media_objects).where(media_objects.c.digest.in_(lost)))
+            conn.execute(delete(media_entries).where(media_entries.c.digest.not_in(select(media_objects.c.digest))))
+        # Files moved into place by a put that crashed before its index write
+        orphans = [path for digest, path in files.items() if digest not in indexed or digest in lost]
+        for path in orphans:
+            os.remove(path)
+        if lost or orphans:
+            logger.warning("Media store recovered: %s lost index rows, %s orphan files removed.", len(lost), len(orphans))
+
+    # --- Reads ---
+
+    def get(self, shortcode):
+        """The stored media for ``shortcode``, or None. Marks it recently used."""
+        with self.engine.connect() as conn:
+            row = conn.execute(
+                select(media_entries.c.digest, media_entries.c.media_type, media_objects.c.size,
+                       media_objects.c.last_access)
+                .join(media_objects, media_objects.c.digest == media_entries.c.digest)
+                .where(media_entries.c.shortcode == shortcode)
+            ).first()
+            if row is None:
+                return None
+            now = self.clock()
+            if now - row.last_access > TOUCH_INTERVAL:
+                conn.execute(media_objects.update().where(media_objects.c.digest == row.digest).values(last_access=now))
+                conn.commit()
+        path = self.object_path(row.digest)
+        if not os.path.exists(path):
+            return None # Evicted between the query and now
+        return StoredMedia(shortcode, row.digest, path, row.size, row.media_type)
+
+    def open(self, stored):
+        """A memory-mapped file object for uploading ``stored``."""
+        name = stored.shortcode + EXTENSIONS.get(stored.media_type, '.bin')
+        return MappedFile(stored.path, name)
+
+    def total_bytes(self):
+        with self.engine.connect() as conn:
+            return conn.execute(select(func.coalesce(func.sum(media_objects.c.size), 0))).scalar()
+
+    # --- Writes ---
+
+    def put(self, shortcode, chunks, media_type=None):
+        """Stores the bytes from the ``chunks`` iterable under ``shortcode``."""
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    size += len(chunk)
+                    if size > self.max_file_bytes:
+                        raise ValueError(f"{shortcode} is larger than {self.max_file_bytes} bytes")
+                    digest.update(chunk)
+                    f.write(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            if not size:
+                raise ValueError(f"{shortcode}: empty download")
+            hexdigest = digest.hexdigest()
+            path = self.object_path(hexdigest)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path) # Same digest, same bytes: replacing is harmless
+            _fsync_directory(os.path.dirname(path))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        now = self.clock()
+        with self.engine.begin() as conn:
+            stmt = insert(media_objects).values(digest=hexdigest, size=size, last_access=now)
+            conn.execute(stmt.on_conflict_do_update(index_elements=['digest'], set_={'last_access': now}))
+            stmt = insert(media_entries).values(shortcode=shortcode, digest=hexdigest, media_type=media_type,
+                                                created_at=now)
+            conn.execute(stmt.on_conflict_do_update(
+                index_elements=['shortcode'], set_={'digest': hexdigest, 'media_type': media_type, 'created_at': now},
+            ))
+        return StoredMedia(shortcode, hexdigest, path, size, media_type)
+
+    def fetch(self, shortcode, url, media_type=None, timeout=60, progress=None):
+        """Downloads ``url`` into the store. Blocking; run it in a thread.
+
+        ``progress(current, total)`` is called after each chunk when the
+        response has a Content-Length.
+        """
+        import requests # Only needed when Telegram cannot fetch a URL itself
+
+        with requests.get(url, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            chunks = response.iter_content(CHUNK_SIZE)
+            total = int(response.headers.get('Content-Length') or 0)
+            if progress is not None and total:
+                chunks = self._reporting(chunks, total, progress)
+            return self.put(shortcode, chunks, media_type)
+
+    @staticmethod
+    def _reporting(chunks, total, progress):
+        current = 0
+        for chunk in chunks:
+            current += len(chunk)
+            progress(current, total)
+            yield chunk
+
+    def close(self):
+        """Closes the index; the last connection checkpoints its WAL."""
+        self.engine.dispose()
+
+    def evict(self):
+        """Drops least recently used files until the store fits. Returns bytes freed."""
+        with self.engine.begin() as conn:
+            total = conn.execute(select(func.coalesce(func.sum(media_objects.c.size), 0))).scalar()
+            if total <= self.max_bytes:
+                return 0
+            target = self.max_bytes * self.low_watermark
+            victims = []
+            freed = 0
+            for digest, size in conn.execute(
+                select(media_objects.c.digest, media_objects.c.size).order_by(media_objects.c.last_access)
+            ):
+                if total - freed <= target:
+                    break
+                victims.append(digest)
+                freed += size
+            conn.execute(delete(media_entries).where(media_entries.c.digest.in_(victims)))
+            conn.execute(delete(media_objects).where(media_objects.c.digest.in_(victims)))
+        # Files go after the commit; a crash in between leaves orphans for recover()
+        for digest in victims:
+            try:
+                os.remove(self.object_path(digest))
+            except FileNotFoundError:
+                pass
+        logger.info("Media store evicted %s files (%s bytes).", len(victims), freed)
+        return freed
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""Minimal Prometheus-style metrics for the bot and the web app.
+
+Counters and histograms write into a per-thread shard, so recording a value
+never takes a lock; shards are only summed when the metrics are scraped.
+When a thread ends, its shard is folded into the metric's base totals, so
+short-lived threads do not pile up shards.
+``render()`` produces the Prometheus text format, served by ``/metrics`` in
+the Flask app and by ``start_http_server()`` in the bot process.
+"""
+import asyncio
+import bisect
+import functools
+import logging
+import threading
+import time
+import weakref
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in list(self._metrics):
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _ShardOwner:
+    """Lives in a thread's local storage; collected when the thread ends."""
+    __slots__ = ('__weakref__',)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+
+class _ShardedMetric(_Metric):
+    """Records into per-thread shards. Subclasses define ``_merge(total,
+    value)``, returning a new total (snapshots share the old one)."""
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self._local = threading.local()
+        self._shards = {} # id -> shard of a live thread
+        self._base = {} # Totals of the threads that have ended
+        self._shards_lock = threading.Lock()
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = {}
+            # Only taken once per thread, never on the recording path
+            with self._shards_lock:
+                self._shards[id(shard)] = shard
+            owner = self._local.owner = _ShardOwner()
+            weakref.finalize(owner, self._retire, shard).atexit = False
+        return shard
+
+    def _retire(self, shard):
+        """Folds the shard of an ended thread into the base totals."""
+        with self._shards_lock:
+            self._shards.pop(id(shard), None)
+            for key, value in shard.items():
+                self._base[key] = self._merge(self._base.get(key), value)
+
+    def _snapshots(self):
+        with self._shards_lock:
+            # dict.copy() is atomic under the GIL, so the owning thread may keep writing
+            return [self._base.copy()] + [shard.copy() for shard in self._shards.values()]
+
+
+class Counter(_ShardedMetric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def _merge(self, total, value):
+        return (total or 0) + value
+
+    def value(self, **labels):
+        key = self._key(labels)
+        return sum(shard.get(key, 0) for shard in self._snapshots())
+
+    def samples(self):
+        totals = {}
+        for shard in self._snapshots():
+            for key, value in shard.items():
+                totals[key] = totals.get(key, 0) + value
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in sorted(totals.items())]
+
+
+class Histogram(_ShardedMetric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        cells = shard.get(key)
+        if cells is None:
+            # One slot per bucket plus +Inf, then the running sum
+            cells = shard[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        cells[bisect.bisect_left(self.buckets, value)] += 1
+        cells[-1] += value
+
+    def time(self, **labels):
+        """Context manager and decorator (sync or async) observing elapsed time."""
+        return _Timer(self, labels)
+
+    def _merge(self, total, cells):
+        cells = list(cells)
+        return cells if total is None else [a + b for a, b in zip(total, cells)]
+
+    def samples(self):
+        totals = {}
+        for shard in self._snapshots():
+            for key, cells in shard.items():
+                merged = totals.setdefault(key, [0] * len(cells))
+                for i, cell in enumerate(list(cells)):
+                    merged[i] += cell
+        lines = []
+        for key, cells in sorted(totals.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), cells[:-1]):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(cells[-1])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Gauge(_Metric):
+    """Point-in-time value, either set directly or computed at scrape time."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        super().__init__(name, documentation, labelnames, registry)
+        self._values = {}
+        self._functions = {}
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def set_function(self, function, **labels):
+        self._functions[self._key(labels)] = function
+
+    def samples(self):
+        values = dict(self._values)
+        for key, function in list(self._functions.items()):
+            try:
+                values[key] = function()
+            except Exception as e:
+                logger.error("Error collecting gauge %s: %s", self.name, e)
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in sorted(values.items())]
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+    def __call__(self, func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with _Timer(self.histogram, self.labels):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _Timer(self.histogram, self.labels):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+def render(registry=REGISTRY):
+    return registry.render()
+
+
+def start_http_server(port, host='0.0.0.0', registry=REGISTRY):
+    """Serves ``/metrics`` from a daemon thread (for processes without Flask)."""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass # Scrapes every few seconds would flood the log
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics-exporter', daemon=True)
+    thread.start()
+    logger.info("Metrics exporter listening on %s:%s/metrics", host, port)
+    return server
+
+
+# --- Application metrics ---
+
+RESOLVE_SECONDS = Histogram('bot_resolve_seconds', 'Time spent resolving an Instagram link to a media URL.', ['outcome'])
+UPLOAD_SECONDS = Histogram('bot_upload_seconds', 'Time spent sending media to Telegram.', ['media_type'])
+DB_QUERY_SECONDS = Histogram('db_query_seconds', 'Time spent in database helpers.', ['helper'])
+HTTP_REQUEST_SECONDS = Histogram('http_request_seconds', 'Flask request handling time.', ['endpoint', 'status'])
+QUEUE_DEPTH = Gauge('queue_depth', 'Jobs waiting in or being processed from a queue.', ['queue'])
+MESSAGES_TOTAL = Counter('bot_messages_total', 'Link messages received by the bot.', ['outcome'])
+FLOOD_WAITS_TOTAL = Counter('bot_flood_waits_total', 'FloodWait errors raised by Telegram.', ['method'])
+FAILURES_TOTAL = Counter('bot_failures_total', 'Failed steps of the download pipeline.', ['stage'])
+CACHE_REQUESTS_TOTAL = Counter('cache_requests_total', 'Cache lookups by cache and result (hit/miss).', ['cache', 'result'])
+INLINE_ANSWER_SECONDS = Histogram('bot_inline_answer_seconds', 'Time from receiving an inline query to answering it.', ['result'])
+PROGRESS_EDITS_TOTAL = Counter('bot_progress_edits_total', 'Progress updates of status messages, by outcome (sent/coalesced/flood_wait/error).', ['outcome'])
+LOG_RECORDS_DROPPED_TOTAL = Counter('log_records_dropped_total', 'Log records not written, by reason (rate_limited/queue_full).', ['reason'])
+WARMS_TOTAL = Counter('bot_cache_warms_total', 'Posts pre-uploaded to the cache chat, by source and outcome.', ['source', 'outcome'])
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""Alembic helpers for changing big tables without stalling the bot or the panel.
+
+``batch_alter_table`` and single-statement backfills rewrite or lock a whole
+table for as long as they run. The helpers here do the same work in steps
+that only hold short locks on PostgreSQL:
+
+* ``create_index`` / ``drop_index`` use ``CONCURRENTLY`` (outside the
+  migration transaction, as PostgreSQL requires), and clean up an invalid
+  index left behind by an interrupted build.
+* ``backfill`` updates rows in primary-key ranges, each committed on its own,
+  sleeping between batches, and logs progress with a rate and an ETA.
+
+On SQLite they fall back to the plain operations: the database is local and
+has a single writer anyway.
+
+Use them from a migration's ``upgrade()``::
+
+    from services import online_migrations
+
+    op.add_column('users', sa.Column('updated_at', sa.DateTime(), nullable=True))
+    online_migrations.backfill('users', 'updated_at = joined_at', where='updated_at IS NULL')
+    online_migrations.create_index('ix_users_updated_at', 'users', ['updated_at'])
+
+Add new columns as nullable and without a server default so that adding them
+does not rewrite the table. Tune with MIGRATION_BATCH_SIZE and
+MIGRATION_BATCH_PAUSE (seconds).
+"""
+import logging
+import os
+import time
+
+import sqlalchemy as sa
+from alembic import op
+
+logger = logging.getLogger('alembic.online')
+
+BATCH_SIZE = int(os.environ.get("MIGRATION_BATCH_SIZE", 5000))
+BATCH_PAUSE = float(os.environ.get("MIGRATION_BATCH_PAUSE", 0.05))
+PROGRESS_INTERVAL = 5 # Seconds between progress lines
+
+
+def _is_postgresql():
+    return op.get_bind().dialect.name == 'postgresql'
+
+
+def _drop_invalid_index(name, table):
+    invalid = op.get_bind().execute(sa.text(
+        "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE c.relname = :name AND NOT i.indisvalid"
+    ), {"name": name}).first()
+    if invalid:
+        logger.warning("Dropping invalid index %s left by an interrupted build.", name)
+        op.drop_index(name, table_name=table, postgresql_concurrently=True)
+
+
+def create_index(name, table, columns, unique=False, **kw):
+    """CREATE INDEX CONCURRENTLY on PostgreSQL, a plain CREATE INDEX elsewhere."""
+    started = time.monotonic()
+    if _is_postgresql():
+        with op.get_context().autocommit_block():
+            _drop_invalid_index(name, table)
+            op.create_index(name, table, columns, unique=unique, postgresql_concurrently=True,
+                            if_not_exists=True, **kw)
+    else:
+        op.create_index(name, table, columns, unique=unique, **kw)
+    logger.info("Index %s on %s built in %.1fs.", name, table, time.monotonic() - started)
+
+
+def drop_index(name, table):
+    if _is_postgresql():
+        with op.get_context().autocommit_block():
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
+    else:
+        op.drop_index(name, table_name=table)
+
+
+class Progress:
+    """Throttled progress log for long-running steps."""
+
+    def __init__(self, label, total):
+        self.label = label
+        self.total = total
+        self.started = time.monotonic()
+        self.last_report = self.started
+
+    def update(self, done, rows, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_report < PROGRESS_INTERVAL:
+            return
+        self.last_report = now
+        elapsed = now - self.started
+        fraction = min(done / self.total, 1.0) if self.total else 1.0
+        eta = elapsed / fraction - elapsed if fraction else 0
+        logger.info("%s: %.0f%% (%s rows updated, %.0f rows/s, ETA %.0fs)", self.label, fraction * 100, rows, rows / elapsed if elapsed else 0, eta)
+
+
+def backfill(table, assignments, where=None, key='id', batch_size=None, pause=None):
+    """Runs ``UPDATE table SET assignments`` in committed primary-key batches.
+
+    ``assignments`` and ``where`` are SQL fragments. Include a ``where`` that
+    excludes rows already done, so an interrupted backfill can simply be
+    rerun. Returns the number of rows updated.
+    """
+    batch_size = batch_size or BATCH_SIZE
+    pause = BATCH_PAUSE if pause is None else pause
+    bind = op.get_bind()
+    low, high = bind.execute(sa.text(f"SELECT MIN({key}), MAX({key}) FROM {table}")).first()
+    if low is None:
+        return 0
+
+    condition = f" AND ({where})" if where else ""
+    statement = sa.text(f"UPDATE {table} SET {assignments} WHERE {key} >= :start AND {key} < :end{condition}")
+    progress = Progress(f"Backfill {table} SET {assignments}", high - low + 1)
+    postgresql = _is_postgresql()
+    updated = 0
+
+    def run_batches():
+        nonlocal updated
+        for start in range(low, high + 1, batch_size):
+            updated += bind.execute(statement, {"start": start, "end": start + batch_size}).rowcount
+            progress.update(start + batch_size - low, updated)
+            if postgresql and pause:
+                time.sleep(pause) # Leave room for the bot and the panel
+
+    if postgresql:
+        # Autocommit: every batch is its own short transaction
+        with op.get_context().autocommit_block():
+            run_batches()
+    else:
+        run_batches()
+    progress.update(high - low + 1, updated, force=True)
+    return updated
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""Live progress in status messages without flooding Telegram.
+
+Pyrogram calls a progress callback for every uploaded chunk, and a download
+reports every chunk it reads. Editing the status message that often would
+hit FloodWait within seconds. Progress goes through a ``ProgressDebouncer``
+shared by the whole bot instead:
+
+* a ``ProgressReporter`` only reports when the percentage moved by at least
+  ``min_step`` points;
+* the debouncer keeps, per chat, only the latest text of each status
+  message and edits at most once every ``min_interval`` seconds per chat.
+  Intermediate updates are dropped, not queued;
+* edits happen in a background task, so a slow or flood-waited edit never
+  holds up the transfer it reports on.
+
+Call ``finish(message)`` before the final edit or delete of a status
+message, so a late progress edit cannot overwrite the result.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from pyrogram.errors import FloodWait
+
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+BAR_WIDTH = 10
+
+
+def progress_bar(percent):
+    filled = min(BAR_WIDTH, percent * BAR_WIDTH // 100)
+    return "▰" * filled + "▱" * (BAR_WIDTH - filled)
+
+
+def human_size(size):
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+
+class _ChatState:
+    def __init__(self):
+        self.last_edit = float('-inf')
+        self.pending = OrderedDict() # message id -> (message, text)
+        self.editing = None # Id of the message whose edit is in flight
+        self.edited = asyncio.Event() # Set whenever no edit is in flight
+        self.edited.set()
+        self.task = None
+
+
+class ProgressDebouncer:
+    def __init__(self, min_interval=3.0, min_step=10, clock=time.monotonic):
+        self.min_interval = min_interval
+        self.min_step = min_step
+        self.clock = clock
+        self._chats = {}
+
+    def reporter(self, message, template):
+        """A reporter editing ``message`` with ``template``, which may use
+        {percent}, {bar}, {current} and {total}."""
+        return ProgressReporter(self, message, template, self.min_step)
+
+    def report(self, message, text):
+        """Sets the text ``message`` should show. Must be called on the event loop."""
+        state = self._chats.get(message.chat.id)
+        if state is None:
+            state = self._chats[message.chat.id] = _ChatState()
+        if message.id in state.pending:
+            metrics.PROGRESS_EDITS_TOTAL.inc(outcome="coalesced")
+        state.pending[message.id] = (message, text) # Keeps its place in line
+        if state.task is None:
+            state.task = asyncio.create_task(self._flush(message.chat.id, state))
+
+    async def finish(self, message):
+        """Drops pending progress for ``message`` and waits out an edit in flight."""
+        if message is None:
+            return
+        state = self._chats.get(message.chat.id)
+        if state is None:
+            return
+        state.pending.pop(message.id, None)
+        while state.editing == message.id:
+            await state.edited.wait()
+
+    async def _flush(self, chat_id, state):
+        try:
+            while state.pending:
+                wait = state.last_edit + self.min_interval - self.clock()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    continue
+                if not state.pending:
+                    break # Finished while we slept
+                message_id, (message, text) = state.pending.popitem(last=False)
+                state.editing = message_id
+                state.edited.clear()
+                try:
+                    await message.edit_text(text)
+                    metrics.PROGRESS_EDITS_TOTAL.inc(outcome="sent")
+                except FloodWait as e:
+                    metrics.FLOOD_WAITS_TOTAL.inc(method="edit_progress")
+                    metrics.PROGRESS_EDITS_TOTAL.inc(outcome="flood_wait")
+                    # Skip this update and back off; the next one carries newer numbers
+                    state.last_edit = self.clock() + e.value
+                    continue
+                except Exception as e:
+                    # Usually the message was already edited to its result or deleted
+                    metrics.PROGRESS_EDITS_TOTAL.inc(outcome="error")
+                    logger.debug("Progress edit in chat %s failed: %s", chat_id, e)
+                finally:
+                    state.editing = None
+                    state.edited.set()
+                state.last_edit = self.clock()
+        finally:
+            state.task = None
+            # Forget the chat once its last edit no longer limits the next one
+            asyncio.get_running_loop().call_later(
+                max(state.last_edit + self.min_interval - self.clock(), 0), self._forget, chat_id, state,
+            )
+
+    def _forget(self, chat_id, state):
+        if state.task is None and not state.pending and self._chats.get(chat_id) is state:
+            del self._chats[chat_id]
+
+
+class ProgressReporter:
+    def __init__(self, debouncer, message, template, min_step):
+        self.debouncer = debouncer
+        self.message = message
+        self.template = template
+        self.min_step = min_step
+        self._shown = None
+
+    def __call__(self, current, total):
+        if not total:
+            return
+        percent = min(100, int(current * 100 / total))
+        if self._shown is not None and percent - self._shown < self.min_step:
+            return
+        self._shown = percent
+        self.debouncer.report(self.message, self.template.format(
+            percent=percent, bar=progress_bar(percent), current=human_size(current), total=human_size(total),
+        ))
+
+    async def update(self, current, total):
+        """Pyrogram's ``progress=`` callback (it awaits coroutine functions)."""
+        self(current, total)
+
+    def threadsafe(self, loop):
+        """A callback for code running in another thread, e.g. a download."""
+        return lambda current, total: loop.call_soon_threadsafe(self, current, total)
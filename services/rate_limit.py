@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""Per-user token-bucket rate limiting with escalating cooldowns.
+
+Every user gets a bucket of ``capacity`` tokens that refills at
+``refill_per_second``. A message costs one token. A user who runs the bucket
+dry earns a strike and is put on a cooldown that doubles with every strike
+(up to ``max_cooldown``). Strikes are forgotten after ``strike_decay`` quiet
+seconds; reaching ``ban_after`` strikes flags the user for a ban. Checks made
+with ``strike=False`` (extra links in one message, inline queries) only
+spend what is there and never earn a strike.
+
+``RateLimiter`` keeps the buckets in memory. ``DatabaseRateLimiter`` keeps
+them in a ``rate_limits`` table so several bot processes share one quota.
+"""
+import logging
+import time
+from collections import namedtuple
+
+from sqlalchemy import (
+    BigInteger, Column, Float, Integer, MetaData, Table, create_engine, select,
+)
+from sqlalchemy.exc import IntegrityError
+
+logger = logging.getLogger(__name__)
+
+# allowed: handle the message. retry_after: seconds until the user may try
+# again. notify: this rejection started a cooldown, worth telling the user
+# (later rejections in the same cooldown are best ignored silently).
+# banned: the user has ``ban_after`` strikes or more.
+# granted: tokens actually spent, less than the cost asked for when the
+# bucket only had part of it.
+RateDecision = namedtuple('RateDecision', ['allowed', 'retry_after', 'notify', 'banned', 'granted'], defaults=(1,))
+
+ALLOWED = RateDecision(True, 0, False, False)
+
+
+class _Bucket:
+    __slots__ = ('tokens', 'updated_at', 'strikes', 'cooldown_until', 'last_strike_at')
+
+    def __init__(self, tokens, updated_at, strikes=0, cooldown_until=0.0, last_strike_at=0.0):
+        self.tokens = tokens
+        self.updated_at = updated_at
+        self.strikes = strikes
+        self.cooldown_until = cooldown_until
+        self.last_strike_at = last_strike_at
+
+
+class RateLimiter:
+    """In-memory limiter. Only valid inside a single process."""
+
+    shared = False
+
+    def __init__(self, capacity=5, refill_per_second=5 / 60, base_cooldown=60, max_cooldown=3600,
+                 strike_decay=3600, ban_after=0, max_tracked_users=100000, clock=time.monotonic):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.base_cooldown = base_cooldown
+        self.max_cooldown = max_cooldown
+        self.strike_decay = strike_decay
+        self.ban_after = ban_after # 0 disables automatic bans
+        self.max_tracked_users = max_tracked_users
+        self.clock = clock
+        self._buckets = {}
+
+    def check(self, user_id, cost=1, strike=True):
+        """Spends up to ``cost`` tokens for ``user_id`` and returns a RateDecision.
+
+        With ``strike=False`` an empty bucket is a plain rejection: no strike,
+        no cooldown."""
+        now = self.clock()
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            if len(self._buckets) >= self.max_tracked_users:
+                self.prune(now)
+            bucket = self._buckets[user_id] = _Bucket(self.capacity, now)
+        return self._spend(bucket, now, cost, strike)
+
+    def prune(self, now=None):
+        """Forgets users whose bucket is full again and who have no strikes."""
+        now = self.clock() if now is None else now
+        idle = []
+        for user_id, bucket in self._buckets.items():
+            self._decay(bucket, now)
+            if not bucket.strikes and bucket.tokens >= self.capacity and bucket.cooldown_until <= now:
+                idle.append(user_id)
+        for user_id in idle:
+            del self._buckets[user_id]
+        return len(idle)
+
+    def _decay(self, bucket, now):
+        """Refills tokens and expires old strikes."""
+        elapsed = max(0.0, now - bucket.updated_at)
+        bucket.tokens = min(self.capacity, bucket.tokens + elapsed * self.refill_per_second)
+        bucket.updated_at = now
+        if bucket.strikes and now - bucket.last_strike_at > self.strike_decay:
+            bucket.strikes = 0
+
+    def _spend(self, bucket, now, cost=1, strike=True):
+        if bucket.cooldown_until > now:
+            return RateDecision(False, bucket.cooldown_until - now, False, False, 0)
+
+        self._decay(bucket, now)
+        if bucket.tokens >= 1:
+            # A multi-link message gets as many links as there are whole tokens
+            granted = min(cost, int(bucket.tokens))
+            bucket.tokens -= granted
+            return ALLOWED if granted == 1 else ALLOWED._replace(granted=granted)
+        if not strike:
+            return RateDecision(False, (1 - bucket.tokens) / self.refill_per_second, False, False, 0)
+
+        bucket.strikes += 1
+        bucket.last_strike_at = now
+        cooldown = min(self.max_cooldown, self.base_cooldown * (2 ** (bucket.strikes - 1)))
+        bucket.cooldown_until = now + cooldown
+        banned = bool(self.ban_after) and bucket.strikes >= self.ban_after
+        return RateDecision(False, cooldown, True, banned, 0)
+
+
+rate_limits = Table(
+    'rate_limits', MetaData(),
+    Column('user_id', BigInteger, primary_key=True, autoincrement=False),
+    Column('tokens', Float, nullable=False),
+    Column('updated_at', Float, nullable=False),
+    Column('strikes', Integer, nullable=False, default=0),
+    Column('cooldown_until', Float, nullable=False, default=0.0),
+    Column('last_strike_at', Float, nullable=False, default=0.0),
+)
+
+
+class DatabaseRateLimiter(RateLimiter):
+    """Limiter whose buckets live in the database, shared across processes.
+
+    ``check`` does blocking I/O; call it from a thread in async code.
+    """
+
+    shared = True
+
+    def __init__(self, engine, create_tables=True, **kwargs):
+        # Buckets are compared across processes, so use wall-clock time
+        kwargs.setdefault('clock', time.time)
+        super().__init__(**kwargs)
+        self.engine = engine
+        self._for_update = engine.dialect.name == 'postgresql'
+        if create_tables:
+            rate_limits.metadata.create_all(bind=engine)
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        if url.startswith("postgres://"):
+            url = url.replace("postgres://", "postgresql://", 1)
+        return cls(create_engine(url), **kwargs)
+
+    def check(self, user_id, cost=1, strike=True):
+        try:
+            return self._check(user_id, cost, strike)
+        except IntegrityError:
+            # Another process created this user's row first; use theirs
+            return self._check(user_id, cost, strike)
+
+    def _check(self, user_id, cost, strike):
+        now = self.clock()
+        query = select(rate_limits).where(rate_limits.c.user_id == user_id)
+        if self._for_update:
+            query = query.with_for_update()
+        with self.engine.begin() as conn:
+            row = conn.execute(query).first()
+            if row is None:
+                bucket = _Bucket(self.capacity, now)
+            else:
+                bucket = _Bucket(row.tokens, row.updated_at, row.strikes, row.cooldown_until,
+                                 row.last_strike_at)
+            decision = self._spend(bucket, now, cost, strike)
+            values = {name: getattr(bucket, name) for name in _Bucket.__slots__}
+            if row is None:
+                conn.execute(rate_limits.insert().values(user_id=user_id, **values))
+            else:
+                conn.execute(rate_limits.update().where(rate_limits.c.user_id == user_id).values(**values))
+        return decision
+
+    def prune(self, now=None):
+        """Deletes rows for users that have been quiet long enough to be full."""
+        now = self.clock() if now is None else now
+        idle_for = max(self.capacity / self.refill_per_second, self.strike_decay)
+        with self.engine.begin() as conn:
+            result = conn.execute(
+                rate_limits.delete()
+                .where(rate_limits.c.updated_at < now - idle_for,
+                       rate_limits.c.cooldown_until < now)
+            )
+        return result.rowcount
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""Precomputed broadcast audiences.
+
+Each segment's members are kept as ``(segment, telegram_user_id)`` rows in
+``audience_segments``, so picking the recipients of a broadcast is one range
+read on the primary key instead of filtering ``users`` (and joining
+``user_activity``) at send time. ``audience_segment_sizes`` holds the member
+counts the admin panel shows before anything is sent.
+
+``refresh`` recomputes the segments. It applies only the difference (new
+members in, departed members out), so a refresh that changes little writes
+little. The bot runs it periodically; it can also be run by hand:
+
+    python -m services.segments refresh --database-url sqlite:///bot_database.db
+
+"Joined after a date" takes an arbitrary date, so it is not precomputed: it
+is a range read on ``ix_users_joined_at`` instead.
+"""
+import argparse
+import logging
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import (
+    BigInteger, Boolean, Column, DateTime, Integer, MetaData, String, Table,
+    create_engine, exists, func, literal, select,
+)
+
+from services.activity import user_activity
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_WINDOWS = tuple(int(days) for days in os.environ.get("SEGMENT_ACTIVE_DAYS", "7,30").split(","))
+HEAVY_DOWNLOADER_MIN = int(os.environ.get("HEAVY_DOWNLOADER_MIN", 50)) # Successful downloads
+JOINED_AFTER = 'joined_after'
+
+metadata = MetaData()
+
+audience_segments = Table(
+    'audience_segments', metadata,
+    Column('segment', String(32), primary_key=True),
+    Column('telegram_user_id', BigInteger, primary_key=True, autoincrement=False),
+)
+
+audience_segment_sizes = Table(
+    'audience_segment_sizes', metadata,
+    Column('segment', String(32), primary_key=True),
+    Column('size', Integer, nullable=False),
+    Column('refreshed_at', DateTime, nullable=False),
+)
+
+# The web app's users table (app.models.User), read only. Kept out of
+# ``metadata`` so create_tables never creates it.
+users = Table(
+    'users', MetaData(),
+    Column('id', Integer, primary_key=True),
+    Column('telegram_user_id', BigInteger),
+    Column('joined_at', DateTime),
+    Column('is_subscribed', Boolean),
+    Column('is_banned', Boolean),
+)
+
+
+def create_tables(engine):
+    metadata.create_all(bind=engine)
+
+
+def drop_tables(engine):
+    metadata.drop_all(bind=engine)
+
+
+def definitions(now=None):
+    """{segment: SELECT of its telegram_user_ids}. Banned users are never members."""
+    now = now or datetime.utcnow()
+    u, a = users.c, user_activity.c
+    allowed = u.is_banned == False # noqa: E712
+    with_activity = select(a.telegram_user_id).join(users, u.telegram_user_id == a.telegram_user_id)
+
+    segments = {'all': select(u.telegram_user_id).where(allowed)}
+    for days in ACTIVE_WINDOWS:
+        segments[f'active_{days}d'] = with_activity.where(a.last_active_at >= now - timedelta(days=days), allowed)
+    segments['subscribed'] = select(u.telegram_user_id).where(u.is_subscribed == True, allowed) # noqa: E712
+    segments['heavy'] = with_activity.where(a.download_count >= HEAVY_DOWNLOADER_MIN, allowed)
+    return segments
+
+
+def _upsert_size(conn, segment, size, at):
+    if conn.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    stmt = insert(audience_segment_sizes).values(segment=segment, size=size, refreshed_at=at)
+    conn.execute(stmt.on_conflict_do_update(
+        index_elements=[audience_segment_sizes.c.segment],
+        set_={'size': stmt.excluded.size, 'refreshed_at': stmt.excluded.refreshed_at},
+    ))
+
+
+def refresh(engine, names=None):
+    """Recomputes the given segments (all by default). Returns {segment: size}.
+
+    Each segment is refreshed in its own transaction, so readers always see a
+    complete member list.
+    """
+    now = datetime.utcnow()
+    m = audience_segments.c
+    sizes = {}
+    for name, query in definitions(now).items():
+        if names is not None and name not in names:
+            continue
+        wanted = query.subquery()
+        with engine.begin() as conn:
+            added = conn.execute(audience_segments.insert().from_select(
+                ['segment', 'telegram_user_id'],
+                select(literal(name), wanted.c.telegram_user_id).where(
+                    ~exists().where(m.segment == name, m.telegram_user_id == wanted.c.telegram_user_id)
+                ),
+            )).rowcount
+            removed = conn.execute(audience_segments.delete().where(
+                m.segment == name, m.telegram_user_id.not_in(select(wanted.c.telegram_user_id))
+            )).rowcount
+            size = conn.execute(select(func.count()).where(m.segment == name)).scalar()
+            _upsert_size(conn, name, size, now)
+        sizes[name] = size
+        logger.info("Segment %s: %s members (+%s -%s).", name, size, added, removed)
+    return sizes
+
+
+def get_sizes(session):
+    """{segment: row with size and refreshed_at} for every computed segment."""
+    return {row.segment: row for row in session.execute(select(audience_segment_sizes))}
+
+
+def _banned():
+    # Bans made since the last refresh; a read of the partial index on banned users
+    return select(users.c.telegram_user_id).where(users.c.is_banned == True) # noqa: E712
+
+
+def count_joined_after(session, since):
+    return session.execute(
+        select(func.count()).where(users.c.joined_at >= since, users.c.is_banned == False) # noqa: E712
+    ).scalar()
+
+
+def members_query(segment, since=None, after=None, batch_size=1000):
+    """SELECT of one page of the segment's telegram_user_ids (see iter_members)."""
+    if segment == JOINED_AFTER:
+        return (select(users.c.telegram_user_id)
+                .where(users.c.joined_at >= since, users.c.is_banned == False) # noqa: E712
+                .order_by(users.c.joined_at))
+    m = audience_segments.c
+    query = (select(m.telegram_user_id)
+             .where(m.segment == segment, m.telegram_user_id.not_in(_banned()))
+             .order_by(m.telegram_user_id).limit(batch_size))
+    if after is not None:
+        query = query.where(m.telegram_user_id > after)
+    return query
+
+
+def iter_members(session, segment, since=None, batch_size=1000):
+    """Yields lists of telegram_user_ids in the segment.
+
+    Precomputed segments are read in primary-key pages, each page picking up
+    after the last id of the previous one. ``JOINED_AFTER`` needs ``since``
+    and is streamed in join order.
+    """
+    if segment == JOINED_AFTER:
+        result = session.execute(members_query(segment, since), execution_options={'yield_per': batch_size})
+        for partition in result.scalars().partitions():
+            yield list(partition)
+        return
+
+    last = None
+    while True:
+        batch = list(session.execute(members_query(segment, after=last, batch_size=batch_size)).scalars())
+        if not batch:
+            return
+        yield batch
+        last = batch[-1]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recompute the broadcast audience segments.")
+    parser.add_argument("command", choices=["refresh"])
+    parser.add_argument("--database-url", required=True)
+    parser.add_argument("--segment", action="append", help="only refresh this segment (repeatable)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    url = args.database_url
+    if url.startswith("postgres://"):
+        url = url.replace("postgres://", "postgresql://", 1)
+    engine = create_engine(url)
+    create_tables(engine)
+    for name, size in refresh(engine, args.segment).items():
+        print(f"{name}: {size}")
+
+
+if __name__ == "__main__":
+    main()
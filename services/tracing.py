@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""Lightweight span tracing for the bot's download pipeline.
+
+A trace covers one handled message and is split into timed spans (one per
+stage). The trace id doubles as a correlation id: ``TraceIdFilter`` adds it
+to every log record emitted while the trace is active. Finished traces go to
+an in-memory ring buffer and, when configured, to a JSON-lines file that the
+admin panel reads to show the slowest recent requests. The file is written
+by a background thread, so the event loop never waits on disk.
+
+Unsampled traces still carry an id for the logs but record nothing, so with
+sampling off a span costs one context variable lookup.
+"""
+import contextvars
+import functools
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import nullcontext
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+
+_NULL_SPAN = nullcontext()
+
+
+class _Span:
+    __slots__ = ('trace', 'name', 'started')
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.trace.spans.append({
+            "name": self.name,
+            "offset_ms": round((self.started - self.trace.started) * 1000, 2),
+            "duration_ms": round((time.perf_counter() - self.started) * 1000, 2),
+            "error": exc_type.__name__ if exc_type else None,
+        })
+
+
+class Trace:
+    sampled = True
+
+    def __init__(self, name, attributes):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.attributes = attributes
+        self.started_at = datetime.utcnow()
+        self.started = time.perf_counter()
+        self.spans = []
+
+    def span(self, name):
+        return _Span(self, name)
+
+    def to_dict(self, duration):
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "started_at": self.started_at.isoformat() + "Z",
+            "duration_ms": round(duration * 1000, 2),
+            "attributes": self.attributes,
+            "spans": self.spans,
+        }
+
+
+class _UnsampledTrace:
+    sampled = False
+
+    def __init__(self):
+        self.trace_id = uuid.uuid4().hex[:16]
+
+    def span(self, name):
+        return _NULL_SPAN
+
+
+class Tracer:
+    def __init__(self, sample_rate=0.0, buffer_size=500, export_path=None, max_file_bytes=10 * 1024 * 1024,
+                 export_queue_size=1000):
+        self.sample_rate = sample_rate
+        self.buffer = deque(maxlen=buffer_size)
+        self.export_path = export_path
+        self.max_file_bytes = max_file_bytes
+        self.dropped = 0 # Traces not exported because the writer fell behind
+        self._queue = queue.Queue(maxsize=export_queue_size)
+        self._writer = None
+        self._writer_lock = threading.Lock()
+
+    def traced(self, name):
+        """Decorator running an async function inside a new trace."""
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                if self.sample_rate and random.random() < self.sample_rate:
+                    trace = Trace(name, {})
+                else:
+                    trace = _UnsampledTrace()
+                token = _current_trace.set(trace)
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    _current_trace.reset(token)
+                    if trace.sampled:
+                        self._finish(trace)
+            return wrapper
+        return decorator
+
+    def _finish(self, trace):
+        record = trace.to_dict(time.perf_counter() - trace.started)
+        self.buffer.append(record)
+        if self.export_path:
+            self._export(record)
+
+    def _export(self, record):
+        """Hands the record to the writer thread; never waits for room."""
+        if self._writer is None:
+            with self._writer_lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._write_loop, name='trace-writer', daemon=True)
+                    self._writer.start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _write_loop(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                return
+            # Whatever else is queued goes out in the same write
+            records = [record]
+            while True:
+                try:
+                    record = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if record is None:
+                    self._write(records)
+                    return
+                records.append(record)
+            self._write(records)
+
+    def _write(self, records):
+        data = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+        try:
+            if os.path.exists(self.export_path) and os.path.getsize(self.export_path) > self.max_file_bytes:
+                os.replace(self.export_path, self.export_path + ".1")
+            with open(self.export_path, "a", encoding="utf-8") as f:
+                f.write(data)
+        except OSError as e:
+            logger.error("Error exporting %s traces: %s", len(records), e)
+
+    def close(self, timeout=5):
+        """Writes out the queued traces and stops the writer thread."""
+        with self._writer_lock:
+            writer, self._writer = self._writer, None
+        if writer is not None:
+            self._queue.put(None)
+            writer.join(timeout)
+
+    def slowest(self, limit=20):
+        return sorted(self.buffer, key=lambda record: record["duration_ms"], reverse=True)[:limit]
+
+
+def span(name):
+    """Times a stage of the current trace. No-op outside a sampled trace."""
+    trace = _current_trace.get()
+    if trace is None:
+        return _NULL_SPAN
+    return trace.span(name)
+
+
+def annotate(**attributes):
+    """Attaches attributes (user id, url, ...) to the current trace."""
+    trace = _current_trace.get()
+    if trace is not None and trace.sampled:
+        trace.attributes.update(attributes)
+
+
+def current_trace_id():
+    trace = _current_trace.get()
+    return trace.trace_id if trace is not None else None
+
+
+class TraceIdFilter(logging.Filter):
+    """Adds ``trace_id`` to log records so formats can use ``%(trace_id)s``."""
+
+    def filter(self, record):
+        record.trace_id = current_trace_id() or "-"
+        return True
+
+
+def read_slowest(path, limit=50, tail_bytes=2 * 1024 * 1024):
+    """Returns the slowest traces among the most recent ones in an export file."""
+    try:
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(0, size - tail_bytes))
+            data = f.read()
+    except OSError:
+        return []
+    lines = data.decode("utf-8", errors="ignore").splitlines()
+    if size > tail_bytes and lines:
+        lines = lines[1:] # First line is probably cut in half
+    records = []
+    for line in lines:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            continue
+    records.sort(key=lambda record: record.get("duration_ms", 0), reverse=True)
+    return records[:limit]
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""Durable update queue shared by the ingestor and the bot worker processes.
+
+The ingestor writes every incoming update into the ``update_queue`` table and
+any number of workers claim and process them. Delivery is at-least-once: a
+claimed job that is not acknowledged before its visibility timeout runs out is
+handed to another worker. Jobs are keyed by their update id, so an update that
+is ingested twice is only stored (and handled) once.
+"""
+import json
+import logging
+import uuid
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import (
+    Column, DateTime, Index, Integer, MetaData, String, Table, Text,
+    and_, create_engine, delete, func, select, update,
+)
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+PROCESSING = 'processing'
+DONE = 'done'
+DEAD = 'dead'
+
+metadata = MetaData()
+
+update_queue = Table(
+    'update_queue', metadata,
+    # "<chat_id>:<message_id>" - MTProto does not expose Bot API update ids,
+    # and a message id is only unique inside its chat.
+    Column('update_id', String(64), primary_key=True),
+    Column('kind', String(32), nullable=False, default='message'),
+    Column('payload', Text, nullable=False),
+    Column('status', String(16), nullable=False, default=PENDING),
+    Column('attempts', Integer, nullable=False, default=0),
+    Column('claim_token', String(32)),
+    Column('worker_id', String(128)),
+    # When the job may be claimed (again): creation time for new jobs, the
+    # visibility deadline for claimed ones and the retry time for failed ones.
+    Column('available_at', DateTime, nullable=False, default=datetime.utcnow),
+    Column('created_at', DateTime, nullable=False, default=datetime.utcnow),
+    Column('finished_at', DateTime),
+    Column('last_error', Text),
+)
+Index('ix_update_queue_status_available_at', update_queue.c.status, update_queue.c.available_at)
+
+Job = namedtuple('Job', ['update_id', 'kind', 'payload', 'attempts', 'claim_token'])
+
+
+class UpdateQueue:
+    """Claim/ack queue on top of SQLite or PostgreSQL."""
+
+    def __init__(self, engine, visibility_timeout=300, max_attempts=5, retry_delay=10, create_tables=True):
+        self.engine = engine
+        self.visibility_timeout = timedelta(seconds=visibility_timeout)
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        # Row locks with SKIP LOCKED let concurrent workers claim disjoint
+        # batches without waiting on each other. SQLite has no row locks; its
+        # single writer already serializes the claiming UPDATE.
+        self._skip_locked = engine.dialect.name == 'postgresql'
+        if create_tables:
+            metadata.create_all(bind=engine)
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        if url.startswith("postgres://"):
+            url = url.replace("postgres://", "postgresql://", 1)
+        return cls(create_engine(url), **kwargs)
+
+    # --- Producer side ---
+
+    def enqueue(self, update_id, payload, kind='message'):
+        """Stores an update. Returns False if it was already queued."""
+        now = datetime.utcnow()
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(update_queue.insert().values(
+                    update_id=str(update_id),
+                    kind=kind,
+                    payload=json.dumps(payload, ensure_ascii=False),
+                    status=PENDING,
+                    attempts=0,
+                    available_at=now,
+                    created_at=now,
+                ))
+            return True
+        except IntegrityError:
+            logger.debug("Update %s already queued, ignoring duplicate.", update_id)
+            return False
+
+    # --- Consumer side ---
+
+    def claim(self, worker_id, batch_size=1):
+        """Claims up to ``batch_size`` due jobs for ``worker_id``."""
+        now = datetime.utcnow()
+        token = uuid.uuid4().hex
+        due = and_(
+            update_queue.c.status.in_((PENDING, PROCESSING)),
+            update_queue.c.available_at <= now,
+        )
+        candidates = (
+            select(update_queue.c.update_id)
+            .where(due)
+            .order_by(update_queue.c.available_at)
+            .limit(batch_size)
+        )
+        if self._skip_locked:
+            candidates = candidates.with_for_update(skip_locked=True)
+
+        with self.engine.begin() as conn:
+            if self._skip_locked:
+                ids = conn.execute(candidates).scalars().all()
+                if not ids:
+                    return []
+                target = update_queue.c.update_id.in_(ids)
+            else:
+                # One statement, so two workers can never both claim a row.
+                target = and_(update_queue.c.update_id.in_(candidates.scalar_subquery()), due)
+            conn.execute(
+                update(update_queue)
+                .where(target)
+                .values(
+                    status=PROCESSING,
+                    claim_token=token,
+                    worker_id=worker_id,
+                    attempts=update_queue.c.attempts + 1,
+                    available_at=now + self.visibility_timeout,
+                )
+            )
+            rows = conn.execute(
+                select(
+                    update_queue.c.update_id, update_queue.c.kind, update_queue.c.payload,
+                    update_queue.c.attempts, update_queue.c.claim_token,
+                ).where(update_queue.c.claim_token == token)
+            ).all()
+        return [Job(r.update_id, r.kind, json.loads(r.payload), r.attempts, r.claim_token) for r in rows]
+
+    def ack(self, job):
+        """Marks a job as done. The row is kept so duplicates stay ignored."""
+        with self.engine.begin() as conn:
+            result = conn.execute(
+                update(update_queue)
+                .where(update_queue.c.update_id == job.update_id,
+                       update_queue.c.claim_token == job.claim_token)
+                .values(status=DONE, finished_at=datetime.utcnow(), last_error=None)
+            )
+        if result.rowcount == 0:
+            # Our claim expired and another worker took the job over.
+            logger.warning("Ack for update %s lost its claim; it may be handled twice.", job.update_id)
+        return result.rowcount == 1
+
+    def fail(self, job, error):
+        """Schedules a retry, or parks the job as dead after too many attempts."""
+        now = datetime.utcnow()
+        if job.attempts >= self.max_attempts:
+            values = dict(status=DEAD, finished_at=now, last_error=error)
+            logger.error("Update %s failed %s times, giving up: %s", job.update_id, job.attempts, error)
+        else:
+            delay = self.retry_delay * (2 ** (job.attempts - 1))
+            values = dict(status=PENDING, available_at=now + timedelta(seconds=delay), last_error=error)
+        with self.engine.begin() as conn:
+            conn.execute(
+                update(update_queue)
+                .where(update_queue.c.update_id == job.update_id,
+                       update_queue.c.claim_token == job.claim_token)
+                .values(**values)
+            )
+
+    def release(self, job):
+        """Hands a claimed job back at once, without counting the attempt
+        (the worker is shutting down, the job did not fail)."""
+        with self.engine.begin() as conn:
+            conn.execute(
+                update(update_queue)
+                .where(update_queue.c.update_id == job.update_id,
+                       update_queue.c.claim_token == job.claim_token)
+                .values(status=PENDING, available_at=datetime.utcnow(), attempts=update_queue.c.attempts - 1)
+            )
+
+    # --- Maintenance ---
+
+    def depth(self):
+        """Number of jobs waiting to be claimed or still being processed."""
+        try:
+            with self.engine.connect() as conn:
+                return conn.execute(
+                    select(func.count()).select_from(update_queue)
+                    .where(update_queue.c.status.in_((PENDING, PROCESSING)))
+                ).scalar() or 0
+        except SQLAlchemyError as e:
+            logger.error("Error reading update queue depth: %s", e)
+            return 0
+
+    def purge(self, older_than=86400):
+        """Deletes finished jobs older than ``older_than`` seconds.
+
+        Done rows double as the idempotency record, so keep them for longer
+        than an update can possibly be redelivered.
+        """
+        cutoff = datetime.utcnow() - timedelta(seconds=older_than)
+        with self.engine.begin() as conn:
+            result = conn.execute(
+                delete(update_queue)
+                .where(update_queue.c.status.in_((DONE, DEAD)), update_queue.c.finished_at < cutoff)
+            )
+        return result.rowcount
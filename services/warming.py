@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""Predictive warming of the media cache for trending posts.
+
+A viral reel is usually requested by many users within minutes. Without
+warming, every early requester pays for a full resolve and upload before the
+first file_id lands in the cache. ``TrendingTracker`` counts requests per
+shortcode over sliding windows. Once a shortcode crosses a window's threshold,
+``CacheWarmer`` resolves the post in the background and uploads it to a
+private cache chat. The resulting file_id is cached, so the requests that
+follow are served with a single send.
+
+Warming has a budget so it never competes with live traffic: one warm at a
+time, at most ``max_per_hour`` warms, and none while the live request rate
+is above ``max_live_rate``. Urgent offers (a user is waiting on an inline
+query) go ahead of the queue and skip the budget; the per-user rate limit
+covers those.
+"""
+import asyncio
+import logging
+import itertools
+import time
+from collections import Counter, deque
+
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class TrendingTracker:
+    """Sliding-window request counts per key.
+
+    ``thresholds`` maps a window length in seconds to the number of requests
+    within that window that makes a key trending, e.g. ``{60: 3, 900: 10}``.
+    Counts are kept in ``bucket_seconds`` buckets, so windows slide in steps
+    of that size.
+    """
+
+    def __init__(self, thresholds=None, bucket_seconds=10, clock=time.monotonic):
+        self.thresholds = dict(thresholds or {60: 3, 900: 10})
+        self.bucket_seconds = bucket_seconds
+        self.clock = clock
+        self._horizon = max(self.thresholds) // bucket_seconds + 1 # Buckets kept
+        self._buckets = deque() # (bucket number, Counter)
+
+    def _bucket(self):
+        number = int(self.clock() // self.bucket_seconds)
+        while self._buckets and self._buckets[0][0] <= number - self._horizon:
+            self._buckets.popleft()
+        if not self._buckets or self._buckets[-1][0] != number:
+            self._buckets.append((number, Counter()))
+        return number
+
+    def count(self, key, window):
+        """Requests for ``key`` within the last ``window`` seconds."""
+        first = self._bucket() - window // self.bucket_seconds
+        return sum(counts[key] for number, counts in self._buckets if number > first)
+
+    def rate(self, window=10):
+        """All requests per second over the last ``window`` seconds."""
+        first = self._bucket() - max(window // self.bucket_seconds, 1)
+        total = sum(sum(counts.values()) for number, counts in self._buckets if number > first)
+        return total / window
+
+    def record(self, key):
+        """Counts one request; True if ``key`` is trending in any window."""
+        self._bucket()
+        self._buckets[-1][1][key] += 1
+        return any(self.count(key, window) >= threshold for window, threshold in self.thresholds.items())
+
+
+class CacheWarmer:
+    """Background resolve-and-upload of candidate posts into a MediaCache.
+
+    ``resolve(url)`` returns ``(media_url, media_type)`` like the bot's
+    download helper. ``upload(shortcode, media_url, media_type)`` sends the
+    media to the cache chat and returns its file_id. Both are coroutines.
+    """
+
+    def __init__(self, cache, resolve, upload, max_per_hour=30, max_live_rate=2.0, live_rate=None,
+                 retry_after=3600, queue_size=100, clock=time.monotonic):
+        self.cache = cache
+        self.resolve = resolve
+        self.upload = upload
+        self.max_per_hour = max_per_hour
+        self.max_live_rate = max_live_rate
+        self.live_rate = live_rate or (lambda: 0.0) # Live link messages per second
+        self.retry_after = retry_after # Seconds before a failed post is tried again
+        self.clock = clock
+        self._queue = asyncio.PriorityQueue(maxsize=queue_size)
+        self._order = itertools.count() # FIFO within a priority
+        self._pending = set()
+        self._failed = {}
+        self._started = deque() # Start times of the warms in the last hour
+        self._urgent = asyncio.Event() # Set by urgent offers, wakes a budget wait
+
+    def is_pending(self, shortcode):
+        return shortcode in self._pending
+
+    def offer(self, shortcode, url, source="trending", urgent=False):
+        """Queues a post for warming. Returns False if it is not needed or no room."""
+        if shortcode in self._pending or shortcode in self.cache:
+            return False
+        if len(self._failed) > 10000:
+            self._failed = {key: at for key, at in self._failed.items() if self.clock() - at < self.retry_after}
+        failed_at = self._failed.get(shortcode)
+        if failed_at is not None and self.clock() - failed_at < self.retry_after:
+            return False
+        try:
+            self._queue.put_nowait((0 if urgent else 1, next(self._order), shortcode, url, source))
+        except asyncio.QueueFull:
+            metrics.WARMS_TOTAL.inc(source=source, outcome="dropped")
+            return False
+        self._pending.add(shortcode)
+        if urgent:
+            self._urgent.set()
+        return True
+
+    def _budget_delay(self):
+        """0 if a warm may start now (and counts it), else seconds to wait."""
+        now = self.clock()
+        while self._started and now - self._started[0] >= 3600:
+            self._started.popleft()
+        if len(self._started) >= self.max_per_hour:
+            return 3600 - (now - self._started[0])
+        if self.live_rate() > self.max_live_rate:
+            return 1 # Live traffic first
+        self._started.append(now)
+        return 0
+
+    async def warm(self, shortcode, url, source):
+        if shortcode in self.cache:
+            return "cached"
+        media_url, media_type = await self.resolve(url)
+        if not media_url:
+            self._failed[shortcode] = self.clock()
+            return "resolve_failed"
+        file_id = await self.upload(shortcode, media_url, media_type)
+        if not file_id:
+            self._failed[shortcode] = self.clock()
+            return "upload_failed"
+        self.cache.set(shortcode, file_id, media_type)
+        self._failed.pop(shortcode, None)
+        return "warmed"
+
+    async def run(self):
+        """Processes queued posts one at a time until cancelled."""
+        while True:
+            item = await self._queue.get()
+            priority, _, shortcode, url, source = item
+            if priority and shortcode not in self.cache:
+                delay = self._budget_delay()
+                if delay:
+                    # Back in line (same place) while we wait, so an urgent
+                    # offer arriving meanwhile is taken first
+                    self._queue.put_nowait(item)
+                    try:
+                        await asyncio.wait_for(self._urgent.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    self._urgent.clear()
+                    continue
+            try:
+                if shortcode in self.cache:
+                    outcome = "cached" # A live request got there first
+                else:
+                    outcome = await self.warm(shortcode, url, source)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._failed[shortcode] = self.clock()
+                outcome = "error"
+                logger.error("Error warming %s: %s", shortcode, e)
+            finally:
+                self._pending.discard(shortcode)
+            metrics.WARMS_TOTAL.inc(source=source, outcome=outcome)
+            if outcome == "warmed":
+                logger.info("Warmed media cache for %s (%s).", shortcode, source)
@@ -0,0 +1,61 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+
+from services import activity
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+    activity.create_table(engine)
+    activity.download_logs.create(engine)
+    return engine
+
+
+def _download(engine, user_id, success=True, at=None, summary=True):
+    """The bot's write path: the log row and the summary upsert, one transaction."""
+    at = at or datetime.utcnow()
+    with Session(engine) as session:
+        session.execute(activity.download_logs.insert().values(user_id=user_id, download_time=at, success=success))
+        if summary:
+            activity.record_download(session, user_id, success, "video", at=at)
+        session.commit()
+
+
+def _summary(engine, user_id):
+    with engine.connect() as conn:
+        return conn.execute(select(activity.user_activity).where(activity.user_activity.c.telegram_user_id == user_id)).first()
+
+
+def test_reconcile_repairs_drift_and_keeps_media_type(engine):
+    _download(engine, 1)
+    _download(engine, 1, summary=False) # Lost summary write
+    _download(engine, 1, success=False, summary=False)
+    _download(engine, 2)
+    with Session(engine) as session:
+        activity.record_download(session, 3, True) # No log rows left
+        session.commit()
+    assert activity.reconcile(engine, batch_size=1) == 2 # One row fixed, one orphan
+    row = _summary(engine, 1)
+    assert (row.download_count, row.failure_count, row.last_media_type) == (2, 1, "video")
+    assert _summary(engine, 3) is None
+    assert activity.reconcile(engine) == 0
+
+
+def test_download_during_reconcile_is_not_overwritten(engine, monkeypatch):
+    _download(engine, 1)
+    _download(engine, 1, summary=False)
+    rewrite = activity._rewrite
+
+    def download_meanwhile(*args):
+        # Commits after reconcile read the aggregate, before it writes
+        _download(engine, 1)
+        return rewrite(*args)
+
+    monkeypatch.setattr(activity, "_rewrite", download_meanwhile)
+    activity.reconcile(engine)
+    assert _summary(engine, 1).download_count == 3
@@ -0,0 +1,76 @@
+# The bot's ban list and user writes against the schema the web app's
+# migrations build (run_telegram_bot.prepare() runs them before the bot starts).
+import os
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import create_engine, update
+from sqlalchemy.orm import sessionmaker
+
+import bot
+from app import create_app, db
+from app.models import User as WebUser
+from config import Config
+from services.ban_list import BanList
+
+
+@pytest.fixture
+def migrated(tmp_path):
+    url = "sqlite:///" + os.path.join(tmp_path, "app.db")
+
+    class TestConfig(Config):
+        SQLALCHEMY_DATABASE_URI = url
+        ASSETS_FINGERPRINT = False
+        LOGIN_DISABLED = True
+
+    app = create_app(TestConfig)
+    with app.app_context():
+        from flask_migrate import upgrade
+        upgrade(directory=os.path.join(os.path.dirname(os.path.dirname(__file__)), "migrations"))
+    engine = create_engine(url)
+    yield app, engine
+    engine.dispose()
+
+
+def _ban_from_admin(app, telegram_user_id, banned=True):
+    # Through the admin panel's own ban/unban routes, so the test also
+    # covers that they move updated_at, which the incremental refresh needs
+    with app.app_context():
+        user_id = db.session.query(WebUser.id).filter_by(telegram_user_id=telegram_user_id).scalar()
+    response = app.test_client().get(f"/admin/users/{user_id}/{'ban' if banned else 'unban'}")
+    assert response.status_code == 302
+
+
+def test_load_and_refresh_see_admin_bans(migrated):
+    app, engine = migrated
+    session = sessionmaker(bind=engine)()
+    for telegram_user_id in (111, 222):
+        bot.add_or_update_user(session, SimpleNamespace(id=telegram_user_id, first_name="a", last_name=None, username=None))
+    session.close()
+    with engine.begin() as conn:
+        # Long-standing users: only an updated_at moved by the routes puts them past the refresh cursor
+        conn.execute(update(bot.User.__table__).values(updated_at=datetime.utcnow() - timedelta(hours=1)))
+    session = sessionmaker(bind=engine)()
+    bot.add_or_update_user(session, SimpleNamespace(id=999, first_name="new", last_name=None, username=None))
+    session.close() # A recent signup moves the cursor to now on load()
+    _ban_from_admin(app, 111)
+
+    ban_list = BanList(engine, bot.User.telegram_user_id, bot.User.is_banned, bot.User.updated_at)
+    ban_list.load()
+    assert 111 in ban_list and 222 not in ban_list
+
+    _ban_from_admin(app, 222)
+    _ban_from_admin(app, 111, banned=False)
+    ban_list.refresh()
+    assert 222 in ban_list and 111 not in ban_list
+
+
+def test_ban_user_writes_the_migrated_column(migrated, monkeypatch):
+    app, engine = migrated
+    session = sessionmaker(bind=engine)()
+    bot.add_or_update_user(session, SimpleNamespace(id=333, first_name="b", last_name=None, username=None))
+    monkeypatch.setattr(bot, "ban_list", BanList(engine, bot.User.telegram_user_id, bot.User.is_banned, bot.User.updated_at))
+    bot.ban_user(session, 333)
+    with app.app_context():
+        assert db.session.query(WebUser).filter_by(telegram_user_id=333).one().is_banned
@@ -0,0 +1,15 @@
+from benchmarks.report import percentile
+
+
+def test_nearest_rank():
+    hundred = list(range(1, 101))
+    assert percentile(hundred, 50) == 50
+    assert percentile(hundred, 95) == 95
+    assert percentile(hundred, 99) == 99
+    assert percentile(hundred, 100) == 100
+    two_hundred = list(range(1, 201))
+    assert percentile(two_hundred, 50) == 100
+    assert percentile(two_hundred, 95) == 190
+    assert percentile([3, 1, 2], 50) == 2
+    assert percentile([7], 0) == 7
+    assert percentile([], 50) is None
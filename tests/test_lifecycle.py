@@ -0,0 +1,174 @@
+import asyncio
+import fcntl
+import json
+import os
+
+import pytest
+
+from services.lifecycle import JobJournal, Lifecycle, _read_journal
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+def _crash(journal):
+    # The process dies: the lock goes, the file stays as it is
+    journal._file.close()
+
+
+def _orphan(directory, name, *entries):
+    with open(os.path.join(directory, name), 'w', encoding='utf-8') as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + "\n")
+
+
+def test_reopened_journal_hands_out_its_leftovers_once(tmp_path, clock):
+    journal = JobJournal(tmp_path, clock=clock)
+    journal.begin("a", {"url": "https://a"})
+    journal.begin("b", {"url": "https://b"})
+    journal.end("a")
+    journal.end("a") # Ending twice is harmless
+    assert len(journal) == 1
+    _crash(journal)
+
+    journal = JobJournal(tmp_path, clock=clock) # Same host and pid: same file
+    assert journal.adopt() == [("b", {"url": "https://b"})]
+    assert journal.adopt() == []
+    assert len(journal) == 1 # Open until the resumed run ends it
+
+
+def test_adopts_unlocked_journals_and_drops_stale_jobs(tmp_path, clock):
+    _orphan(
+        tmp_path, "jobs-gone-1.jsonl",
+        {"op": "begin", "id": "x", "at": clock.now - 10, "payload": {"n": 1}},
+        {"op": "begin", "id": "old", "at": clock.now - 7200, "payload": {"n": 2}},
+        {"op": "begin", "id": "done", "at": clock.now - 10, "payload": {"n": 3}},
+        {"op": "end", "id": "done"},
+    )
+    with open(os.path.join(tmp_path, "jobs-gone-1.jsonl"), 'a', encoding='utf-8') as f:
+        f.write('{"op": "begin", "id"') # Torn last line
+    journal = JobJournal(tmp_path, max_age=3600, clock=clock)
+    assert journal.adopt() == [("x", {"n": 1})]
+    assert not os.path.exists(os.path.join(tmp_path, "jobs-gone-1.jsonl"))
+    # Written to our own journal before the orphan was removed
+    with open(journal.path, encoding='utf-8') as f:
+        assert set(_read_journal(f)) == {"x"}
+
+
+def test_skips_journals_still_locked_by_their_process(tmp_path, clock):
+    path = os.path.join(tmp_path, "jobs-busy-2.jsonl")
+    _orphan(tmp_path, "jobs-busy-2.jsonl", {"op": "begin", "id": "y", "at": clock.now, "payload": {}})
+    with open(path, encoding='utf-8') as owner:
+        fcntl.flock(owner.fileno(), fcntl.LOCK_EX)
+        journal = JobJournal(tmp_path, clock=clock)
+        assert journal.adopt() == []
+    assert journal.adopt() == [("y", {})] # Its owner is gone now
+
+
+def test_compaction_keeps_only_open_jobs(tmp_path, clock):
+    journal = JobJournal(tmp_path, compact_after=5, clock=clock)
+    journal.begin("keep", {"n": 0})
+    for n in range(10):
+        journal.begin(n, {"n": n})
+        journal.end(n)
+    with open(journal.path, encoding='utf-8') as f:
+        lines = f.readlines()
+    assert len(lines) <= 6
+    assert [name for name in os.listdir(tmp_path) if name.endswith('.tmp')] == []
+    journal.begin("after", {})
+    _crash(journal)
+    assert [job_id for job_id, _ in JobJournal(tmp_path, clock=clock).adopt()] == ["keep", "after"]
+
+
+def test_close_removes_the_journal_only_when_empty(tmp_path, clock):
+    journal = JobJournal(tmp_path, clock=clock)
+    journal.close()
+    assert os.listdir(tmp_path) == []
+    journal = JobJournal(tmp_path, clock=clock)
+    journal.begin("a", {})
+    journal.close()
+    assert os.path.exists(journal.path)
+
+
+def test_run_journals_jobs_until_they_end(tmp_path, clock):
+    async def scenario():
+        journal = JobJournal(tmp_path, clock=clock)
+        lifecycle = Lifecycle(journal)
+        seen = []
+
+        async def job():
+            seen.append(len(journal))
+            return "sent"
+
+        assert await lifecycle.run("a", job(), payload={"url": "https://a"})
+        assert seen == [1] and len(journal) == 0
+        assert await lifecycle.run("w", job()) # No payload: not journaled
+        assert seen == [1, 0]
+
+        async def broken():
+            raise RuntimeError("boom")
+
+        with pytest.raises(RuntimeError):
+            await lifecycle.run("b", broken(), payload={})
+        assert len(journal) == 0 # Failed, not cut off: not resumed
+
+    asyncio.run(scenario())
+
+
+def test_stop_puts_new_jobs_aside_and_drain_cuts_off_slow_ones(tmp_path, clock):
+    async def scenario():
+        journal = JobJournal(tmp_path, clock=clock)
+        lifecycle = Lifecycle(journal)
+        started = asyncio.Event()
+
+        async def slow():
+            started.set()
+            await asyncio.sleep(60)
+
+        async def quick():
+            await asyncio.sleep(0.01)
+
+        slow_run = asyncio.create_task(lifecycle.run("slow", slow(), payload={"n": 1}))
+        quick_run = asyncio.create_task(lifecycle.run("quick", quick(), payload={"n": 2}))
+        await started.wait()
+        lifecycle.stop()
+        ran = []
+
+        async def late():
+            ran.append(True)
+
+        assert not await lifecycle.run("late", late(), payload={"n": 3})
+        assert ran == []
+        assert await lifecycle.drain(timeout=0.2) == 1
+        assert await quick_run and not await slow_run
+        assert set(journal._open) == {"slow", "late"}
+
+    asyncio.run(scenario())
+
+
+def test_second_stop_cancels_running_jobs():
+    async def scenario():
+        lifecycle = Lifecycle()
+        started = asyncio.Event()
+
+        async def slow():
+            started.set()
+            await asyncio.sleep(60)
+
+        run = asyncio.create_task(lifecycle.run("slow", slow()))
+        await started.wait()
+        lifecycle.stop()
+        lifecycle.stop()
+        assert not await asyncio.wait_for(run, 1)
+
+    asyncio.run(scenario())
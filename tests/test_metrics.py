@@ -0,0 +1,73 @@
+import asyncio
+import threading
+
+import pytest
+
+from services.metrics import Counter, Gauge, Histogram, Registry
+
+
+@pytest.fixture
+def registry():
+    return Registry()
+
+
+def test_counter_sums_threads_and_folds_ended_ones(registry):
+    counter = Counter('jobs_total', 'Jobs.', ['outcome'], registry=registry)
+
+    def work():
+        for _ in range(100):
+            counter.inc(outcome='ok')
+
+    threads = [threading.Thread(target=work) for _ in range(50)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    counter.inc(2, outcome='failed')
+    assert counter.value(outcome='ok') == 5000
+    assert counter.value(outcome='failed') == 2
+    assert len(counter._shards) == 1 # Only the live main thread
+    assert 'jobs_total{outcome="ok"} 5000' in registry.render()
+
+
+def test_histogram_buckets_are_cumulative(registry):
+    histogram = Histogram('latency_seconds', 'Latency.', buckets=(0.1, 1.0), registry=registry)
+    for value in (0.05, 0.5, 0.5, 5.0):
+        histogram.observe(value)
+    thread = threading.Thread(target=histogram.observe, args=(0.05,))
+    thread.start()
+    thread.join()
+    lines = registry.render().splitlines()
+    assert 'latency_seconds_bucket{le="0.1"} 2' in lines
+    assert 'latency_seconds_bucket{le="1.0"} 4' in lines
+    assert 'latency_seconds_bucket{le="+Inf"} 5' in lines
+    assert 'latency_seconds_count 5' in lines
+    assert 'latency_seconds_sum 6.1' in lines
+
+
+def test_histogram_timer_decorates_coroutines(registry):
+    histogram = Histogram('step_seconds', 'Step.', ['step'], registry=registry)
+
+    @histogram.time(step='x')
+    async def step():
+        return 42
+
+    assert asyncio.run(step()) == 42
+    assert 'step_seconds_count{step="x"} 1' in registry.render()
+
+
+def test_gauge_function_and_label_checks(registry):
+    gauge = Gauge('depth', 'Depth.', ['queue'], registry=registry)
+    gauge.set(3, queue='a')
+    gauge.set_function(lambda: 7, queue='b')
+    gauge.set_function(lambda: 1 / 0, queue='c') # Logged, not raised
+    lines = registry.render().splitlines()
+    assert 'depth{queue="a"} 3' in lines and 'depth{queue="b"} 7' in lines
+    with pytest.raises(ValueError):
+        gauge.set(1, other='x')
+
+
+def test_label_values_are_escaped(registry):
+    counter = Counter('odd_total', 'Odd.', ['name'], registry=registry)
+    counter.inc(name='a"b\\c')
+    assert 'odd_total{name="a\\"b\\\\c"} 1' in registry.render()
@@ -0,0 +1,95 @@
+import asyncio
+from types import SimpleNamespace
+
+from pyrogram.errors import FloodWait
+
+from services.progress import ProgressDebouncer, human_size, progress_bar
+
+
+class FakeMessage:
+    def __init__(self, chat_id, message_id, fail=None):
+        self.chat = SimpleNamespace(id=chat_id)
+        self.id = message_id
+        self.edits = []
+        self.fail = fail
+
+    async def edit_text(self, text):
+        if self.fail:
+            error, self.fail = self.fail, None
+            raise error
+        self.edits.append(text)
+
+
+def test_reporter_only_reports_steps():
+    async def scenario():
+        debouncer = ProgressDebouncer(min_interval=0, min_step=10)
+        message = FakeMessage(1, 1)
+        reported = []
+        debouncer.report = lambda message, text: reported.append(text)
+        reporter = debouncer.reporter(message, "{percent}")
+        for current in range(0, 101):
+            reporter(current, 100)
+        assert reported == [str(percent) for percent in range(0, 101, 10)]
+        reporter(5, 0) # Unknown total: ignored
+        assert len(reported) == 11
+
+    asyncio.run(scenario())
+
+
+def test_updates_are_coalesced_per_chat():
+    async def scenario():
+        debouncer = ProgressDebouncer(min_interval=0.05, min_step=1)
+        first, second, other_chat = FakeMessage(1, 1), FakeMessage(1, 2), FakeMessage(2, 1)
+        for percent in range(5):
+            debouncer.report(first, f"a{percent}")
+        debouncer.report(second, "b")
+        debouncer.report(other_chat, "c")
+        await asyncio.sleep(0.01)
+        # Only the newest text is sent; the chat's next edit waits out min_interval
+        assert first.edits == ["a4"] and second.edits == []
+        assert other_chat.edits == ["c"] # Chats are limited separately
+        for percent in range(5, 10):
+            debouncer.report(first, f"a{percent}")
+        await asyncio.sleep(0.03)
+        assert second.edits == [] and first.edits == ["a4"]
+        await asyncio.sleep(0.2)
+        assert second.edits == ["b"]
+        assert first.edits == ["a4", "a9"]
+
+    asyncio.run(scenario())
+
+
+def test_finish_drops_pending_progress():
+    async def scenario():
+        debouncer = ProgressDebouncer(min_interval=0.05, min_step=1)
+        message = FakeMessage(1, 1)
+        debouncer.report(message, "10%")
+        await asyncio.sleep(0.01)
+        debouncer.report(message, "20%")
+        await debouncer.finish(message)
+        await asyncio.sleep(0.1)
+        assert message.edits == ["10%"]
+
+    asyncio.run(scenario())
+
+
+def test_flood_wait_backs_off_and_skips_the_update():
+    async def scenario():
+        debouncer = ProgressDebouncer(min_interval=0.01, min_step=1)
+        message = FakeMessage(1, 1, fail=FloodWait(value=0))
+        debouncer.report(message, "1")
+        await asyncio.sleep(0.05)
+        assert message.edits == [] # Dropped, not retried
+        debouncer.report(message, "2")
+        await asyncio.sleep(0.05)
+        assert message.edits == ["2"]
+
+    asyncio.run(scenario())
+
+
+def test_formatting():
+    assert progress_bar(0) == "▱" * 10
+    assert progress_bar(55) == "▰" * 5 + "▱" * 5
+    assert human_size(512) == "512 B"
+    assert human_size(1536) == "1.5 KB"
+    assert human_size(3 * 1024 ** 3) == "3.0 GB"
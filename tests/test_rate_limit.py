@@ -0,0 +1,73 @@
+import pytest
+from sqlalchemy import create_engine, func, select
+
+from services.rate_limit import DatabaseRateLimiter, RateLimiter, rate_limits
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture(params=["memory", "database"])
+def limiter(request):
+    clock = Clock()
+    options = dict(capacity=2, refill_per_second=1 / 60, base_cooldown=10, max_cooldown=100,
+                   strike_decay=1000, ban_after=2, clock=clock)
+    if request.param == "memory":
+        limiter = RateLimiter(**options)
+    else:
+        limiter = DatabaseRateLimiter(create_engine("sqlite://"), **options)
+    limiter.test_clock = clock
+    return limiter
+
+
+def test_burst_then_cooldown_doubles(limiter):
+    clock = limiter.test_clock
+    assert limiter.check(1).allowed
+    assert limiter.check(1).allowed
+    first = limiter.check(1)
+    assert not first.allowed and first.notify and first.retry_after == 10
+    silent = limiter.check(1)
+    assert not silent.allowed and not silent.notify
+    clock.now += 11
+    assert not limiter.check(1).allowed # Not refilled yet: second strike
+    assert limiter.check(2).allowed # Other users are unaffected
+
+
+def test_ban_flag_from_ban_after_strikes_on(limiter):
+    clock = limiter.test_clock
+    limiter.check(1)
+    limiter.check(1)
+    decision = limiter.check(1)
+    assert not decision.banned
+    for _ in range(2):
+        # Just past the cooldown, before a token is back: another strike
+        clock.now += decision.retry_after + 0.1
+        decision = limiter.check(1)
+        assert not decision.allowed and decision.banned
+
+
+def test_partial_spend_without_strike(limiter):
+    assert limiter.check(1, cost=5, strike=False).granted == 2
+    rejected = limiter.check(1, strike=False)
+    assert not rejected.allowed and not rejected.notify and not rejected.banned
+    # No cooldown was started: a refilled token is usable right away
+    limiter.test_clock.now += 60
+    assert limiter.check(1).allowed
+
+
+def test_prune_forgets_only_idle_users(limiter):
+    clock = limiter.test_clock
+    limiter.check(1)
+    clock.now += 2000 # Refilled, strikes decayed
+    limiter.check(2)
+    assert limiter.prune() == 1
+    if isinstance(limiter, DatabaseRateLimiter):
+        with limiter.engine.connect() as conn:
+            assert conn.execute(select(func.count()).select_from(rate_limits)).scalar() == 1
+    else:
+        assert list(limiter._buckets) == [2]
@@ -0,0 +1,88 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine, select, update
+from sqlalchemy.pool import StaticPool
+
+from services.update_queue import DEAD, DONE, PENDING, UpdateQueue, update_queue
+
+
+@pytest.fixture
+def queue():
+    # One shared in-memory database for every connection
+    engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+    return UpdateQueue(engine, visibility_timeout=60, max_attempts=2, retry_delay=10)
+
+
+def _row(queue, update_id):
+    with queue.engine.connect() as conn:
+        return conn.execute(select(update_queue).where(update_queue.c.update_id == update_id)).one()
+
+
+def _age(queue, update_id, **values):
+    with queue.engine.begin() as conn:
+        conn.execute(update(update_queue).where(update_queue.c.update_id == update_id).values(**values))
+
+
+def test_enqueue_is_idempotent(queue):
+    assert queue.enqueue("1:1", {"text": "a"})
+    assert not queue.enqueue("1:1", {"text": "a"})
+    assert queue.depth() == 1
+
+
+def test_claim_ack(queue):
+    queue.enqueue("1:1", {"text": "a"})
+    queue.enqueue("1:2", {"text": "b"})
+    jobs = queue.claim("w1", batch_size=5)
+    assert [job.payload["text"] for job in jobs] == ["a", "b"]
+    assert all(job.attempts == 1 for job in jobs)
+    assert queue.claim("w2") == [] # Still within the visibility timeout
+    assert queue.ack(jobs[0])
+    assert _row(queue, "1:1").status == DONE
+    assert queue.depth() == 1
+
+
+def test_stale_claim_is_reclaimed_and_old_ack_lost(queue):
+    queue.enqueue("1:1", {})
+    first, = queue.claim("w1")
+    _age(queue, "1:1", available_at=datetime.utcnow() - timedelta(seconds=1)) # Visibility ran out
+    second, = queue.claim("w2")
+    assert second.attempts == 2 and second.claim_token != first.claim_token
+    assert not queue.ack(first)
+    assert queue.ack(second)
+
+
+def test_fail_retries_with_backoff_then_dead(queue):
+    queue.enqueue("1:1", {})
+    job, = queue.claim("w1")
+    queue.fail(job, "boom")
+    row = _row(queue, "1:1")
+    assert row.status == PENDING and row.last_error == "boom"
+    assert row.available_at > datetime.utcnow() + timedelta(seconds=5)
+    assert queue.claim("w1") == [] # Not due yet
+    _age(queue, "1:1", available_at=datetime.utcnow() - timedelta(seconds=1))
+    job, = queue.claim("w1")
+    queue.fail(job, "boom again")
+    assert _row(queue, "1:1").status == DEAD
+    assert queue.depth() == 0
+
+
+def test_release_does_not_count_the_attempt(queue):
+    queue.enqueue("1:1", {})
+    job, = queue.claim("w1")
+    queue.release(job)
+    job, = queue.claim("w2")
+    assert job.attempts == 1
+
+
+def test_purge_deletes_only_old_finished_jobs(queue):
+    for update_id in ("1:1", "1:2", "1:3"):
+        queue.enqueue(update_id, {})
+    for job in queue.claim("w1", batch_size=2):
+        queue.ack(job)
+    _age(queue, "1:1", finished_at=datetime.utcnow() - timedelta(days=2))
+    assert queue.purge(older_than=86400) == 1
+    with queue.engine.connect() as conn:
+        left = set(conn.execute(select(update_queue.c.update_id)).scalars())
+    assert left == {"1:2", "1:3"}
+    assert not queue.enqueue("1:2", {}) # Kept rows still catch duplicates
@@ -0,0 +1,70 @@
+import asyncio
+
+from services.media_cache import MediaCache
+from services.warming import CacheWarmer, TrendingTracker
+
+
+def _warmer(**kwargs):
+    cache = MediaCache(clock=lambda: 0.0)
+    warmed = []
+
+    async def resolve(url):
+        return f"https://cdn/{url}", "video"
+
+    async def upload(shortcode, media_url, media_type):
+        warmed.append(shortcode)
+        return f"file-{shortcode}"
+
+    return CacheWarmer(cache, resolve, upload, clock=lambda: 0.0, **kwargs), cache, warmed
+
+
+async def _until(condition, timeout=1.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+def test_urgent_offer_is_not_stuck_behind_hourly_cap():
+    async def scenario():
+        warmer, cache, warmed = _warmer(max_per_hour=1)
+        task = asyncio.create_task(warmer.run())
+        try:
+            warmer.offer("first", "u1")
+            await _until(lambda: "first" in cache)
+            warmer.offer("second", "u2") # Waits up to an hour for the cap
+            await asyncio.sleep(0.05)
+            warmer.offer("inline", "u3", source="inline", urgent=True)
+            await _until(lambda: "inline" in cache)
+            assert warmed == ["first", "inline"]
+            assert warmer.is_pending("second")
+        finally:
+            task.cancel()
+
+    asyncio.run(scenario())
+
+
+def test_urgent_offer_is_not_stuck_behind_busy_live_traffic():
+    async def scenario():
+        warmer, cache, warmed = _warmer(max_live_rate=1.0, live_rate=lambda: 5.0)
+        task = asyncio.create_task(warmer.run())
+        try:
+            warmer.offer("trending", "u1")
+            await asyncio.sleep(0.05)
+            warmer.offer("inline", "u2", source="inline", urgent=True)
+            await _until(lambda: "inline" in cache, timeout=0.5)
+            assert warmed == ["inline"]
+        finally:
+            task.cancel()
+
+    asyncio.run(scenario())
+
+
+def test_trending_tracker_thresholds():
+    now = [0.0]
+    tracker = TrendingTracker({60: 3}, bucket_seconds=10, clock=lambda: now[0])
+    assert not tracker.record("a")
+    assert not tracker.record("a")
+    assert tracker.record("a")
+    now[0] += 70
+    assert not tracker.record("a")